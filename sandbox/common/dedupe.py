@@ -0,0 +1,351 @@
+"""
+Replace duplicate files with hardlinks or reflinks
+
+Every duplicate is compared byte by byte with the kept (original) file
+right before it is replaced, then it is replaced atomically: the link is
+created with a temporary name in the same directory and renamed over the
+duplicate.
+    hardlink  the duplicate becomes another name of the original inode
+    reflink   the duplicate stays a separate file (own metadata), which
+              shares the data blocks with the original (FICLONE ioctl,
+              btrfs/XFS/...), modifying one of them does not change the
+              other
+    auto      reflink if the file system supports it, else hardlink
+
+The journal is JSON lines, every batch is written and fsync-ed before it
+is applied and the replaced duplicates are marked after it, so everything
+done can be undone (a separate copy of the data is restored for every
+duplicate that was replaced and is still linked):
+    python -m sandbox.common.dedupe --undo JOURNAL
+"""
+import os
+import sys
+import json
+import errno
+import fcntl
+import filecmp
+import logging
+import argparse
+from collections import Counter
+
+from sandbox.common.file_copy import copy_file
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 2
+MODES = ('auto', 'reflink', 'hardlink')
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+_TMP_SUFFIX = '.dedupe-tmp'
+# errors meaning reflinks are not supported for these files
+_NO_REFLINK_ERRNOS = {errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV,
+                      errno.EINVAL, errno.ENOTTY, errno.EBADF}
+
+
+class DedupeException(Exception):
+    pass
+
+
+class DedupeStats:
+
+    def __init__(self):
+        self.counts = Counter()
+        self.bytes_reclaimed = 0
+
+    def __str__(self):
+        return '%s, %s MB reclaimed' % (
+            ', '.join('%s: %s' % item for item in sorted(self.counts.items()))
+            or 'nothing done', round(self.bytes_reclaimed / 1000000, 2))
+
+
+def _tmp_name(fname):
+    return fname + _TMP_SUFFIX
+
+
+def _reflink(src_fname, dest_fname):
+    with open(src_fname, 'rb') as fin, open(dest_fname, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def _replace_with_link(original, duplicate, mode):
+    """
+    :return str: the used mode ("reflink" or "hardlink")
+    """
+    tmp_fname = _tmp_name(duplicate)
+    try:
+        if mode in ('auto', 'reflink'):
+            try:
+                _reflink(original, tmp_fname)
+                # the reflink is a separate file, keep the metadata of the
+                # duplicate
+                stat_result = os.stat(duplicate)
+                os.chmod(tmp_fname, stat_result.st_mode)
+                os.utime(tmp_fname, ns=(stat_result.st_atime_ns,
+                                        stat_result.st_mtime_ns))
+                os.replace(tmp_fname, duplicate)
+                return 'reflink'
+            except OSError as ex:
+                if ex.errno not in _NO_REFLINK_ERRNOS:
+                    raise
+
+                if mode == 'reflink':
+                    raise DedupeException(
+                        'Reflinks are not supported for "%s": %s' %
+                        (duplicate, ex))
+
+                os.unlink(tmp_fname)
+
+        os.link(original, tmp_fname)
+        os.replace(tmp_fname, duplicate)
+        return 'hardlink'
+    except BaseException:
+        if os.path.lexists(tmp_fname):
+            os.unlink(tmp_fname)
+        raise
+
+
+def _check_pair(original, duplicate, verify):
+    """
+    :return str: reason to skip the duplicate or None
+    """
+    if not os.path.isfile(original) or not os.path.isfile(duplicate):
+        return 'missing'
+
+    original_stat = os.stat(original)
+    duplicate_stat = os.stat(duplicate)
+    if os.path.samestat(original_stat, duplicate_stat):
+        return 'already linked'
+
+    # neither hardlinks nor reflinks work across file systems
+    if original_stat.st_dev != duplicate_stat.st_dev:
+        return 'cross-device'
+
+    if original_stat.st_size != duplicate_stat.st_size:
+        return 'different'
+
+    if verify and not filecmp.cmp(original, duplicate, shallow=False):
+        return 'different'
+
+    return None
+
+
+def _write_batch(fout, records):
+    for record in records:
+        fout.write(json.dumps(record))
+        fout.write('\n')
+
+    fout.flush()
+    os.fsync(fout.fileno())
+
+
+def _iter_pairs(groups):
+    for group in groups:
+        original = group[0]
+        for duplicate in group[1:]:
+            yield original, duplicate
+
+
+def dedupe_files(groups, mode='auto', journal_fname=None, dry_run=False,
+                 verify=True, batch_size=100):
+    """
+    :param groups: iterable of lists of abs file names with equal content,
+    the first file of every group is kept, the rest are replaced with links
+    to it
+    :param mode: one of MODES
+    :param journal_fname: required (unless dry_run), the undo journal
+    :param verify: compare the files byte by byte before replacing
+    :param batch_size: count of duplicates written to the journal (and
+    fsync-ed) before they are replaced
+    :return DedupeStats:
+    """
+    if mode not in MODES:
+        raise DedupeException('Unsupported dedupe mode "%s"' % mode)
+
+    if not dry_run and not journal_fname:
+        raise DedupeException('Journal is required to dedupe files')
+
+    stats = DedupeStats()
+    fout = None
+    if not dry_run:
+        fout = open(journal_fname, 'w', encoding='utf-8')
+        _write_batch(fout, [{'version': JOURNAL_VERSION}])
+
+    try:
+        batch = []
+        for pair in _iter_pairs(groups):
+            batch.append(pair)
+            if len(batch) >= batch_size:
+                _dedupe_batch(batch, mode, fout, verify, stats)
+                batch = []
+
+        _dedupe_batch(batch, mode, fout, verify, stats)
+    finally:
+        if fout:
+            fout.close()
+
+    return stats
+
+
+def _dedupe_batch(pairs, mode, fout, verify, stats):
+    """
+    :param fout: journal file object, None for dry run
+    """
+    records = []
+    for original, duplicate in pairs:
+        # the journal must work from any working dir
+        original = os.path.abspath(original)
+        duplicate = os.path.abspath(duplicate)
+        skip_reason = _check_pair(original, duplicate, verify)
+        if skip_reason:
+            LOG.debug('Skipping "%s" (%s)', duplicate, skip_reason)
+            stats.counts[skip_reason] += 1
+            continue
+
+        stat_result = os.stat(duplicate)
+        records.append({
+            'original': original,
+            'duplicate': duplicate,
+            'size': stat_result.st_size,
+            'mode': stat_result.st_mode,
+            'atime_ns': stat_result.st_atime_ns,
+            'mtime_ns': stat_result.st_mtime_ns,
+            # the data is freed only when this was its last name
+            'last_link': stat_result.st_nlink == 1
+        })
+
+    if fout is None:
+        for record in records:
+            LOG.info('Would link "%s" to "%s"', record['duplicate'],
+                     record['original'])
+            stats.counts['planned'] += 1
+            if record['last_link']:
+                stats.bytes_reclaimed += record['size']
+        return
+
+    _write_batch(fout, records)
+    linked = []
+    try:
+        for record in records:
+            try:
+                used_mode = _replace_with_link(record['original'],
+                                               record['duplicate'], mode)
+            except OSError as ex:
+                LOG.warning('Can not link "%s": %s', record['duplicate'], ex)
+                stats.counts['failed'] += 1
+                continue
+
+            linked.append({'linked': record['duplicate'],
+                           'used_mode': used_mode})
+            stats.counts[used_mode] += 1
+            if record['last_link']:
+                stats.bytes_reclaimed += record['size']
+    finally:
+        # undo skips the records without this mark (unless hardlinked)
+        _write_batch(fout, linked)
+
+
+def _iter_journal_lines(journal_fname):
+    with open(journal_fname, encoding='utf-8') as fin:
+        header = json.loads(fin.readline() or 'null')
+        if not header or header.get('version') != JOURNAL_VERSION:
+            raise DedupeException('Not a dedupe journal (version %s): %s' %
+                                  (JOURNAL_VERSION, journal_fname))
+
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_journal(journal_fname):
+    """
+    :return generator: the records (dicts) of the journal
+    """
+    for item in _iter_journal_lines(journal_fname):
+        if 'duplicate' in item:
+            yield item
+
+
+def read_linked(journal_fname):
+    """
+    :return set: the duplicates marked as replaced in the journal
+    """
+    return {item['linked'] for item in _iter_journal_lines(journal_fname)
+            if 'linked' in item}
+
+
+def _is_linked(record, linked):
+    """
+    :param linked: see read_linked()
+    :return bool: True if the duplicate is still a link made by dedupe
+    (unchanged since then)
+    """
+    duplicate = record['duplicate']
+    if not os.path.isfile(duplicate):
+        return False
+
+    if os.path.samefile(record['original'], duplicate):
+        return True
+
+    if duplicate not in linked:
+        # journaled but not replaced (failed or interrupted), an
+        # interrupted reflink has the same data and metadata anyway
+        return False
+
+    # reflink, the duplicate kept its metadata
+    stat_result = os.stat(duplicate)
+    return (stat_result.st_size == record['size'] and
+            stat_result.st_mtime_ns == record['mtime_ns'])
+
+
+def undo_dedupe(journal_fname, dry_run=False):
+    """
+    Restore a separate copy of the data (and the metadata) of every
+    duplicate in the journal, which is still linked.
+
+    :return Counter: restored, skipped
+    """
+    counts = Counter()
+    linked = read_linked(journal_fname)
+    for record in iter_journal(journal_fname):
+        duplicate = record['duplicate']
+        if not _is_linked(record, linked):
+            LOG.info('Skipping "%s", not replaced, not linked or modified',
+                     duplicate)
+            counts['skipped'] += 1
+            continue
+
+        if dry_run:
+            LOG.info('Would restore "%s"', duplicate)
+            counts['restored'] += 1
+            continue
+
+        tmp_fname = _tmp_name(duplicate)
+        copy_file(record['original'], tmp_fname)
+        os.chmod(tmp_fname, record['mode'])
+        os.utime(tmp_fname, ns=(record['atime_ns'], record['mtime_ns']))
+        os.replace(tmp_fname, duplicate)
+        counts['restored'] += 1
+
+    return counts
+
+
+def _run():
+    parser = argparse.ArgumentParser(
+        description='Undo the replacing of duplicates with links')
+    parser.add_argument('--undo', required=True, metavar='JOURNAL',
+                        help='Journal written when deduplicating')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s [%(levelname)8s] %(message)s')
+    try:
+        counts = undo_dedupe(args.undo, args.dry_run)
+    except DedupeException as ex:
+        LOG.error('%s', ex)
+        sys.exit(1)
+
+    LOG.info('Undo done: %s', dict(counts))
+
+
+if __name__ == '__main__':
+    _run()
@@ -0,0 +1,211 @@
+"""
+Compact map digest -> (file size, file path) for millions of files
+
+Instead of one dict per file keyed by a hex string, the data is kept in a
+few flat columns:
+    digests       raw digests sorted, digest_size bytes per file
+    sizes         array of unsigned 64-bit integers
+    path_ids      index of the path of every digest in the path heap
+    path_offsets  start of every path in the path heap
+    path_heap     the UTF-8 encoded paths one after another
+Lookups are binary searches over the sorted digests, so the overhead per
+file is digest_size + 20 bytes (plus the encoded path) instead of hundreds
+of bytes for a dict, its hex key and its values.
+"""
+import array
+
+
+def _encode_path(path):
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def _decode_path(data):
+    return data.decode('utf-8', 'surrogateescape')
+
+
+class DigestMap:
+
+    def __init__(self, digest_size, digests, sizes, path_ids, path_offsets,
+                 path_heap):
+        self.digest_size = digest_size
+        self._digests = digests
+        self._sizes = sizes
+        self._path_ids = path_ids
+        self._path_offsets = path_offsets
+        self._path_heap = path_heap
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def _digest_at(self, index):
+        start = index * self.digest_size
+        return self._digests[start:start + self.digest_size]
+
+    def _path_at(self, index):
+        path_id = self._path_ids[index]
+        return _decode_path(self._path_heap[
+            self._path_offsets[path_id]:self._path_offsets[path_id + 1]])
+
+    def _find(self, digest):
+        """
+        :return int: index of digest or -1
+        """
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._digest_at(middle) < digest:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self) and self._digest_at(low) == digest:
+            return low
+
+        return -1
+
+    def get(self, hex_digest, default=None):
+        """
+        :return tuple: (size, path)
+        """
+        index = self._find(bytes.fromhex(hex_digest))
+        if index < 0:
+            return default
+
+        return self._sizes[index], self._path_at(index)
+
+    def __contains__(self, hex_digest):
+        return self._find(bytes.fromhex(hex_digest)) >= 0
+
+    def items(self):
+        """
+        :return generator: (hex digest, size, path) sorted by digest
+        """
+        for index in range(len(self)):
+            yield (self._digest_at(index).hex(), self._sizes[index],
+                   self._path_at(index))
+
+    def nbytes(self):
+        """
+        :return int: memory used by the columns
+        """
+        return sum(
+            len(column) * getattr(column, 'itemsize', 1)
+            for column in (self._digests, self._sizes, self._path_ids,
+                           self._path_offsets, self._path_heap)
+        )
+
+
+class DigestMapBuilder:
+
+    def __init__(self, digest_size=None):
+        """
+        :param digest_size: in bytes, by default taken from the first digest
+        """
+        self.digest_size = digest_size
+        self._digests = bytearray()
+        self._sizes = array.array('Q')
+        self._path_offsets = array.array('Q', [0])
+        self._path_heap = bytearray()
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def add(self, hex_digest, size, path):
+        digest = bytes.fromhex(hex_digest)
+        if self.digest_size is None:
+            self.digest_size = len(digest)
+        elif len(digest) != self.digest_size:
+            raise ValueError('Digest %s is not %s bytes' %
+                             (hex_digest, self.digest_size))
+
+        self._digests += digest
+        self._sizes.append(size)
+        self._path_heap += _encode_path(path)
+        self._path_offsets.append(len(self._path_heap))
+
+    def build(self, on_duplicate=None):
+        """
+        The columns are moved to the DigestMap, the builder is empty after
+        it.
+
+        :param on_duplicate: callable(hex digest, size, path) called for
+        every file with the digest of a file added before it, only the
+        first file with a digest is kept
+        :return DigestMap:
+        """
+        digest_size = self.digest_size or 0
+        digests = self._digests
+
+        def digest_at(index):
+            return digests[index * digest_size:(index + 1) * digest_size]
+
+        # sorted bucket by bucket (by the first byte of the digest), so the
+        # sort keys exist only for one bucket (1/256 of the files) at a time
+        buckets = [array.array('I') for _ in range(256)]
+        for index in range(len(self) if digest_size else 0):
+            buckets[digests[index * digest_size]].append(index)
+
+        sorted_digests = bytearray()
+        sizes = array.array('Q')
+        path_ids = array.array('I')
+        prev_digest = None
+        for bucket_id in range(len(buckets)):
+            bucket = buckets[bucket_id]
+            buckets[bucket_id] = None
+            # stable, so the first added file is kept for duplicated digests
+            for index in sorted(bucket, key=digest_at):
+                digest = digest_at(index)
+                if digest == prev_digest:
+                    if on_duplicate:
+                        path = _decode_path(self._path_heap[
+                            self._path_offsets[index]:
+                            self._path_offsets[index + 1]])
+                        on_duplicate(digest.hex(), self._sizes[index], path)
+                    continue
+
+                prev_digest = digest
+                sorted_digests += digest
+                sizes.append(self._sizes[index])
+                path_ids.append(index)
+
+        digest_map = DigestMap(digest_size, sorted_digests, sizes, path_ids,
+                               self._path_offsets, self._path_heap)
+        self.__init__(digest_size)
+        return digest_map
+
+
+if __name__ == '__main__':
+    import hashlib
+    import tracemalloc
+
+    count_files = 200000
+    paths = ['/media/backup/DCIM/%03dAPPLE/IMG_%06d.JPG' % (i // 1000, i)
+             for i in range(count_files)]
+    digests = [hashlib.sha1(path.encode()).hexdigest() for path in paths]
+
+    # peak, so the temporary data of building counts too
+    tracemalloc.start()
+    hash_data_map = {
+        digest: {'abs_name': path, 'size': 1000000 + i}
+        for i, (digest, path) in enumerate(zip(digests, paths))
+    }
+    dict_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del hash_data_map
+
+    tracemalloc.start()
+    builder = DigestMapBuilder()
+    for i, (digest, path) in enumerate(zip(digests, paths)):
+        builder.add(digest, 1000000 + i, path)
+    digest_map = builder.build()
+    del builder
+    map_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print('files: %s' % count_files)
+    print('dict of dicts, peak: %s bytes per file (paths not included)' %
+          round(dict_bytes / count_files, 1))
+    print('DigestMap, peak: %s bytes per file (paths included)' %
+          round(map_bytes / count_files, 1))
+    print('DigestMap columns: %s bytes per file (paths included)' %
+          round(digest_map.nbytes() / count_files, 1))
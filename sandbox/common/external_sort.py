@@ -0,0 +1,161 @@
+"""
+Sorting of more strings than fit in memory (external merge sort) and
+streaming operations on sorted strings
+
+The strings are collected in a set until the memory limit is reached,
+then they are sorted and spilled as a run to a temp file. Iterating
+k-way merges the runs (heapq.merge) with the strings still in memory, so
+the memory used is about the limit plus a read buffer per run. At most
+MAX_MERGE_RUNS runs are open at a time, if there are more they are first
+merged into fewer, longer runs (intermediate merge passes).
+
+The runs are NUL separated (the strings can contain new lines, e.g. file
+names), encoded with surrogateescape so any file name survives.
+"""
+import os
+import sys
+import heapq
+import shutil
+import tempfile
+
+_READ_SIZE = 1 << 16
+# estimated memory of a set slot (hash + pointer, load factor)
+_SET_SLOT_SIZE = 32
+# open run files merged at once, far below the usual limit of open files
+MAX_MERGE_RUNS = 128
+
+
+def _iter_run(fname):
+    with open(fname, encoding='utf-8', errors='surrogateescape',
+              newline='') as fin:
+        tail = ''
+        while True:
+            chunk = fin.read(_READ_SIZE)
+            if not chunk:
+                break
+
+            items = (tail + chunk).split('\0')
+            tail = items.pop()
+            yield from items
+
+
+def iter_unique(sorted_items):
+    """
+    :return generator: sorted_items without consecutive duplicates
+    """
+    prev_item = None
+    for item in sorted_items:
+        if item != prev_item:
+            yield item
+            prev_item = item
+
+
+def iter_sorted_diff(old_items, new_items):
+    """
+    Linear merge of two sorted iterables, only one item of each is in
+    memory at a time.
+
+    :return generator: ("-", item) for the items only in old_items and
+    ("+", item) for the items only in new_items, sorted by item
+    """
+    old_items = iter_unique(old_items)
+    new_items = iter_unique(new_items)
+    end = object()
+    old_item = next(old_items, end)
+    new_item = next(new_items, end)
+    while old_item is not end or new_item is not end:
+        if new_item is end or old_item is not end and old_item < new_item:
+            yield '-', old_item
+            old_item = next(old_items, end)
+        elif old_item is end or new_item < old_item:
+            yield '+', new_item
+            new_item = next(new_items, end)
+        else:
+            old_item = next(old_items, end)
+            new_item = next(new_items, end)
+
+
+class ExternalSorter:
+
+    def __init__(self, memory_limit=None, tmp_dir=None,
+                 max_merge_runs=MAX_MERGE_RUNS):
+        """
+        :param memory_limit: estimated bytes of the strings kept in memory,
+        None for no limit (nothing is spilled)
+        :param tmp_dir: where the temp dir for the runs is created
+        :param max_merge_runs: max count of runs merged (open) at once
+        """
+        if max_merge_runs < 2:
+            raise ValueError('max_merge_runs must be at least 2')
+
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.max_merge_runs = max_merge_runs
+        self.count_runs = 0
+        self._items = set()
+        self._memory_used = 0
+        self._runs_dir = None
+        # file names of the runs to merge
+        self._run_fnames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._runs_dir:
+            shutil.rmtree(self._runs_dir, ignore_errors=True)
+            self._runs_dir = None
+
+    def add(self, item):
+        if item in self._items:
+            return
+
+        self._items.add(item)
+        self._memory_used += sys.getsizeof(item) + _SET_SLOT_SIZE
+        if self.memory_limit and self._memory_used >= self.memory_limit:
+            self._spill()
+
+    def _write_run(self, sorted_items):
+        if self._runs_dir is None:
+            self._runs_dir = tempfile.mkdtemp(prefix='external_sort_',
+                                              dir=self.tmp_dir)
+
+        fname = os.path.join(self._runs_dir, 'run_%06d' % self.count_runs)
+        with open(fname, 'w', encoding='utf-8', errors='surrogateescape',
+                  newline='') as fout:
+            for item in sorted_items:
+                fout.write(item)
+                fout.write('\0')
+
+        self.count_runs += 1
+        self._run_fnames.append(fname)
+
+    def _spill(self):
+        self._write_run(sorted(self._items))
+        self._items = set()
+        self._memory_used = 0
+
+    def _merge_runs(self):
+        """
+        Merge the oldest runs into one until they can be merged at once
+        with the strings in memory.
+        """
+        while len(self._run_fnames) >= self.max_merge_runs:
+            fnames = self._run_fnames[:self.max_merge_runs]
+            del self._run_fnames[:self.max_merge_runs]
+            self._write_run(iter_unique(heapq.merge(
+                *(_iter_run(fname) for fname in fnames))))
+            for fname in fnames:
+                os.unlink(fname)
+
+    def __iter__(self):
+        """
+        :return generator: the unique strings sorted
+        """
+        self._merge_runs()
+        runs = [_iter_run(fname) for fname in self._run_fnames]
+        runs.append(iter(sorted(self._items)))
+        return iter_unique(heapq.merge(*runs))
@@ -0,0 +1,402 @@
+"""
+Persisted scan of a directory tree in a binary columnar file
+
+Layout (little-endian, every section starts at a multiple of 8 bytes):
+    header        magic, version, count of files, count of dirs, sizes of
+                  the name heaps, scan time (ns)
+    file columns  size (u64), mtime_ns (i64), dir id (u32),
+                  name offset (u64, count of files + 1)
+    dir columns   parent dir id (u32), name offset (u64, count of dirs + 1),
+                  mtime_ns (i64)
+    name heaps    the UTF-8 encoded file names one after another, then the
+                  dir names
+Dir 0 is the scanned (absolute) top dir, the rest are names relative to
+their parent dir. The file is loaded with mmap and the columns are
+zero-copy views (memoryview.cast, or NumPy arrays with to_numpy()), so a
+persisted scan is queried without re-walking or parsing the tree.
+open_catalog() scans again if the mtime of any dir changed since the scan
+(files added, removed or renamed), which costs a stat per dir. With
+check_files it also scans again if the size or the mtime of any file
+changed (rewritten in place), which costs a stat per file. The catalog file
+itself is not part of the scan, so it can be written inside the tree.
+
+The catalog is written by scan_tree() and used with:
+    with open_catalog(fname, top) as catalog:
+        for dir_path, name, size, mtime_ns in catalog.iter_files(): ...
+"""
+import os
+import sys
+import mmap
+import array
+import time
+import struct
+import logging
+
+from sandbox.common.dir_walker import iter_dirs
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = b'FCAT'
+VERSION = 2
+# magic, version, count of files, count of dirs, file names size,
+# dir names size, scan time (ns)
+_HEADER = struct.Struct('<4sIQQQQq')
+NO_PARENT = 0xFFFFFFFF
+# (column name, typecode, numpy dtype)
+_FILE_COLUMNS = (('sizes', 'Q', '<u8'), ('mtimes_ns', 'q', '<i8'),
+                 ('dir_ids', 'I', '<u4'), ('name_offsets', 'Q', '<u8'))
+_DIR_COLUMNS = (('parent_ids', 'I', '<u4'),
+                ('dir_name_offsets', 'Q', '<u8'),
+                ('dir_mtimes_ns', 'q', '<i8'))
+
+
+class FileCatalogException(Exception):
+    pass
+
+
+def _check_byte_order():
+    # the columns are written and viewed in the native byte order
+    if sys.byteorder != 'little':
+        raise FileCatalogException('Only little-endian platforms are '
+                                   'supported')
+
+
+def _encode(name):
+    return name.encode('utf-8', 'surrogateescape')
+
+
+def _decode(data):
+    return bytes(data).decode('utf-8', 'surrogateescape')
+
+
+def _padding(size):
+    return -size % 8
+
+
+def scan_tree(top, fname, include_dir=None, jobs=None):
+    """
+    Walk top and write the catalog of its regular files (symlinks are
+    followed) to fname.
+
+    :param include_dir: see sandbox.common.dir_walker.iter_dirs()
+    :param jobs: see sandbox.common.dir_walker.iter_dirs()
+    :return int: count of the files
+    """
+    _check_byte_order()
+    top = os.path.abspath(top)
+    fname = os.path.abspath(fname)
+    tmp_fname = '%s.tmp' % fname
+    scan_time_ns = time.time_ns()
+    columns = {name: array.array(typecode)
+               for name, typecode, _ in _FILE_COLUMNS + _DIR_COLUMNS}
+    heap = bytearray()
+    dir_heap = bytearray()
+    columns['name_offsets'].append(0)
+    columns['dir_name_offsets'].append(0)
+    dir_ids = {}
+
+    def add_dir(dir_path, parent_id, name, mtime_ns):
+        dir_ids[dir_path] = len(columns['parent_ids'])
+        columns['parent_ids'].append(parent_id)
+        dir_heap.extend(_encode(name))
+        columns['dir_name_offsets'].append(len(dir_heap))
+        # stat-ed before the dir is listed, so a change while it is listed
+        # makes the catalog stale
+        columns['dir_mtimes_ns'].append(mtime_ns)
+
+    add_dir(top, NO_PARENT, top, os.stat(top).st_mtime_ns)
+    for dir_path, dir_entries, file_entries in iter_dirs(
+            top, include_dir=include_dir, jobs=jobs,
+            on_error=lambda ex: LOG.warning('Can not list: %s', ex)):
+        dir_id = dir_ids[dir_path]
+        for entry in dir_entries:
+            try:
+                mtime_ns = entry.stat().st_mtime_ns
+            except OSError as ex:
+                LOG.warning('Can not stat: %s', ex)
+                mtime_ns = 0
+
+            add_dir(entry.path, dir_id, entry.name, mtime_ns)
+
+        for entry in file_entries:
+            if entry.path in (fname, tmp_fname):
+                continue
+
+            try:
+                if not entry.is_file():
+                    continue
+
+                stat_result = entry.stat()
+            except OSError as ex:
+                LOG.warning('Can not stat: %s', ex)
+                continue
+
+            columns['sizes'].append(stat_result.st_size)
+            columns['mtimes_ns'].append(stat_result.st_mtime_ns)
+            columns['dir_ids'].append(dir_id)
+            heap.extend(_encode(entry.name))
+            columns['name_offsets'].append(len(heap))
+
+    # writing the catalog inside the tree changes the mtime of its dir
+    catalog_dir_id = dir_ids.get(os.path.dirname(fname))
+    if catalog_dir_id is not None and os.stat(os.path.dirname(
+            fname)).st_mtime_ns != columns['dir_mtimes_ns'][catalog_dir_id]:
+        # changed by someone else during the scan, keep it stale
+        catalog_dir_id = None
+
+    count_files = len(columns['sizes'])
+    with open(tmp_fname, 'wb') as fout:
+        fout.write(_HEADER.pack(MAGIC, VERSION, count_files,
+                                len(columns['parent_ids']), len(heap),
+                                len(dir_heap), scan_time_ns))
+        fout.write(b'\0' * _padding(_HEADER.size))
+        for name, _, _ in _FILE_COLUMNS + _DIR_COLUMNS:
+            if name == 'dir_mtimes_ns':
+                dir_mtimes_offset = fout.tell()
+            data = columns[name].tobytes()
+            fout.write(data)
+            fout.write(b'\0' * _padding(len(data)))
+        fout.write(heap)
+        fout.write(dir_heap)
+
+    os.replace(tmp_fname, fname)
+    if catalog_dir_id is not None:
+        # changing the content of the file does not change the dir mtime
+        with open(fname, 'r+b') as fout:
+            fout.seek(dir_mtimes_offset + catalog_dir_id * 8)
+            fout.write(struct.pack('<q', os.stat(os.path.dirname(
+                fname)).st_mtime_ns))
+
+    LOG.info('Catalog of %s written to %s: %s files, %s dirs', top, fname,
+             count_files, len(columns['parent_ids']))
+    return count_files
+
+
+class FileCatalog:
+
+    def __init__(self, fname):
+        _check_byte_order()
+        self.fname = fname
+        with open(fname, 'rb') as fin:
+            if not os.fstat(fin.fileno()).st_size:
+                raise FileCatalogException('Empty file: %s' % fname)
+
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            self._load(fname)
+        except FileCatalogException:
+            self._mmap.close()
+            raise
+
+    def _load(self, fname):
+        if len(self._mmap) < _HEADER.size:
+            raise FileCatalogException('Not a file catalog: %s' % fname)
+
+        magic, version, count_files, count_dirs, heap_size, dir_heap_size, \
+            scan_time_ns = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != VERSION:
+            raise FileCatalogException('Not a file catalog (version %s): %s'
+                                       % (VERSION, fname))
+
+        self.count_files = count_files
+        self.count_dirs = count_dirs
+        self.scan_time_ns = scan_time_ns
+        # column name -> (offset in the file, typecode, count of items)
+        self._layout = {}
+        offset = _HEADER.size + _padding(_HEADER.size)
+        for columns, count in ((_FILE_COLUMNS, count_files),
+                               (_DIR_COLUMNS, count_dirs)):
+            for name, typecode, _ in columns:
+                length = count + 1 if name.endswith('name_offsets') else count
+                size = length * array.array(typecode).itemsize
+                self._layout[name] = (offset, typecode, length)
+                offset += size + _padding(size)
+
+        if offset + heap_size + dir_heap_size != len(self._mmap):
+            raise FileCatalogException('Truncated or corrupt catalog: %s' %
+                                       fname)
+
+        self._view = view = memoryview(self._mmap)
+        for name, (offset, typecode, length) in self._layout.items():
+            size = length * array.array(typecode).itemsize
+            # e.g. self.sizes
+            setattr(self, name, view[offset:offset + size].cast(typecode))
+
+        offset = len(self._mmap) - heap_size - dir_heap_size
+        self._heap = view[offset:offset + heap_size]
+        offset += heap_size
+        self._dir_heap = view[offset:offset + dir_heap_size]
+        self._dir_paths = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for name, _, _ in _FILE_COLUMNS + _DIR_COLUMNS:
+            getattr(self, name).release()
+        self._heap.release()
+        self._dir_heap.release()
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # NumPy arrays from to_numpy() still use it, it is closed when
+            # they are garbage collected
+            pass
+
+    def __len__(self):
+        return self.count_files
+
+    @property
+    def top(self):
+        return self.dir_path(0)
+
+    def name(self, index):
+        return _decode(self._heap[self.name_offsets[index]:
+                                  self.name_offsets[index + 1]])
+
+    def _dir_name(self, dir_id):
+        return _decode(self._dir_heap[self.dir_name_offsets[dir_id]:
+                                      self.dir_name_offsets[dir_id + 1]])
+
+    def rel_dir_paths(self):
+        """
+        :return list: relative path ("" for top) of every dir id, the parent
+        dirs are always before their children
+        """
+        if self._dir_paths is None:
+            dir_paths = ['']
+            for dir_id in range(1, self.count_dirs):
+                parent_path = dir_paths[self.parent_ids[dir_id]]
+                name = self._dir_name(dir_id)
+                dir_paths.append(os.path.join(parent_path, name)
+                                 if parent_path else name)
+            self._dir_paths = dir_paths
+
+        return self._dir_paths
+
+    def dir_path(self, dir_id):
+        rel_path = self.rel_dir_paths()[dir_id]
+        top = self._dir_name(0)
+        return os.path.join(top, rel_path) if rel_path else top
+
+    def path(self, index, relative=False):
+        dir_id = self.dir_ids[index]
+        dir_path = self.rel_dir_paths()[dir_id] if relative else \
+            self.dir_path(dir_id)
+        return os.path.join(dir_path, self.name(index))
+
+    def iter_files(self, relative=False):
+        """
+        :param relative: yield the dir paths relative to top ("" for top)
+        :return generator: (dir path, file name, size, mtime_ns), the
+        dir path strings are shared by the files of the same dir
+        """
+        dir_paths = self.rel_dir_paths()
+        if not relative:
+            dir_paths = [self.dir_path(dir_id)
+                         for dir_id in range(self.count_dirs)]
+
+        sizes = self.sizes
+        mtimes_ns = self.mtimes_ns
+        dir_ids = self.dir_ids
+        for index in range(self.count_files):
+            yield (dir_paths[dir_ids[index]], self.name(index), sizes[index],
+                   mtimes_ns[index])
+
+    def find_changed_dir(self):
+        """
+        :return str: path of a dir, which was changed (or removed) since the
+        scan, None if no dir changed
+        """
+        for dir_id in range(self.count_dirs):
+            dir_path = self.dir_path(dir_id)
+            try:
+                mtime_ns = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                return dir_path
+
+            if mtime_ns != self.dir_mtimes_ns[dir_id]:
+                return dir_path
+
+        return None
+
+    def find_changed_file(self):
+        """
+        :return str: path of a file, which size or mtime changed (or which
+        was removed) since the scan, None if no file changed
+        """
+        for dir_path, name, size, mtime_ns in self.iter_files():
+            path = os.path.join(dir_path, name)
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                return path
+
+            if (stat_result.st_size, stat_result.st_mtime_ns) != \
+                    (size, mtime_ns):
+                return path
+
+        return None
+
+    def to_numpy(self):
+        """
+        :return dict: column name -> NumPy array viewing the mmap-ed file
+        (no copy), e.g. numpy.flatnonzero(columns['sizes'] > 1 << 30)
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise FileCatalogException('to_numpy() needs numpy: pip install '
+                                       'numpy')
+
+        dtypes = {name: dtype
+                  for name, _, dtype in _FILE_COLUMNS + _DIR_COLUMNS}
+        return {
+            name: numpy.frombuffer(self._mmap, dtype=dtypes[name],
+                                   count=length, offset=offset)
+            for name, (offset, _, length) in self._layout.items()
+        }
+
+
+def open_catalog(fname, top, rescan=False, check_files=False,
+                 **scan_kwargs):
+    """
+    :param rescan: scan top again even if fname is a catalog of top
+    :param check_files: scan again also if a file changed since the scan
+    (needed when the sizes or the mtimes are used)
+    :param scan_kwargs: passed to scan_tree()
+    :return FileCatalog: of top, scanned if fname does not exist, is not a
+    catalog of top, a dir (or a file with check_files) changed since the
+    scan or rescan
+    """
+    if not rescan and os.path.isfile(fname):
+        try:
+            catalog = FileCatalog(fname)
+        except FileCatalogException as ex:
+            LOG.info('Scanning again: %s', ex)
+        else:
+            if catalog.top != os.path.abspath(top):
+                LOG.info('Scanning again, %s is a catalog of %s', fname,
+                         catalog.top)
+            else:
+                changed = catalog.find_changed_dir()
+                if changed is None and check_files:
+                    changed = catalog.find_changed_file()
+
+                if changed is None:
+                    LOG.info('Using the catalog %s (%s files)', fname,
+                             len(catalog))
+                    return catalog
+
+                LOG.info('Scanning again, changed since the scan: %s',
+                         changed)
+
+            catalog.close()
+
+    scan_tree(top, fname, **scan_kwargs)
+    return FileCatalog(fname)
@@ -0,0 +1,186 @@
+"""
+File copying
+
+Without verification the data is copied inside the kernel
+(os.copy_file_range, then os.sendfile, then a plain read/write loop for
+file systems that support neither). With verification the data is hashed
+while it is copied, so the source is read only once, and the destination
+is read back and hashed after it.
+"""
+import os
+import errno
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from sandbox.common.hashing import BLOCK_SIZE, HashStats, get_file_hash
+
+ZERO_COPY_CHUNK = 1 << 30
+# errors meaning the zero-copy call is not supported for these files
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                       errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF}
+
+
+class CopyVerificationException(Exception):
+    pass
+
+
+def _check_copied(count, copied, size):
+    """
+    :param count: returned by the last zero-copy call
+    """
+    if count:
+        return
+
+    if not copied:
+        # e.g. file systems, on which copy_file_range() copies nothing
+        raise OSError(errno.EOPNOTSUPP, 'Nothing copied')
+
+    raise OSError(errno.EIO, 'Copied %s of %s bytes, the source file ended '
+                             'early' % (copied, size))
+
+
+def _copy_file_range(fd_in, fd_out, size):
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(fd_in, fd_out,
+                                   min(size - copied, ZERO_COPY_CHUNK))
+        _check_copied(count, copied, size)
+        copied += count
+
+    return copied
+
+
+def _sendfile(fd_in, fd_out, size):
+    copied = 0
+    while copied < size:
+        count = os.sendfile(fd_out, fd_in, copied,
+                            min(size - copied, ZERO_COPY_CHUNK))
+        _check_copied(count, copied, size)
+        copied += count
+
+    return copied
+
+
+def _copy_zero_copy(fin, fout):
+    """
+    :return int: count of the copied bytes
+    """
+    fd_in = fin.fileno()
+    fd_out = fout.fileno()
+    size = os.fstat(fd_in).st_size
+    for copy_func_name, copy_func in (('copy_file_range', _copy_file_range),
+                                      ('sendfile', _sendfile)):
+        if not hasattr(os, copy_func_name):
+            continue
+
+        try:
+            return copy_func(fd_in, fd_out, size)
+        except OSError as ex:
+            if ex.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+
+            # nothing was written if the first call is not supported
+            os.lseek(fd_in, 0, os.SEEK_SET)
+            os.lseek(fd_out, 0, os.SEEK_SET)
+            os.ftruncate(fd_out, 0)
+
+    shutil.copyfileobj(fin, fout, BLOCK_SIZE)
+    return fout.tell()
+
+
+def _copy_and_hash(fin, fout, algorithm):
+    """
+    :return tuple: (count of the copied bytes, hex digest of the data)
+    """
+    hash_algo = hashlib.new(algorithm)
+    buffer = bytearray(BLOCK_SIZE)
+    view = memoryview(buffer)
+    copied = 0
+    while True:
+        size = fin.readinto(buffer)
+        if not size:
+            break
+
+        hash_algo.update(view[:size])
+        fout.write(view[:size])
+        copied += size
+
+    return copied, hash_algo.hexdigest()
+
+
+def copy_file(src_fname, dest_fname, algorithm=None, expected_digest=None):
+    """
+    Copy the data and the metadata (like shutil.copy2).
+
+    :param algorithm: if provided, the copy is verified: the copied data is
+    hashed while it is copied and the destination is hashed after it, both
+    have to be equal (and equal to expected_digest, if provided)
+    :param expected_digest: digest of the source file (e.g. calculated
+    when the files were compared)
+    :return tuple: (count of the copied bytes, digest or None if not
+    verified)
+    """
+    with open(src_fname, 'rb', buffering=0) as fin, \
+            open(dest_fname, 'wb', buffering=0) as fout:
+        if algorithm:
+            copied, digest = _copy_and_hash(fin, fout, algorithm)
+        else:
+            copied, digest = _copy_zero_copy(fin, fout), None
+
+    shutil.copystat(src_fname, dest_fname)
+    if not algorithm:
+        return copied, None
+
+    if expected_digest is not None and digest != expected_digest:
+        # changed since the digest was calculated
+        raise CopyVerificationException(
+            'Copy of "%s" to "%s" is not verified, source digest %s != %s' %
+            (src_fname, dest_fname, digest, expected_digest))
+
+    dest_digest = get_file_hash(dest_fname, algorithm)
+    if dest_digest != digest:
+        raise CopyVerificationException(
+            'Copy of "%s" to "%s" is not verified, destination digest '
+            '%s != %s' % (src_fname, dest_fname, dest_digest, digest))
+
+    return copied, digest
+
+
+def copy_files(fname_pairs, jobs=None, algorithm=None, expected_digests=None,
+               stats=None):
+    """
+    :param fname_pairs: iterable of (source file name, destination file name)
+    :param jobs: if > 1, that many files are copied concurrently
+    :param algorithm: see copy_file()
+    :param expected_digests: dict source file name -> digest
+    :param stats: HashStats updated with every copied file
+    :return generator: (source file name, destination file name, digest)
+    in completion order
+    """
+    expected_digests = expected_digests or {}
+    if stats is None:
+        stats = HashStats(action='copied')
+
+    def copy_task(src_fname, dest_fname):
+        copied, digest = copy_file(src_fname, dest_fname, algorithm,
+                                   expected_digests.get(src_fname))
+        return src_fname, dest_fname, copied, digest
+
+    with ThreadPoolExecutor(max_workers=max(jobs or 1, 1)) as executor:
+        pending = set()
+        fname_pairs = iter(fname_pairs)
+        while True:
+            for src_fname, dest_fname in fname_pairs:
+                pending.add(executor.submit(copy_task, src_fname, dest_fname))
+                if len(pending) >= max(jobs or 1, 1) * 2:
+                    break
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                src_fname, dest_fname, copied, digest = future.result()
+                stats.add(copied)
+                yield src_fname, dest_fname, digest
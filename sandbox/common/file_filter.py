@@ -0,0 +1,183 @@
+"""
+File filter compiled once and evaluated for every file of a scan
+
+The extensions are kept in sets (a lookup per file instead of a loop over
+the extensions), all glob patterns are combined in a single regex. The
+regexes are compiled one by one, joined they would lose their global
+inline flags and numbered backreferences. The filter is evaluated against
+os.DirEntry objects: the name and the type come from the directory
+listing, the file is stat-ed only for size/mtime bounds (and DirEntry
+caches that stat for later use).
+"""
+import os
+import re
+import stat
+import fnmatch
+import operator
+
+
+def _normalize_extension(extension, ignore_case):
+    extension = extension.lstrip('.')
+    return extension.lower() if ignore_case else extension
+
+
+def _compile_patterns(globs, regexes, flags):
+    """
+    :return list: re.Pattern objects, a name matches if any of them is
+    found in it: one for all the globs (whole name) and one per regex
+    """
+    patterns = []
+    if globs:
+        patterns.append(re.compile('|'.join(
+            '(?:^%s)' % fnmatch.translate(glob) for glob in globs), flags))
+
+    patterns.extend(re.compile(regex, flags) for regex in regexes or ())
+    return patterns
+
+
+def _search_any(patterns, name):
+    return any(pattern.search(name) for pattern in patterns)
+
+
+class FileFilter:
+
+    def __init__(self, extensions=None, exclude_extensions=None, globs=None,
+                 exclude_globs=None, regexes=None, exclude_regexes=None,
+                 min_size=None, max_size=None, min_mtime=None,
+                 max_mtime=None, ignore_case=False, files_only=False,
+                 follow_symlinks=True):
+        """
+        A file passes if it has one of the extensions (if provided), matches
+        any of globs/regexes (if provided), is within the size/mtime bounds
+        and does not have any of exclude_extensions or match any of
+        exclude_globs/exclude_regexes.
+
+        :param extensions: with or without the dot, e.g. "mkv" or ".tar.gz"
+        :param globs: fnmatch patterns, matched against the whole file name
+        :param regexes: searched in the file name
+        :param min_size: in bytes, inclusive (the same for max_size)
+        :param min_mtime: timestamp in seconds, inclusive (the same for
+        max_mtime)
+        :param ignore_case: for the extensions and the patterns
+        :param files_only: skip directories (and anything else that is not a
+        regular file)
+        :param follow_symlinks: used for the type and the stat of the files
+        """
+        self.ignore_case = ignore_case
+        self.files_only = files_only
+        self.follow_symlinks = follow_symlinks
+        self._extensions = None
+        if extensions is not None:
+            self._extensions = {_normalize_extension(ext, ignore_case)
+                                for ext in extensions}
+        self._exclude_extensions = {
+            _normalize_extension(ext, ignore_case)
+            for ext in exclude_extensions or ()
+        }
+        # number of dot separated parts of the longest extension
+        self._extension_parts = max(
+            (ext.count('.') + 1 for ext in
+             (self._extensions or set()) | self._exclude_extensions),
+            default=0)
+        flags = re.IGNORECASE if ignore_case else 0
+        self._patterns = _compile_patterns(globs, regexes, flags)
+        self._exclude_patterns = _compile_patterns(exclude_globs,
+                                                   exclude_regexes, flags)
+        self._bounds = [
+            (attr, bound, compare)
+            for attr, bound, compare in (
+                ('st_size', min_size, operator.ge),
+                ('st_size', max_size, operator.le),
+                ('st_mtime', min_mtime, operator.ge),
+                ('st_mtime', max_mtime, operator.le),
+            )
+            if bound is not None
+        ]
+
+    def _iter_extensions(self, name):
+        """
+        :return generator: "gz", "tar.gz"... up to the longest extension
+        of the filter
+        """
+        end = len(name)
+        for _ in range(self._extension_parts):
+            end = name.rfind('.', 0, end)
+            if end == -1:
+                return
+
+            yield name[end + 1:]
+
+    def _has_extension(self, name, extensions):
+        return any(ext in extensions for ext in self._iter_extensions(name))
+
+    def match_name(self, name):
+        """
+        :return bool: True if the name passes the name-based criteria
+        (extensions and patterns)
+        """
+        key = name.lower() if self.ignore_case else name
+        if self._exclude_extensions and \
+                self._has_extension(key, self._exclude_extensions):
+            return False
+
+        if self._extensions is not None and \
+                not self._has_extension(key, self._extensions):
+            return False
+
+        if _search_any(self._exclude_patterns, name):
+            return False
+
+        if self._patterns and not _search_any(self._patterns, name):
+            return False
+
+        return True
+
+    def _match_stat(self, stat_result):
+        return all(compare(getattr(stat_result, attr), bound)
+                   for attr, bound, compare in self._bounds)
+
+    def __call__(self, entry):
+        """
+        :param entry: os.DirEntry
+        """
+        if not self.match_name(entry.name):
+            return False
+
+        if self.files_only and \
+                not entry.is_file(follow_symlinks=self.follow_symlinks):
+            return False
+
+        if self._bounds and not self._match_stat(
+                entry.stat(follow_symlinks=self.follow_symlinks)):
+            return False
+
+        return True
+
+    def match_path(self, path):
+        """
+        Like calling the filter with a DirEntry, for a path (e.g. from the
+        command line).
+        """
+        if not self.match_name(os.path.basename(path)):
+            return False
+
+        if not self.files_only and not self._bounds:
+            return True
+
+        try:
+            stat_result = os.stat(path) if self.follow_symlinks else \
+                os.lstat(path)
+        except OSError:
+            return False
+
+        if self.files_only and not stat.S_ISREG(stat_result.st_mode):
+            return False
+
+        return self._match_stat(stat_result)
+
+
+# the movie files listed by movie_names_to_file.py (and diff_listings.py),
+# without sample.mkv, Sample.avi...
+MOVIE_EXTENSIONS = ('mkv', 'avi', 'mp4')
+MOVIE_FILTER = FileFilter(extensions=MOVIE_EXTENSIONS,
+                          exclude_regexes=[r'^(?i:sample)\.[^.]*$'])
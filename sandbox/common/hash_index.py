@@ -0,0 +1,122 @@
+"""
+Persistent index of file digests (SQLite)
+
+A digest is reused as long as the size, the modification time (in ns) and
+the inode of the file are the same as when it was calculated, so repeated
+runs only hash the new or modified files.
+"""
+import os
+import sqlite3
+
+DEFAULT_INDEX_NAME = '.hash_index.sqlite'
+
+
+class HashIndex:
+
+    def __init__(self, root_dir, index_fname=None, commit_every=1000):
+        """
+        :param root_dir: the paths are stored relative to it, so the index
+        stays valid if the whole directory is moved
+        :param index_fname: SQLite file, by default DEFAULT_INDEX_NAME in
+        root_dir
+        :param commit_every: commit after that many new digests, so the
+        work is not lost if the run is interrupted
+        """
+        self.root_dir = os.path.abspath(root_dir)
+        self.index_fname = index_fname or os.path.join(self.root_dir,
+                                                       DEFAULT_INDEX_NAME)
+        self.commit_every = commit_every
+        self.count_hits = 0
+        self.count_misses = 0
+        self._count_uncommitted = 0
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = sqlite3.connect(self.index_fname)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS file_digests ('
+            'path TEXT NOT NULL, '
+            'algorithm TEXT NOT NULL, '
+            'size INTEGER NOT NULL, '
+            'mtime_ns INTEGER NOT NULL, '
+            'inode INTEGER NOT NULL, '
+            'digest TEXT NOT NULL, '
+            'PRIMARY KEY (path, algorithm))')
+        return self
+
+    def __exit__(self, *exc_info):
+        self._conn.commit()
+        self._conn.close()
+        self._conn = None
+
+    def is_index_file(self, fname):
+        """
+        :return bool: True for the index file and the SQLite temporary
+        files next to it
+        """
+        return os.path.abspath(fname).startswith(self.index_fname)
+
+    def _rel_path(self, abs_fname):
+        return os.path.relpath(abs_fname, self.root_dir)
+
+    def _lookup(self, abs_fname, stat_result, algorithm):
+        row = self._conn.execute(
+            'SELECT size, mtime_ns, inode, digest FROM file_digests '
+            'WHERE path = ? AND algorithm = ?',
+            (self._rel_path(abs_fname), algorithm)).fetchone()
+        if row and row[:3] == (stat_result.st_size, stat_result.st_mtime_ns,
+                               stat_result.st_ino):
+            return row[3]
+
+        return None
+
+    def get(self, abs_fname, stat_result, algorithm='sha1'):
+        """
+        :param stat_result: os.stat_result of the file
+        :return str: the digest or None if not indexed or the file changed
+        """
+        digest = self._lookup(abs_fname, stat_result, algorithm)
+        if digest:
+            self.count_hits += 1
+        else:
+            self.count_misses += 1
+
+        return digest
+
+    def contains(self, abs_fname, stat_result, algorithm='sha1'):
+        """
+        :return bool: True if get() would return the digest (does not
+        change the hit/miss counters)
+        """
+        return self._lookup(abs_fname, stat_result, algorithm) is not None
+
+    def set(self, abs_fname, stat_result, digest, algorithm='sha1'):
+        self._conn.execute(
+            'INSERT OR REPLACE INTO file_digests '
+            '(path, algorithm, size, mtime_ns, inode, digest) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (self._rel_path(abs_fname), algorithm, stat_result.st_size,
+             stat_result.st_mtime_ns, stat_result.st_ino, digest))
+        self._count_uncommitted += 1
+        if self._count_uncommitted >= self.commit_every:
+            self._conn.commit()
+            self._count_uncommitted = 0
+
+    def remove_missing(self, abs_fnames):
+        """
+        Remove the digests of the files that are not in abs_fnames (e.g.
+        deleted since the previous run).
+
+        :return int: count of the removed rows
+        """
+        self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen_paths '
+                           '(path TEXT PRIMARY KEY)')
+        self._conn.execute('DELETE FROM seen_paths')
+        self._conn.executemany(
+            'INSERT OR IGNORE INTO seen_paths (path) VALUES (?)',
+            ((self._rel_path(abs_fname),) for abs_fname in abs_fnames))
+        cursor = self._conn.execute(
+            'DELETE FROM file_digests '
+            'WHERE path NOT IN (SELECT path FROM seen_paths)')
+        self._conn.commit()
+        return cursor.rowcount
@@ -0,0 +1,171 @@
+"""
+File hashing
+
+hashlib releases the GIL while hashing big buffers, so hashing files with
+a thread pool keeps several disks/cores busy. A process pool can be used
+for many small files, where the Python overhead per file dominates.
+"""
+import os
+import time
+import hashlib
+from concurrent.futures import (
+    ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED)
+
+from sandbox.common.formatting import format_seconds
+
+ALGORITHMS = ('blake2b', 'sha256', 'sha1')
+BLOCK_SIZE = 1 << 20  # read in 1MB blocks
+SAMPLE_SIZE = 1 << 16
+
+
+def hash_file(abs_fname, algorithm='sha1', block_size=BLOCK_SIZE):
+    """
+    :return tuple: (hex digest, count of the read bytes)
+    """
+    hash_algo = hashlib.new(algorithm)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    count_bytes = 0
+    with open(abs_fname, 'rb', buffering=0) as fin:
+        while True:
+            size = fin.readinto(buffer)
+            if not size:
+                break
+
+            hash_algo.update(view[:size])
+            count_bytes += size
+
+    return hash_algo.hexdigest(), count_bytes
+
+
+def get_file_hash(abs_fname, algorithm='sha1', block_size=BLOCK_SIZE):
+    return hash_file(abs_fname, algorithm, block_size)[0]
+
+
+def get_sample_offsets(size, count_samples=2, sample_size=SAMPLE_SIZE):
+    """
+    :return list: offsets of count_samples chunks spread evenly from the
+    start to the end of the file (for 2 samples: head and tail), a single
+    offset 0 if the samples would cover the whole file
+    """
+    if count_samples < 2 or size <= count_samples * sample_size:
+        return [0]
+
+    step = (size - sample_size) / (count_samples - 1)
+    return [int(step * i) for i in range(count_samples)]
+
+
+def hash_file_samples(abs_fname, algorithm='sha1', count_samples=2,
+                      sample_size=SAMPLE_SIZE):
+    """
+    Hash of the size and of a few fixed-offset chunks of the file. Files
+    with different sample hashes are different, files with the same sample
+    hash need a full hash to be compared. Files with size up to
+    count_samples * sample_size are hashed completely.
+
+    :return tuple: (hex digest, count of the read bytes)
+    """
+    hash_algo = hashlib.new(algorithm)
+    count_bytes = 0
+    with open(abs_fname, 'rb', buffering=0) as fin:
+        size = os.fstat(fin.fileno()).st_size
+        hash_algo.update(str(size).encode())
+        offsets = get_sample_offsets(size, count_samples, sample_size)
+        read_size = (size if size <= count_samples * sample_size
+                     else sample_size)
+        for offset in offsets:
+            data = os.pread(fin.fileno(), read_size, offset)
+            hash_algo.update(data)
+            count_bytes += len(data)
+
+    return hash_algo.hexdigest(), count_bytes
+
+
+class HashStats:
+
+    def __init__(self, action='hashed'):
+        """
+        :param action: shown in the summary, e.g. "copied"
+        """
+        self.action = action
+        self.count_files = 0
+        self.count_bytes = 0
+        self.start_time = time.time()
+
+    def add(self, count_bytes):
+        self.count_files += 1
+        self.count_bytes += count_bytes
+
+    def __str__(self):
+        seconds = max(time.time() - self.start_time, 1e-6)
+        return ('%s %s files, %s MB for %s (%s MB/sec., %s files/sec.)' %
+                (self.action, self.count_files,
+                 round(self.count_bytes / 1000000, 2),
+                 format_seconds(seconds),
+                 round(self.count_bytes / 1000000 / seconds, 2),
+                 round(self.count_files / seconds, 2)))
+
+
+def _hash_file_task(abs_fname, algorithm, count_samples=None,
+                    skip_missing=False):
+    try:
+        if count_samples:
+            return (abs_fname,) + hash_file_samples(abs_fname, algorithm,
+                                                    count_samples)
+
+        return (abs_fname,) + hash_file(abs_fname, algorithm)
+    except FileNotFoundError:
+        if not skip_missing:
+            raise
+
+        return abs_fname, None, 0
+
+
+def hash_files(abs_fnames, algorithm='sha1', jobs=None, use_processes=False,
+               stats=None, count_samples=None, skip_missing=False):
+    """
+    :param jobs: if > 1, the files are hashed by that many threads (or
+    processes), the results are then yielded in completion order
+    :param use_processes: use processes instead of threads
+    :param stats: HashStats updated with every hashed file
+    :param count_samples: if provided, only that many chunks of every file
+    are hashed (see hash_file_samples())
+    :param skip_missing: yield None as digest for the files, which do not
+    exist (e.g. deleted since they were listed), instead of raising
+    :return generator: (abs file name, hex digest)
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unsupported hash algorithm "%s"' % algorithm)
+
+    if not jobs or jobs < 2:
+        for abs_fname in abs_fnames:
+            _, digest, count_bytes = _hash_file_task(
+                abs_fname, algorithm, count_samples, skip_missing)
+            if stats is not None:
+                stats.add(count_bytes)
+            yield abs_fname, digest
+        return
+
+    executor_class = ProcessPoolExecutor if use_processes else \
+        ThreadPoolExecutor
+    with executor_class(max_workers=jobs) as executor:
+        pending = set()
+        abs_fnames = iter(abs_fnames)
+        while True:
+            # bounded, so millions of files do not create millions of futures
+            for abs_fname in abs_fnames:
+                pending.add(executor.submit(_hash_file_task, abs_fname,
+                                            algorithm, count_samples,
+                                            skip_missing))
+                if len(pending) >= jobs * 4:
+                    break
+
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                abs_fname, digest, count_bytes = future.result()
+                if stats is not None:
+                    stats.add(count_bytes)
+                yield abs_fname, digest
@@ -0,0 +1,402 @@
+"""
+Merkle tree digests of directory trees
+
+The digest of a directory combines the names and the digests of its files
+and of its sub-directories, so two trees (or two snapshots of the same
+tree) with the same root digest are identical, and comparing them only
+descends into the sub-directories with different digests.
+
+A snapshot keeps (size, mtime_ns, digest) for every file. When a snapshot
+is built with the previous one, only the new or modified files are hashed.
+
+Trees with different layouts (e.g. a camera dir and its backup) are
+compared by the file contents with diff_contents() instead. Given the
+result of the last comparison of the same trees, it compares again only
+the dirs changed since then (found by the dir digests).
+"""
+import os
+import json
+import hashlib
+from collections import deque
+
+from sandbox.common.dir_walker import iter_dirs
+from sandbox.common.hashing import hash_files
+
+SNAPSHOT_VERSION = 1
+ROOT = '.'
+
+
+class MerkleException(Exception):
+    pass
+
+
+class DirNode:
+    __slots__ = ('digest', 'dirs', 'files')
+
+    def __init__(self, digest=None, dirs=None, files=None):
+        self.digest = digest
+        # names of the sub-directories
+        self.dirs = dirs if dirs is not None else []
+        # file name -> [size, mtime_ns, digest]
+        self.files = files if files is not None else {}
+
+
+def _join(rel_dir, name):
+    return name if rel_dir == ROOT else '%s/%s' % (rel_dir, name)
+
+
+def _encode_child(child_type, name, digest):
+    return ('%s\0%s\0%s\0' % (child_type, name, digest)).encode(
+        'utf-8', 'surrogateescape')
+
+
+def _depth(rel_dir):
+    return 0 if rel_dir == ROOT else rel_dir.count('/') + 1
+
+
+class MerkleSnapshot:
+
+    def __init__(self, algorithm='sha1', nodes=None):
+        """
+        :param nodes: dict relative dir name ("." for the root) -> DirNode
+        """
+        self.algorithm = algorithm
+        self.nodes = nodes if nodes is not None else {}
+
+    @property
+    def root_digest(self):
+        root = self.nodes.get(ROOT)
+        return root.digest if root else None
+
+    def content_keys(self):
+        """
+        :return set: (size, digest) of every file
+        """
+        return {key for node in self.nodes.values()
+                for key in _content_keys(node)}
+
+    def get_file(self, rel_dir, name):
+        node = self.nodes.get(rel_dir)
+        return node.files.get(name) if node else None
+
+    @staticmethod
+    def build(top, algorithm='sha1', previous=None, exclude=None, jobs=None,
+              hash_index=None):
+        """
+        :param previous: MerkleSnapshot of the same tree, the digests of the
+        files with the same size and mtime_ns are taken from it
+        :param exclude: callable(DirEntry) -> bool, files and directories for
+        which it returns True are not part of the snapshot
+        :param jobs: number of threads hashing the files
+        :param hash_index: HashIndex of the tree, the valid digests of the
+        files not in previous are taken from it and the calculated ones are
+        added to it
+        """
+        if previous is not None and previous.algorithm != algorithm:
+            previous = None
+
+        snapshot = MerkleSnapshot(algorithm)
+        # abs file name -> (files of a DirNode, file name, os.stat_result),
+        # for the files without digest
+        to_hash = {}
+        for dir_path, dir_entries, file_entries in iter_dirs(
+                top, include_dir=lambda e: not (exclude and exclude(e))):
+            rel_dir = os.path.relpath(dir_path, top).replace(os.sep, '/')
+            node = DirNode()
+            node.dirs = sorted(
+                entry.name for entry in dir_entries
+                if not (exclude and exclude(entry))
+            )
+            for entry in file_entries:
+                if exclude and exclude(entry):
+                    continue
+
+                try:
+                    stat_result = entry.stat()
+                except FileNotFoundError:
+                    # deleted since the dir was listed
+                    continue
+
+                prev_file = previous and previous.get_file(rel_dir,
+                                                           entry.name)
+                if prev_file and prev_file[:2] == [stat_result.st_size,
+                                                   stat_result.st_mtime_ns]:
+                    node.files[entry.name] = list(prev_file)
+                    continue
+
+                digest = hash_index and hash_index.get(
+                    entry.path, stat_result, algorithm)
+                node.files[entry.name] = [stat_result.st_size,
+                                          stat_result.st_mtime_ns,
+                                          digest or None]
+                if not digest:
+                    to_hash[entry.path] = (node.files, entry.name,
+                                           stat_result)
+
+            snapshot.nodes[rel_dir] = node
+
+        for abs_fname, digest in hash_files(list(to_hash), algorithm, jobs,
+                                            skip_missing=True):
+            files, name, stat_result = to_hash[abs_fname]
+            if digest is None:
+                del files[name]
+                continue
+
+            files[name][2] = digest
+            if hash_index:
+                hash_index.set(abs_fname, stat_result, digest, algorithm)
+
+        snapshot._update_dir_digests()
+        return snapshot
+
+    def _update_dir_digests(self):
+        # children first
+        for rel_dir in sorted(self.nodes, key=_depth, reverse=True):
+            node = self.nodes[rel_dir]
+            hash_algo = hashlib.new(self.algorithm)
+            for name in sorted(node.files):
+                hash_algo.update(_encode_child('f', name,
+                                               node.files[name][2]))
+            for name in node.dirs:
+                child = self.nodes.get(_join(rel_dir, name))
+                hash_algo.update(_encode_child('d', name,
+                                               child.digest if child else ''))
+            node.digest = hash_algo.hexdigest()
+
+    def save(self, fname):
+        data = {
+            'version': SNAPSHOT_VERSION,
+            'algorithm': self.algorithm,
+            'dirs': {
+                rel_dir: {
+                    'digest': node.digest,
+                    'dirs': node.dirs,
+                    'files': node.files
+                }
+                for rel_dir, node in self.nodes.items()
+            }
+        }
+        with open(fname, 'w', encoding='utf-8',
+                  errors='surrogateescape') as fout:
+            json.dump(data, fout, ensure_ascii=False)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, encoding='utf-8', errors='surrogateescape') as fin:
+            data = json.load(fin)
+
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise MerkleException('Unsupported snapshot version in %s' %
+                                  fname)
+
+        nodes = {
+            rel_dir: DirNode(item['digest'], item['dirs'], item['files'])
+            for rel_dir, item in data['dirs'].items()
+        }
+        return MerkleSnapshot(data['algorithm'], nodes)
+
+
+def _content_keys(node):
+    return [(file_data[0], file_data[2]) for file_data in node.files.values()]
+
+
+def _file_digests(node):
+    return {name: file_data[2] for name, file_data in node.files.items()}
+
+
+def _iter_different_dirs(first, second, into_missing=False):
+    """
+    :param into_missing: descend also into the sub-trees found only in one
+    of the snapshots
+    :return generator: (relative dir name, first DirNode, second DirNode)
+    of the dirs with different digests (None for the node of the snapshot
+    without the dir), the sub-trees with equal digests are skipped
+    """
+    queue = deque([ROOT])
+    while queue:
+        rel_dir = queue.popleft()
+        first_node = first.nodes.get(rel_dir)
+        second_node = second.nodes.get(rel_dir)
+        if first_node is not None and second_node is not None and \
+                first_node.digest == second_node.digest:
+            continue
+
+        yield rel_dir, first_node, second_node
+        if (first_node is None or second_node is None) and not into_missing:
+            continue
+
+        dir_names = set()
+        for node in (first_node, second_node):
+            if node is not None:
+                dir_names.update(node.dirs)
+
+        for name in sorted(dir_names):
+            queue.append(_join(rel_dir, name))
+
+
+def diff_snapshots(first, second, names=('first', 'second')):
+    """
+    Compare two snapshots, the sub-trees with equal digests are skipped.
+
+    :param names: names of the snapshots used in the descriptions
+    :return list: (relative dir name, description) for the directories
+    with different files and for the sub-trees found only in one of the
+    snapshots
+    """
+    if first.algorithm != second.algorithm:
+        raise MerkleException('Snapshots with different hash algorithms: '
+                              '%s, %s' % (first.algorithm, second.algorithm))
+
+    diffs = []
+    for rel_dir, first_node, second_node in _iter_different_dirs(first,
+                                                                 second):
+        if first_node is None or second_node is None:
+            diffs.append((rel_dir, 'only in %s' %
+                          names[1 if first_node is None else 0]))
+            continue
+
+        first_files = _file_digests(first_node)
+        second_files = _file_digests(second_node)
+        if first_files != second_files:
+            only_first = first_files.keys() - second_files.keys()
+            only_second = second_files.keys() - first_files.keys()
+            changed = [
+                name for name in first_files.keys() & second_files.keys()
+                if first_files[name] != second_files[name]
+            ]
+            diffs.append((rel_dir, 'files only in %s: %s, only in %s: %s, '
+                          'different: %s' %
+                          (names[0], len(only_first), names[1],
+                           len(only_second), len(changed))))
+
+    return diffs
+
+
+def changed_dirs(previous, current):
+    """
+    :param previous: older MerkleSnapshot of the same tree
+    :return set: relative names of the dirs with different files in the
+    snapshots, also of the dirs found only in one of them; only the
+    sub-trees with different digests are visited
+    """
+    if previous.algorithm != current.algorithm:
+        raise MerkleException('Snapshots with different hash algorithms: '
+                              '%s, %s' % (previous.algorithm,
+                                          current.algorithm))
+
+    return {
+        rel_dir for rel_dir, prev_node, node in
+        _iter_different_dirs(previous, current, into_missing=True)
+        if prev_node is None or node is None or
+        _file_digests(prev_node) != _file_digests(node)
+    }
+
+
+def _find_missing(snapshot, rel_dirs, other_keys):
+    missing = {}
+    for rel_dir in rel_dirs:
+        node = snapshot.nodes.get(rel_dir)
+        if node is None:
+            continue
+
+        names = sorted(
+            name for name, file_data in node.files.items()
+            if (file_data[0], file_data[2]) not in other_keys
+        )
+        if names:
+            missing[rel_dir] = names
+
+    return missing
+
+
+def find_missing_contents(snapshot, other, previous=None):
+    """
+    Find the files of snapshot, which content (size and digest) is not
+    anywhere in other, regardless of the file names and the layout of the
+    dirs.
+
+    :param previous: (snapshot, other, result) of the last comparison of
+    the same trees, then only the dirs of snapshot changed since it and the
+    dirs with files affected by the changes of other are compared again
+    :return dict: relative dir name -> sorted names of the missing files
+    """
+    if previous is None:
+        return _find_missing(snapshot, snapshot.nodes, other.content_keys())
+
+    prev_snapshot, prev_other, prev_missing = previous
+    snapshot_dirs = changed_dirs(prev_snapshot, snapshot)
+    other_dirs = changed_dirs(prev_other, other)
+    if not snapshot_dirs and not other_dirs:
+        return prev_missing
+
+    other_keys = other.content_keys()
+    missing = {rel_dir: names for rel_dir, names in prev_missing.items()
+               if rel_dir not in snapshot_dirs}
+    recheck_dirs = set(snapshot_dirs)
+    if other_dirs:
+        # the missing contents could be added to other
+        recheck_dirs.update(missing)
+        # and the contents removed from other could be missing now
+        removed_keys = {
+            key for rel_dir in other_dirs if rel_dir in prev_other.nodes
+            for key in _content_keys(prev_other.nodes[rel_dir])
+        }
+        removed_keys -= other_keys
+        if removed_keys:
+            recheck_dirs.update(
+                rel_dir for rel_dir, node in snapshot.nodes.items()
+                if not removed_keys.isdisjoint(_content_keys(node))
+            )
+
+    for rel_dir in recheck_dirs:
+        missing.pop(rel_dir, None)
+
+    missing.update(_find_missing(snapshot, recheck_dirs, other_keys))
+    return missing
+
+
+def diff_contents(first, second, names=('first', 'second'), previous=None):
+    """
+    Compare the file contents of two snapshots regardless of the file names
+    and the layout of the dirs (see find_missing_contents()).
+
+    :param names: names of the snapshots used in the descriptions
+    :param previous: (first, second, missing) of the last comparison of the
+    same trees, with the missing returned by it
+    :return tuple: (diffs, missing), diffs is a list of (name of the
+    snapshot, relative dir name, description) for the directories with
+    files, which content is not anywhere in the other snapshot; missing is
+    (missing files of first, missing files of second) for the next
+    comparison
+    """
+    if first.algorithm != second.algorithm:
+        raise MerkleException('Snapshots with different hash algorithms: '
+                              '%s, %s' % (first.algorithm, second.algorithm))
+
+    if previous is not None and (
+            previous[0].algorithm != first.algorithm or
+            previous[1].algorithm != second.algorithm):
+        previous = None
+
+    if first.root_digest == second.root_digest:
+        missing = ({}, {})
+    elif previous is None:
+        missing = (find_missing_contents(first, second),
+                   find_missing_contents(second, first))
+    else:
+        prev_first, prev_second, prev_missing = previous
+        missing = (
+            find_missing_contents(first, second,
+                                  (prev_first, prev_second, prev_missing[0])),
+            find_missing_contents(second, first,
+                                  (prev_second, prev_first, prev_missing[1]))
+        )
+
+    diffs = []
+    for snapshot_missing, name, other_name in zip(missing, names,
+                                                  names[::-1]):
+        for rel_dir in sorted(snapshot_missing):
+            diffs.append((name, rel_dir, 'files not in %s: %s' %
+                          (other_name, len(snapshot_missing[rel_dir]))))
+
+    return diffs, missing
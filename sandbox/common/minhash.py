@@ -0,0 +1,179 @@
+"""
+Similar text grouping with MinHash and locality-sensitive hashing (LSH)
+
+Every text is turned into a set of shingles (character n-grams) and the
+set into a MinHash signature: the minimum of num_perm hash functions over
+the shingles. The probability that two signatures agree in a position is
+(about) the Jaccard similarity of the two sets. The hash functions are a
+64-bit hash of the shingle XOR-ed with a random mask, which is several
+times faster in Python than (a * x + b) mod prime.
+
+The signatures are cut into bands, texts with an identical band land in
+the same bucket and only texts sharing a bucket are compared, so grouping
+is near-linear in the number of texts instead of comparing every pair.
+With b bands of r rows a pair with similarity s becomes a candidate with
+probability 1 - (1 - s^r)^b, the threshold is around (1 / b)^(1 / r).
+"""
+import random
+import hashlib
+from collections import defaultdict
+
+EMPTY_HASH = 1 << 64
+
+
+def shingles(text, size=3):
+    """
+    :return set: character n-grams of the text (the text itself if shorter)
+    """
+    if len(text) <= size:
+        return {text} if text else set()
+
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def jaccard_similarity(first, second):
+    if not first and not second:
+        return 1.0
+
+    return len(first & second) / len(first | second)
+
+
+def _stable_hash(shingle):
+    # not hash(), which is randomized per process for strings
+    return int.from_bytes(hashlib.blake2b(
+        shingle.encode('utf-8', 'surrogateescape'), digest_size=8).digest(),
+        'big')
+
+
+class MinHasher:
+
+    def __init__(self, num_perm=48, seed=1):
+        rand = random.Random(seed)
+        self.num_perm = num_perm
+        self._masks = [rand.getrandbits(64) for _ in range(num_perm)]
+        # the shingles repeat a lot between texts
+        self._shingle_hashes = {}
+
+    def signature(self, shingle_set):
+        """
+        :return tuple: num_perm integers
+        """
+        if not shingle_set:
+            return (EMPTY_HASH,) * self.num_perm
+
+        hashes = []
+        for shingle in shingle_set:
+            shingle_hash = self._shingle_hashes.get(shingle)
+            if shingle_hash is None:
+                shingle_hash = self._shingle_hashes[shingle] = \
+                    _stable_hash(shingle)
+            hashes.append(shingle_hash)
+
+        return tuple(min(map(mask.__xor__, hashes)) for mask in self._masks)
+
+
+def estimate_similarity(first_signature, second_signature):
+    equal = sum(1 for x, y in zip(first_signature, second_signature)
+                if x == y)
+    return equal / len(first_signature)
+
+
+class LSHIndex:
+
+    def __init__(self, bands=16, rows=3):
+        """
+        Signatures must have bands * rows values.
+        """
+        self.bands = bands
+        self.rows = rows
+        # (band number, band values) -> keys
+        self._buckets = defaultdict(list)
+
+    def add(self, key, signature):
+        if len(signature) != self.bands * self.rows:
+            raise ValueError('Signature with %s values, expected %s' %
+                             (len(signature), self.bands * self.rows))
+
+        for band in range(self.bands):
+            start = band * self.rows
+            self._buckets[band, signature[start:start + self.rows]].append(
+                key)
+
+    def candidate_pairs(self):
+        """
+        :return set: (key, key) pairs sharing at least one bucket
+        """
+        pairs = set()
+        for keys in self._buckets.values():
+            if len(keys) < 2:
+                continue
+
+            for i, first in enumerate(keys):
+                for second in keys[i + 1:]:
+                    if first != second:
+                        pairs.add((first, second) if first < second
+                                  else (second, first))
+
+        return pairs
+
+
+def _find_root(parents, key):
+    root = key
+    while parents[root] != root:
+        root = parents[root]
+
+    # path compression
+    while parents[key] != root:
+        parents[key], key = root, parents[key]
+
+    return root
+
+
+def find_similar_groups(shingle_sets, threshold=0.5, num_perm=48, bands=16):
+    """
+    :param shingle_sets: dict key (e.g. normalized title) -> set of shingles
+    :param threshold: minimal Jaccard similarity of a pair in a group
+    :param num_perm: signature size, must be a multiple of bands
+    :return list: (sorted keys, pairs) for every group of 2 or more keys
+    connected by similar pairs, pairs is a list of (key, key, similarity)
+    sorted by similarity descending, the groups are sorted by their best
+    similarity descending
+    """
+    if num_perm % bands:
+        raise ValueError('num_perm %s is not a multiple of bands %s' %
+                         (num_perm, bands))
+
+    hasher = MinHasher(num_perm)
+    lsh_index = LSHIndex(bands, num_perm // bands)
+    for key, shingle_set in shingle_sets.items():
+        lsh_index.add(key, hasher.signature(shingle_set))
+
+    parents = {}
+    similar_pairs = []
+    for first, second in lsh_index.candidate_pairs():
+        # the candidates are few, so the exact similarity is affordable
+        similarity = jaccard_similarity(shingle_sets[first],
+                                        shingle_sets[second])
+        if similarity < threshold:
+            continue
+
+        similar_pairs.append((first, second, round(similarity, 3)))
+        parents.setdefault(first, first)
+        parents.setdefault(second, second)
+        first_root = _find_root(parents, first)
+        second_root = _find_root(parents, second)
+        if first_root != second_root:
+            parents[second_root] = first_root
+
+    groups = defaultdict(lambda: (set(), []))
+    for pair in similar_pairs:
+        keys, pairs = groups[_find_root(parents, pair[0])]
+        keys.update(pair[:2])
+        pairs.append(pair)
+
+    result = [
+        (sorted(keys), sorted(pairs, key=lambda x: (-x[2], x[0], x[1])))
+        for keys, pairs in groups.values()
+    ]
+    result.sort(key=lambda x: (-x[1][0][2], x[0]))
+    return result
@@ -0,0 +1,189 @@
+"""
+Compact in-memory store of many file paths
+
+The directories are nodes of a trie: every directory is kept once as
+(parent dir id, base name), so the long common prefixes are not repeated
+for every file. A file is (dir id, base name). The full paths are built
+only when they are requested.
+
+    store = PathStore()
+    store.extend(paths)
+    for path in store: ...
+
+The paths are split on os.sep and joined back exactly as they were added
+(relative or absolute, without normalization).
+"""
+import os
+import sys
+import array
+
+# the parent of the top-level dirs, also the dir of the files added
+# without a dir
+ROOT_ID = 0
+
+
+class PathStore:
+
+    def __init__(self):
+        self._dir_parents = array.array('I', [ROOT_ID])
+        self._dir_names = ['']
+        # (parent dir id, name) -> dir id
+        self._dir_ids = {}
+        self._file_dirs = array.array('I')
+        self._file_names = []
+        # the files are usually added dir by dir
+        self._last_dir = (None, ROOT_ID)
+
+    def __len__(self):
+        return len(self._file_names)
+
+    @property
+    def count_dirs(self):
+        return len(self._dir_names) - 1
+
+    def _add_dir_names(self, names):
+        dir_id = ROOT_ID
+        for name in names:
+            key = (dir_id, name)
+            child_id = self._dir_ids.get(key)
+            if child_id is None:
+                child_id = len(self._dir_names)
+                self._dir_ids[key] = child_id
+                self._dir_parents.append(dir_id)
+                # e.g. "2019" or "DCIM" repeat in many dirs
+                self._dir_names.append(sys.intern(name))
+            dir_id = child_id
+
+        return dir_id
+
+    def add_dir(self, dir_path):
+        """
+        :param dir_path: not empty, the trailing separators are ignored
+        :return int: dir id
+        """
+        if dir_path == self._last_dir[0]:
+            return self._last_dir[1]
+
+        dir_id = self._add_dir_names(dir_path.rstrip(os.sep).split(os.sep))
+        self._last_dir = (dir_path, dir_id)
+        return dir_id
+
+    def add_file(self, dir_id, name):
+        """
+        :return int: file id (index)
+        """
+        self._file_dirs.append(dir_id)
+        self._file_names.append(name)
+        return len(self._file_names) - 1
+
+    def add(self, path):
+        """
+        :return int: file id (index)
+        """
+        dir_path, sep, name = path.rpartition(os.sep)
+        if not sep:
+            return self.add_file(ROOT_ID, name)
+
+        if dir_path == self._last_dir[0]:
+            dir_id = self._last_dir[1]
+        else:
+            # "" for the files in the file system root
+            dir_id = self._add_dir_names(dir_path.split(os.sep))
+            self._last_dir = (dir_path, dir_id)
+
+        return self.add_file(dir_id, name)
+
+    def append(self, path):
+        self.add(path)
+
+    def extend(self, paths):
+        for path in paths:
+            self.add(path)
+
+    def dir_name(self, dir_id):
+        return self._dir_names[dir_id]
+
+    def dir_path(self, dir_id):
+        names = []
+        while dir_id != ROOT_ID:
+            names.append(self._dir_names[dir_id])
+            dir_id = self._dir_parents[dir_id]
+
+        names.reverse()
+        # [""] is the file system root
+        return os.sep.join(names) if names != [''] else os.sep
+
+    def join(self, dir_id, name):
+        if dir_id == ROOT_ID:
+            return name
+
+        dir_path = self.dir_path(dir_id)
+        return dir_path + name if dir_path == os.sep else \
+            dir_path + os.sep + name
+
+    def dir_id(self, file_id):
+        return self._file_dirs[file_id]
+
+    def name(self, file_id):
+        return self._file_names[file_id]
+
+    def __getitem__(self, file_id):
+        return self.join(self._file_dirs[file_id], self._file_names[file_id])
+
+    def __iter__(self):
+        """
+        :return generator: the full paths, in the order they were added
+        """
+        # the path of a dir is built once for all its consecutive files
+        prev_dir_id = None
+        dir_prefix = None
+        for dir_id, name in zip(self._file_dirs, self._file_names):
+            if dir_id != prev_dir_id:
+                prev_dir_id = dir_id
+                dir_prefix = '' if dir_id == ROOT_ID else \
+                    self.join(dir_id, '')
+            yield dir_prefix + name
+
+
+if __name__ == '__main__':
+    import tracemalloc
+
+    def generate_paths(count_files, depth=8, fan_out=4, files_per_dir=50):
+        # deep synthetic tree, like an archive of dated backups
+        root = '/media/archive/backups/photos_and_videos'
+        stack = [(root, 0)]
+        while stack:
+            dir_path, level = stack.pop()
+            if level == depth:
+                for i in range(files_per_dir):
+                    yield '%s/IMG_%06d.JPG' % (dir_path, i)
+                    count_files -= 1
+                    if not count_files:
+                        return
+                continue
+
+            for i in range(fan_out):
+                stack.append(('%s/level_%d_directory_%02d' %
+                              (dir_path, level, i), level + 1))
+
+    count_files = 300000
+    tracemalloc.start()
+    path_list = list(generate_paths(count_files))
+    list_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    avg_path_len = sum(len(path) for path in path_list) / count_files
+    del path_list
+
+    tracemalloc.start()
+    store = PathStore()
+    store.extend(generate_paths(count_files))
+    store_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert list(store) == list(generate_paths(count_files))
+    print('files: %s, dirs: %s, average path length: %s' %
+          (count_files, store.count_dirs, round(avg_path_len, 1)))
+    print('list of paths: %s bytes per file' %
+          round(list_bytes / count_files, 1))
+    print('PathStore: %s bytes per file' %
+          round(store_bytes / count_files, 1))
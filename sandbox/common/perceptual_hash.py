@@ -0,0 +1,170 @@
+"""
+Perceptual hashes of images and a BK-tree for near-duplicate search
+
+The hashes are 64-bit integers (for hash_size 8), similar images have
+hashes with a small Hamming distance. The BK-tree uses the triangle
+inequality of the Hamming distance to skip most of the tree, so a search
+for near-duplicates is sub-linear instead of comparing with every image.
+
+Needs numpy and Pillow (pip install numpy Pillow), they are imported
+only when an image is hashed. HEIC/HEIF images (the iPhone default) also
+need the pillow-heif plugin (pip install pillow-heif), without it they
+are not treated as images.
+"""
+import os
+
+HEIF_EXTENSIONS = ('.heic', '.heif')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff',
+                    '.webp') + HEIF_EXTENSIONS
+# None until checked, see has_heif_decoder()
+_heif_decoder = None
+
+
+class PerceptualHashException(Exception):
+    pass
+
+
+def _import_image_libs():
+    try:
+        import numpy
+        from PIL import Image
+    except ImportError:
+        raise PerceptualHashException(
+            'Perceptual hashes need numpy and Pillow: '
+            'pip install numpy Pillow')
+
+    return numpy, Image
+
+
+def check_image_libs():
+    """
+    Raise PerceptualHashException if numpy or Pillow is not installed
+    """
+    _import_image_libs()
+
+
+def has_heif_decoder():
+    """
+    :return bool: True if Pillow can open HEIC/HEIF images (the pillow-heif
+    plugin is installed, it is registered on the first call)
+    """
+    global _heif_decoder
+    if _heif_decoder is None:
+        try:
+            from pillow_heif import register_heif_opener
+        except ImportError:
+            _heif_decoder = False
+        else:
+            register_heif_opener()
+            _heif_decoder = True
+
+    return _heif_decoder
+
+
+def is_image_file(fname):
+    extension = os.path.splitext(fname)[1].lower()
+    if extension in HEIF_EXTENSIONS:
+        return has_heif_decoder()
+
+    return extension in IMAGE_EXTENSIONS
+
+
+def _load_gray_pixels(fname, width, height):
+    numpy, Image = _import_image_libs()
+    try:
+        with Image.open(fname) as img:
+            # JPEGs are decoded directly in a smaller scale (much faster)
+            img.draft('L', (width * 4, height * 4))
+            img = img.convert('L').resize((width, height), Image.LANCZOS)
+            return numpy.asarray(img, dtype=numpy.int16)
+    except Image.DecompressionBombError as ex:
+        # not an OSError
+        raise PerceptualHashException('Image too large: %s' % ex)
+
+
+def _bits_to_int(bits):
+    numpy, _ = _import_image_libs()
+    return int.from_bytes(numpy.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def difference_hash(fname, hash_size=8):
+    """
+    :return int: hash_size * hash_size bits, every bit is 1 if the pixel is
+    brighter than its right neighbour in the downscaled image
+    """
+    pixels = _load_gray_pixels(fname, hash_size + 1, hash_size)
+    return _bits_to_int(pixels[:, :-1] > pixels[:, 1:])
+
+
+def average_hash(fname, hash_size=8):
+    """
+    :return int: hash_size * hash_size bits, every bit is 1 if the pixel is
+    brighter than the mean of the downscaled image
+    """
+    pixels = _load_gray_pixels(fname, hash_size, hash_size)
+    return _bits_to_int(pixels > pixels.mean())
+
+
+HASH_FUNCTIONS = {
+    'dhash': difference_hash,
+    'ahash': average_hash,
+}
+
+
+def hamming_distance(first, second):
+    return bin(first ^ second).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of integer hashes with the Hamming distance
+    """
+
+    def __init__(self):
+        # node: [hash, items, {distance: child node}]
+        self._root = None
+        self.count_hashes = 0
+
+    def add(self, hash_value, item):
+        """
+        :param item: returned by search() for that hash (e.g. file name)
+        """
+        if self._root is None:
+            self._root = [hash_value, [item], {}]
+            self.count_hashes += 1
+            return
+
+        node = self._root
+        while True:
+            distance = hamming_distance(hash_value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [hash_value, [item], {}]
+                self.count_hashes += 1
+                return
+
+            node = child
+
+    def search(self, hash_value, max_distance):
+        """
+        :return list: (distance, item) for every item with hash within
+        max_distance, sorted by distance
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(hash_value, node[0])
+            if distance <= max_distance:
+                found.extend((distance, item) for item in node[1])
+
+            # only the children in that range can be within max_distance
+            for child_distance, child in node[2].items():
+                if abs(child_distance - distance) <= max_distance:
+                    stack.append(child)
+
+        return sorted(found, key=lambda x: x[0])
@@ -0,0 +1,241 @@
+"""
+Linux inotify watcher for new files
+
+Uses libc through ctypes, so there is no extra dependency. The events are
+coalesced in batches: after the first event the watcher keeps reading until
+there are no new events for `delay` seconds (or the batch is full), so a
+burst of arrivals is handled with one pass per directory.
+"""
+import os
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+from collections import defaultdict
+
+from sandbox.common.dir_walker import iter_dirs
+
+LOG = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# IN_CREATE is only used for directories, the files are reported when they
+# are completely written (IN_CLOSE_WRITE) or moved in (IN_MOVED_TO)
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+_READ_SIZE = 1 << 16
+
+
+class InotifyException(Exception):
+    pass
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                       use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise InotifyException('inotify is not supported on this system')
+
+    return libc
+
+
+class Batch:
+
+    def __init__(self):
+        # dir name -> set of new file names
+        self.new_files = defaultdict(set)
+        self.new_dirs = []
+        # True if the kernel queue overflowed and events were lost
+        self.overflow = False
+        self.count_events = 0
+
+
+class InotifyWatcher:
+
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise InotifyException('inotify_init1 failed: %s' %
+                                   os.strerror(errno))
+
+        self._wd_to_dir = {}
+        # cookie -> (wd, name) of the IN_MOVED_FROM events, to tell apart
+        # renames inside the tree from files moved in from elsewhere
+        self._moved_from = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def add_watch(self, dir_name):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(dir_name), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            LOG.warning('Can not watch %s: %s', dir_name, os.strerror(errno))
+            return None
+
+        self._wd_to_dir[wd] = dir_name
+        return wd
+
+    def _watched_under(self, dir_name):
+        """
+        :return list: (wd, watched dir name) of dir_name and its subdirs
+        """
+        prefix = os.path.join(dir_name, '')
+        return [(wd, watched) for wd, watched in self._wd_to_dir.items()
+                if watched == dir_name or watched.startswith(prefix)]
+
+    def _rename_dirs(self, batch, old_dir, new_dir):
+        """
+        A watched dir was renamed inside the tree, its watch and the ones of
+        its subdirs stay, only the paths change.
+        """
+        for wd, watched in self._watched_under(old_dir):
+            new_watched = new_dir + watched[len(old_dir):]
+            self._wd_to_dir[wd] = new_watched
+            # the files which arrived before the rename, in this batch
+            if watched in batch.new_files:
+                batch.new_files[new_watched] |= batch.new_files.pop(watched)
+
+        LOG.debug('Watched directory %s renamed to %s', old_dir, new_dir)
+
+    def _remove_dirs(self, dir_name):
+        """
+        Stop watching dir_name and its subdirs (moved out of the tree).
+        """
+        for wd, _ in self._watched_under(dir_name):
+            del self._wd_to_dir[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+        LOG.info('Not watching %s anymore, it was moved away', dir_name)
+
+    def add_tree(self, top, recursive=True):
+        """
+        :return int: count of the watched directories
+        """
+        count = 0
+        for dir_name, _, _ in iter_dirs(top, recursive=recursive,
+                                         on_error=LOG.warning):
+            count += self.add_watch(dir_name) is not None
+
+        return count
+
+    def _read_events(self, timeout):
+        """
+        :param timeout: in seconds, None to wait until there are events
+        :return generator: (wd, mask, cookie, name)
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return
+
+        data = os.read(self._fd, _READ_SIZE)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(data,
+                                                                   offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_len].rstrip(b'\0')
+            offset += name_len
+            yield wd, mask, cookie, os.fsdecode(name)
+
+    def _add_event(self, batch, wd, mask, cookie, name):
+        batch.count_events += 1
+        if mask & IN_Q_OVERFLOW:
+            LOG.warning('inotify queue overflow, events were lost')
+            batch.overflow = True
+            return
+
+        if mask & IN_IGNORED:
+            self._wd_to_dir.pop(wd, None)
+            return
+
+        dir_name = self._wd_to_dir.get(wd)
+        if dir_name is None:
+            return
+
+        if mask & IN_MOVE_SELF:
+            # after the IN_MOVED_FROM/IN_MOVED_TO pair of a rename inside
+            # the tree (already applied), so the dir is gone only if it was
+            # moved out of the tree
+            if not os.path.isdir(dir_name):
+                self._remove_dirs(dir_name)
+            return
+
+        if not name:
+            return
+
+        if mask & IN_MOVED_FROM:
+            self._moved_from[cookie] = (wd, name)
+            return
+
+        moved_from = None
+        if mask & IN_MOVED_TO:
+            moved_from = self._moved_from.pop(cookie, None)
+
+        if moved_from is not None and mask & IN_ISDIR:
+            from_dir_name = self._wd_to_dir.get(moved_from[0])
+            if from_dir_name is not None:
+                self._rename_dirs(batch,
+                                  os.path.join(from_dir_name, moved_from[1]),
+                                  os.path.join(dir_name, name))
+                return
+
+        if moved_from is not None and moved_from[0] == wd:
+            # renamed inside the directory (e.g. by us), not a new file
+            return
+
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                batch.new_dirs.append(os.path.join(dir_name, name))
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            batch.new_files[dir_name].add(name)
+
+    def iter_batches(self, delay=1.0, max_batch_events=10000):
+        """
+        Wait for events and yield them coalesced in Batch objects.
+
+        :param delay: seconds without new events, which close a batch
+        :param max_batch_events: a batch is closed when it has that many
+        events even if events are still arriving
+        """
+        while self._fd >= 0:
+            batch = Batch()
+            timeout = None  # wait for the first event of the batch
+            while batch.count_events < max_batch_events:
+                count_events = batch.count_events
+                for event in self._read_events(timeout):
+                    self._add_event(batch, *event)
+
+                if batch.count_events == count_events:
+                    break
+
+                timeout = delay
+
+            # the moves out of the watched directories have no pair, their
+            # cookies are not needed anymore
+            self._moved_from.clear()
+            yield batch
@@ -0,0 +1,171 @@
+"""
+On-disk journal with the planned renames
+
+The journal is written while the tree is scanned (plan phase) and
+executed later (apply phase). It is read and written as a stream, so the
+memory used does not depend on the number of renames.
+
+Format: NUL terminated fields (NUL is the only character that can not be
+part of a file name)
+    header:     H <version>
+    directory:  D <abs dir name>
+    rename:     R <old file name> <new file name>
+The renames belong to the last directory record before them, every
+directory is written once.
+
+The plan never uses a target name that already exists in the directory,
+so the renames do not depend on each other and can be executed in any
+order, also reversed (undo).
+"""
+import os
+import logging
+from collections import Counter
+
+LOG = logging.getLogger(__name__)
+
+JOURNAL_VERSION = '1'
+_READ_SIZE = 1 << 16
+
+
+class JournalException(Exception):
+    pass
+
+
+def _open(fname, mode):
+    # surrogateescape, so file names that are not valid UTF-8 survive
+    return open(fname, mode, encoding='utf-8', errors='surrogateescape',
+                newline='')
+
+
+class JournalWriter:
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.count_dirs = 0
+        self.count_renames = 0
+        self._fout = None
+
+    def __enter__(self):
+        self._fout = _open(self.fname, 'w')
+        self._write('H', JOURNAL_VERSION)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._fout.close()
+        self._fout = None
+
+    def _write(self, *fields):
+        self._fout.write('\0'.join(fields))
+        self._fout.write('\0')
+
+    def add_dir(self, dir_name, renames):
+        """
+        :param dir_name: absolute path of the directory
+        :param renames: list of (old file name, new file name)
+        """
+        if not renames:
+            return
+
+        self._write('D', dir_name)
+        for old_name, new_name in renames:
+            self._write('R', old_name, new_name)
+
+        self.count_dirs += 1
+        self.count_renames += len(renames)
+
+
+def _iter_fields(fin):
+    tail = ''
+    while True:
+        chunk = fin.read(_READ_SIZE)
+        if not chunk:
+            break
+
+        fields = (tail + chunk).split('\0')
+        tail = fields.pop()
+        yield from fields
+
+    if tail:
+        raise JournalException('Truncated journal: %s' % fin.name)
+
+
+def iter_renames(fname):
+    """
+    :return generator: (dir name, old file name, new file name)
+    """
+    with _open(fname, 'r') as fin:
+        fields = _iter_fields(fin)
+        header = [next(fields, None), next(fields, None)]
+        if header != ['H', JOURNAL_VERSION]:
+            raise JournalException('Not a rename journal: %s' % fname)
+
+        dir_name = None
+        for record_type in fields:
+            if record_type == 'D':
+                dir_name = next(fields, None)
+            elif record_type == 'R' and dir_name is not None:
+                old_name = next(fields, None)
+                new_name = next(fields, None)
+                if old_name is None or new_name is None:
+                    raise JournalException('Truncated journal: %s' % fname)
+
+                yield dir_name, old_name, new_name
+            else:
+                raise JournalException('Invalid record "%s" in journal %s' %
+                                       (record_type, fname))
+
+
+def _list_names(dir_name):
+    try:
+        with os.scandir(dir_name) as it:
+            return {entry.name for entry in it}
+    except OSError as ex:
+        LOG.warning('Can not list %s: %s', dir_name, ex)
+        return set()
+
+
+def apply_journal(fname, undo=False, dry_run=False):
+    """
+    Execute the renames from the journal.
+
+    Every directory is listed once and the renames are checked against that
+    listing, so renames that are already done (e.g. before a crash) are
+    skipped and applying the same journal again is safe.
+
+    :param undo: if True, the files are renamed back to their old names
+    :param dry_run: if True, no changes will be performed
+    :return Counter: with keys "renamed", "already renamed", "skipped"
+    """
+    stats = Counter()
+    cur_dir = None
+    names = set()
+    for dir_name, old_name, new_name in iter_renames(fname):
+        if undo:
+            old_name, new_name = new_name, old_name
+
+        if dir_name != cur_dir:
+            cur_dir = dir_name
+            names = _list_names(dir_name)
+
+        if old_name in names and new_name not in names:
+            msg = 'renaming "%s" -> "%s"' % (old_name, new_name)
+            if dry_run:
+                LOG.info('(dry run) %s', msg)
+            else:
+                LOG.debug(msg)
+                os.rename(os.path.join(dir_name, old_name),
+                          os.path.join(dir_name, new_name))
+
+            names.discard(old_name)
+            names.add(new_name)
+            stats['renamed'] += 1
+        elif new_name in names and old_name not in names:
+            LOG.debug('Already renamed: %s',
+                      os.path.join(dir_name, new_name))
+            stats['already renamed'] += 1
+        else:
+            LOG.warning('Skipping "%s" -> "%s" in %s, both or none of the '
+                        'names exist', old_name, new_name, dir_name)
+            stats['skipped'] += 1
+
+    return stats
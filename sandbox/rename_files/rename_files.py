@@ -3,13 +3,32 @@ import os
 import argparse
 import re
 import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from sandbox.common.logging_utils import config_logging
 from sandbox.common.input_utils import confirm
 from sandbox.common.formatting import format_seconds
+from sandbox.common.dir_walker import iter_dirs
+from sandbox.rename_files.journal import (
+    JournalWriter, JournalException, apply_journal)
+from sandbox.rename_files.inotify_watch import (
+    InotifyWatcher, InotifyException)
+from sandbox.rename_files.report import ReportWriter
+from sandbox.rename_files.rules import (
+    RenamePipeline, PrefixRule, SuffixRule, CASE_MODES, make_rule,
+    REGEX_MISS, UNCHANGED, INVALID_NAME)
 
 LOG = logging.getLogger(__name__)
 
+# decisions for the files, in addition to the ones of RenamePipeline
+NAME_USED = 'name-used'
+PLANNED = 'planned'
+DRY_RUN = 'dry-run'
+RENAMED = 'renamed'
+
 
 class RenameFilesException(Exception):
     pass
@@ -26,10 +45,42 @@ def get_regex(pattern=None):
     return None
 
 
+class _UsedNames(set):
+    """
+    Known names of a directory, the names not in the set are checked on the
+    file system (used when only a few names of a big directory are known)
+    """
+
+    def __init__(self, dir_name, names=()):
+        super().__init__(names)
+        self.dir_name = dir_name
+
+    def __contains__(self, name):
+        return (super().__contains__(name) or
+                os.path.lexists(os.path.join(self.dir_name, name)))
+
+
+class AddRule(argparse.Action):
+    """
+    Collects the rules in the order they are given on the command line
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            rule = make_rule(option_string.lstrip('-'), values)
+        except ValueError as ex:
+            parser.error(str(ex))
+
+        rules = list(getattr(namespace, self.dest, None) or [])
+        rules.append(rule)
+        setattr(namespace, self.dest, rules)
+
+
 def read_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--dir', required=True,
-                        help='Files in that directory will be renamed')
+    parser.add_argument('--dir',
+                        help=('Files in that directory will be renamed '
+                              '(required for "change")'))
     parser.add_argument('-r', '--recursive', action='store_true',
                         help='Process files inside sub-directories')
     parser.add_argument('--regex', type=get_regex,
@@ -38,21 +89,65 @@ def read_args():
     parser.add_argument('--dry-run', action='store_true',
                         help='Show what will be modified without doing it')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help=('Number of threads used for listing the '
+                              'directories and renaming the files'))
+    parser.add_argument('--report',
+                        help=('Write the decision for every file to that '
+                              'file (JSON lines) instead of logging it'))
+    parser.add_argument('--watch', action='store_true',
+                        help=('After processing the files keep watching the '
+                              'directory (and the sub-directories with -r) '
+                              'and rename the new files (Linux only)'))
+    parser.add_argument('--watch-delay', type=float, default=1.0,
+                        help=('Seconds without new files, after which the '
+                              'collected new files are renamed'))
     subparsers = parser.add_subparsers()
     # the below two lines will make the "change" sub-command required
     subparsers.required = True
     subparsers.dest = 'change'
-    operation_parser = subparsers.add_parser('change')
-    operation_group = operation_parser.add_mutually_exclusive_group(
-        required=True)
-    operation_group.add_argument(
-        '--prefix',
-        help=('Prefix the matching files with the provided string'))
-    operation_group.add_argument(
-        '--suffix',
-        help=('Suffix the matching files with the provided string'))
+    operation_parser = subparsers.add_parser(
+        'change', help=('Change the matching file names, the options can be '
+                        'combined and are applied in the given order'))
+    operation_parser.add_argument(
+        '--prefix', dest='rules', action=AddRule,
+        help='Prefix the matching files with the provided string')
+    operation_parser.add_argument(
+        '--suffix', dest='rules', action=AddRule,
+        help='Suffix the matching files with the provided string')
+    operation_parser.add_argument(
+        '--sub', dest='rules', action=AddRule, nargs=2,
+        metavar=('PATTERN', 'REPLACEMENT'),
+        help='Replace the regular expression matches in the file names')
+    operation_parser.add_argument(
+        '--case', dest='rules', action=AddRule, choices=sorted(CASE_MODES),
+        help='Change the case of the file names (without the extension)')
+    operation_parser.add_argument(
+        '--ext-map', dest='rules', action=AddRule,
+        help=('Replace extensions, comma separated old:new pairs, '
+              'e.g. "jpeg:jpg,JPG:jpg"'))
+    operation_parser.add_argument(
+        '--journal',
+        help=('Write the planned renames to that file and then execute '
+              'them from it (with --dry-run only the plan is written)'))
+    apply_parser = subparsers.add_parser(
+        'apply', help='Execute the renames from a journal')
+    apply_parser.add_argument('--journal', required=True,
+                              help='Journal written by "change --journal"')
+    apply_parser.add_argument('--undo', action='store_true',
+                              help='Rename the files back to the old names')
 
     args = parser.parse_args()
+    if args.change == 'change' and not args.dir:
+        parser.error('--dir is required for "change"')
+
+    if args.change == 'change' and not args.rules:
+        parser.error('At least one change is required for "change"')
+
+    if args.watch and (args.change != 'change' or args.journal):
+        parser.error('--watch can be used only with "change" without '
+                     '--journal')
+
     config_logger(args.debug)
     return args
 
@@ -67,7 +162,8 @@ def config_logger(debug=False):
 class Worker:
 
     def __init__(self, dir, recursive=None, regex=None,
-                 dry_run=None, prefix=None, suffix=None):
+                 dry_run=None, prefix=None, suffix=None, jobs=None,
+                 journal=None, rules=None, report=None):
         """
         :param dir: files in that dir will be renamed
         :param recursive: if True, will process subdirectories
@@ -75,107 +171,138 @@ class Worker:
         renamed
         :param dry_run: if True, no changes will be performed
         :param prefix: will use that to prefix the matched files
-        :param suffix: will use that to prefix the matched files
+        :param suffix: will use that to suffix the matched files
+        :param jobs: if > 1, that many threads list the directories and
+        rename the files (files of one directory are renamed in order by
+        the same thread)
+        :param journal: if provided, the renames are first written to that
+        file and then executed from it (only written on dry run)
+        :param rules: rules from sandbox.rename_files.rules applied in that
+        order to every matched file name (prefix and suffix are added to
+        them)
+        :param report: if provided, the decision for every file is written
+        to that file instead of being logged, only counts per directory are
+        logged
         """
         self.dir = dir
         self.recursive = recursive
         self.regex = regex
         self.dry_run = dry_run
-        self.prefix = prefix
-        self.suffix = suffix
+        self.rules = list(rules or [])
+        self.jobs = jobs
+        self.journal = journal
+        self.report = report
 
         self.count_dirs_processed = 0
+        self.count_files_processed = 0
         self.count_files_changed = 0
+        self.count_renames_planned = 0
+        self._counters_lock = threading.Lock()
+        self._journal_writer = None
+        self._report_writer = None
 
         if not os.path.isdir(self.dir):
             raise RenameFilesException('%s is not directory' % self.dir)
 
-        if (bool(self.prefix) + bool(self.suffix)) != 1:
-            raise RenameFilesException('Can specify only one: '
-                                       'prefix (%s), suffix (%s)' %
-                                       (self.prefix, self.suffix))
+        if suffix:
+            self.rules.append(SuffixRule(suffix))
 
-        if self.prefix:
-            self.rename_file = self._rename_using_prefix
-        elif self.suffix:
-            self.rename_file = self._rename_using_suffix
-        else:
-            raise RenameFilesException('hohoho')
+        if prefix:
+            self.rules.append(PrefixRule(prefix))
 
-    def _rename_using_prefix(self, fname):
-        """
-        :return bool: True if the file name was changed, False otherwise
-        """
+        if not self.rules:
+            raise RenameFilesException('No rules for renaming the files')
 
-        if not os.path.isabs(fname):
-            raise Exception('Not absolute path')
+        self._pipeline = RenamePipeline(self.rules, self.regex)
 
-        dir_name = os.path.dirname(fname)
-        old_file_name = os.path.basename(fname)
-        if old_file_name.startswith(self.prefix):
-            LOG.debug('Already prefixed: %s', fname)
-            return False
-
-        if self.regex and not self.regex.search(old_file_name):
-            LOG.debug('File %s does not match the provided regex',
-                      old_file_name)
-            return False
-
-        new_file_name = '%s%s' % (self.prefix, old_file_name)
-        msg = 'renaming "%s" -> "%s"' % (old_file_name, new_file_name)
-        if self.dry_run:
+    def _add_decision(self, decisions, dir_name, file_name, new_file_name,
+                      decision):
+        """
+        :param decisions: list collecting the decisions for the report, if
+        None the decision is logged
+        """
+        if decisions is not None:
+            decisions.append((file_name, new_file_name, decision))
+            return
+
+        msg = 'renaming "%s" -> "%s"' % (file_name, new_file_name)
+        if decision == REGEX_MISS:
+            LOG.debug('File %s does not match the provided regex', file_name)
+        elif decision == UNCHANGED:
+            LOG.debug('Not changed by the rules: %s', file_name)
+        elif decision == INVALID_NAME:
+            LOG.warning('Rules produce invalid name for %s', file_name)
+        elif decision == NAME_USED:
+            LOG.warning('Can not rename "%s" -> "%s" in %s, the name is '
+                        'already used', file_name, new_file_name, dir_name)
+        elif decision == DRY_RUN:
             LOG.info('(dry run) %s', msg)
-            return False
-
-        LOG.debug(msg)
-        os.rename(fname, os.path.join(dir_name, new_file_name))
-        return True
+        elif decision == RENAMED:
+            LOG.debug(msg)
 
-    def _rename_using_suffix(self, fname):
+    def plan_renames(self, dir_name, dir_names, file_names, decisions=None):
         """
-        :return bool: True if the file name was changed, False otherwise
+        :param dir_names: set with the names in dir_name (files and
+        directories), used for detecting name collisions instead of checking
+        every new name on the file system, the new names are added to it
+        :param file_names: names of the files to be renamed
+        :param decisions: see _add_decision()
+        :return list: (old file name, new file name)
         """
+        renames = []
+        for old_file_name in file_names:
+            new_file_name, decision = \
+                self._pipeline.get_new_name(old_file_name)
+            if new_file_name and new_file_name in dir_names:
+                decision = NAME_USED
 
-        if not os.path.isabs(fname):
-            raise Exception('Not absolute path')
-
-        dir_name = os.path.dirname(fname)
-        old_file_name = os.path.basename(fname)
+            if decision == NAME_USED or not new_file_name:
+                self._add_decision(decisions, dir_name, old_file_name,
+                                   new_file_name, decision)
+                continue
 
-        if self.regex and not self.regex.search(old_file_name):
-            LOG.debug('File %s does not match the provided regex',
-                      old_file_name)
-            return False
+            dir_names.add(new_file_name)
+            renames.append((old_file_name, new_file_name))
 
-        file_parts = old_file_name.rsplit('.', 1)
-        if len(file_parts) == 1:
-            file_parts.append('')
+        return renames
 
-        if file_parts[0].endswith(self.suffix):
-            LOG.debug('Already suffixed: %s', fname)
-            return False
+    def rename_files(self, dir_name, renames, decisions=None):
+        """
+        :param decisions: see _add_decision()
+        :return int: count of the renamed files
+        """
+        if not os.path.isabs(dir_name):
+            raise Exception('Not absolute path')
 
-        if file_parts[1]:
-            file_parts[1] = '.%s' % file_parts[1]
+        count_changed = 0
+        for old_file_name, new_file_name in renames:
+            if self.dry_run:
+                self._add_decision(decisions, dir_name, old_file_name,
+                                   new_file_name, DRY_RUN)
+                continue
 
-        new_file_name = ('%s%s%s' %
-                         (file_parts[0], self.suffix, file_parts[1]))
+            self._add_decision(decisions, dir_name, old_file_name,
+                               new_file_name, RENAMED)
+            os.rename(os.path.join(dir_name, old_file_name),
+                      os.path.join(dir_name, new_file_name))
+            count_changed += 1
 
-        msg = 'renaming "%s" -> "%s"' % (old_file_name, new_file_name)
-        if self.dry_run:
-            LOG.info('(dry run) %s', msg)
-            return False
+        return count_changed
 
-        LOG.debug(msg)
+    def _report_decisions(self, dir_name, decisions):
+        if decisions is None:
+            return
 
-        os.rename(fname, os.path.join(dir_name, new_file_name))
-        return True
+        self._report_writer.add_dir(dir_name, decisions)
+        counts = Counter(decision for _, _, decision in decisions)
+        LOG.info('Decisions in %s: %s', dir_name,
+                 ', '.join('%s %s' % item for item in sorted(counts.items())))
 
     def show_active_vars(self):
         lines = ['This will be used for renaming:', ]
         for k in sorted(self.__dict__.keys()):
             v = self.__dict__[k]
-            if v and k != 'rename_file':
+            if v and not k.startswith('_'):
                 lines.append('%s: "%s"' % (k, v))
         LOG.info('\n'.join(lines))
 
@@ -186,56 +313,200 @@ class Worker:
             recursive=args.recursive,
             regex=args.regex,
             dry_run=args.dry_run,
-            prefix=args.prefix,
-            suffix=args.suffix)
+            jobs=args.jobs,
+            journal=args.journal,
+            rules=args.rules,
+            report=args.report)
 
-    def process_files(self, dirname):
+    def _process_dir(self, dirname, dir_entries, file_entries):
         LOG.info('Processing %s', dirname)
-        self.count_dirs_processed += 1
-        dirs_to_process = []
-        dirname = os.path.abspath(dirname)
+        decisions = [] if self._report_writer else None
+        names = {entry.name for entry in dir_entries}
+        file_names = [entry.name for entry in file_entries]
+        names.update(file_names)
+        renames = self.plan_renames(dirname, names, file_names, decisions)
         count_cur_dir_changed_files = 0
-        for item in os.listdir(dirname):
-            item = os.path.join(dirname, item)
-            if os.path.isdir(item):
-                dirs_to_process.append(item)
-            else:
-                changed = self.rename_file(item)  # changed = True/False
-                self.count_files_changed += changed
-                count_cur_dir_changed_files += changed
-
+        if self._journal_writer:
+            for old_file_name, new_file_name in renames:
+                self._add_decision(decisions, dirname, old_file_name,
+                                   new_file_name, PLANNED)
+        else:
+            count_cur_dir_changed_files = self.rename_files(
+                dirname, renames, decisions)
+
+        with self._counters_lock:
+            self.count_dirs_processed += 1
+            self.count_files_processed += len(file_entries)
+            self.count_files_changed += count_cur_dir_changed_files
+            self.count_renames_planned += len(renames)
+            if self._journal_writer:
+                self._journal_writer.add_dir(dirname, renames)
+
+        self._report_decisions(dirname, decisions)
         LOG.info('Files changed in %s: %s',
                  dirname, count_cur_dir_changed_files)
+        if not self.recursive:
+            for entry in dir_entries:
+                LOG.debug('Skipping directory %s', entry.path)
 
-        for _dirname in dirs_to_process:
-            if self.recursive:
-                self.process_files(_dirname)
-            else:
-                LOG.debug('Skipping directory %s', _dirname)
+    def process_files(self, dirname):
+        dirname = os.path.abspath(dirname)
+        scanned_dirs = iter_dirs(dirname, recursive=self.recursive,
+                                 jobs=self.jobs)
+        if not self.jobs or self.jobs < 2:
+            for scanned in scanned_dirs:
+                self._process_dir(*scanned)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = set()
+            for scanned in scanned_dirs:
+                # bounded, so the listing does not run far ahead of renaming
+                if len(pending) >= self.jobs * 2:
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()  # raise the errors, if any
+
+                pending.add(executor.submit(self._process_dir, *scanned))
+
+            for future in wait(pending).done:
+                future.result()
+
+    @contextmanager
+    def _reporting(self):
+        if not self.report or self._report_writer:
+            yield
+            return
+
+        with ReportWriter(self.report) as self._report_writer:
+            yield
+
+        LOG.info('Decisions for %s files written to %s',
+                 self._report_writer.count_records,
+                 os.path.abspath(self.report))
+        self._report_writer = None
 
     def run(self):
-        self.process_files(self.dir)
+        with self._reporting():
+            self._process_all()
+
+    def _process_all(self):
+        if not self.journal:
+            self.process_files(self.dir)
+            return
+
+        with JournalWriter(self.journal) as self._journal_writer:
+            self.process_files(self.dir)
+
+        self._journal_writer = None
+        LOG.info('Renames planned: %s, journal: %s',
+                 self.count_renames_planned, os.path.abspath(self.journal))
+        if self.dry_run:
+            return
+
+        stats = apply_journal(self.journal)
+        self.count_files_changed = stats['renamed']
+
+    def _process_new_files(self, dirname, file_names):
+        file_names = [
+            name for name in sorted(file_names)
+            if os.path.isfile(os.path.join(dirname, name))
+        ]
+        decisions = [] if self._report_writer else None
+        renames = self.plan_renames(
+            dirname, _UsedNames(dirname, file_names), file_names, decisions)
+        count_changed = self.rename_files(dirname, renames, decisions)
+        with self._counters_lock:
+            self.count_files_processed += len(file_names)
+            self.count_files_changed += count_changed
+
+        self._report_decisions(dirname, decisions)
+
+        LOG.info('New files in %s: %s, changed: %s',
+                 dirname, len(file_names), count_changed)
+
+    def watch(self, delay=1.0):
+        """
+        Process the files (see run()) and then keep renaming the new files
+        until interrupted (Ctrl+C).
+
+        :param delay: seconds without new files, after which the collected
+        new files are renamed
+        """
+        dirname = os.path.abspath(self.dir)
+        with InotifyWatcher() as watcher, self._reporting():
+            # watch before the first pass, so no new file is missed
+            count_watched = watcher.add_tree(dirname, self.recursive)
+            self.run()
+            LOG.info('Watching %s directories for new files', count_watched)
+            try:
+                for batch in watcher.iter_batches(delay):
+                    if batch.overflow:
+                        # the lost events could be of new dirs, watching an
+                        # already watched dir again does nothing
+                        count_watched = watcher.add_tree(dirname,
+                                                         self.recursive)
+                        LOG.info('Events lost, watching %s directories',
+                                 count_watched)
+                        self.process_files(dirname)
+                        continue
+
+                    if self.recursive:
+                        for new_dir in batch.new_dirs:
+                            watcher.add_tree(new_dir)
+                            self.process_files(new_dir)
+
+                    for new_files_dir, file_names in batch.new_files.items():
+                        self._process_new_files(new_files_dir, file_names)
+            except KeyboardInterrupt:
+                LOG.info('Watching stopped')
+
+
+def _apply(args):
+    LOG.info('%s journal %s', 'Undoing' if args.undo else 'Applying',
+             os.path.abspath(args.journal))
+    if not confirm():
+        return
+
+    start_time = time.time()
+    stats = apply_journal(args.journal, undo=args.undo, dry_run=args.dry_run)
+    LOG.info('Files renamed: %s, already renamed: %s, skipped: %s',
+             stats['renamed'], stats['already renamed'], stats['skipped'])
+    LOG.info('Applying the journal completed for %s',
+             format_seconds(time.time() - start_time))
 
 
 def _run():
     args = read_args()
     LOG.debug(args)
+    if args.change == 'apply':
+        _apply(args)
+        return
+
     worker = Worker.from_args(args)
     worker.show_active_vars()
     if not confirm():
         return
     start_time = time.time()
-    worker.run()
+    if args.watch:
+        worker.watch(args.watch_delay)
+    else:
+        worker.run()
+
+    seconds = time.time() - start_time
     LOG.info('Directories processed: %s', worker.count_dirs_processed)
+    LOG.info('Files processed: %s', worker.count_files_processed)
     LOG.info('Files changed: %s', worker.count_files_changed)
-    LOG.info('Renaming files completed for %s',
-             format_seconds(time.time() - start_time))
+    LOG.info('Renaming files completed for %s (%s files/sec.)',
+             format_seconds(seconds),
+             round(worker.count_files_processed / max(seconds, 1e-6), 2))
 
 
 def run():
     try:
         _run()
-    except RenameFilesException as ex:
+    except (RenameFilesException, JournalException, InotifyException) as ex:
         LOG.error(ex)
 
 
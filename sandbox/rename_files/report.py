@@ -0,0 +1,74 @@
+"""
+Report with the decision for every processed file
+
+The records are passed per directory to a background thread, which
+serialises them as JSON lines and writes them to the report file, so
+the cost for the processing threads does not depend on the number of
+files.
+"""
+import json
+import queue
+import threading
+
+
+class ReportWriter:
+
+    def __init__(self, fname, max_pending_dirs=64):
+        """
+        :param fname: the report file, one JSON object per line
+        :param max_pending_dirs: add_dir() blocks when that many directories
+        are waiting to be written
+        """
+        self.fname = fname
+        self.count_records = 0
+        self._queue = queue.Queue(maxsize=max_pending_dirs)
+        self._fout = None
+        self._thread = None
+        self._error = None
+
+    def __enter__(self):
+        self._fout = open(self.fname, 'w', encoding='utf-8')
+        self._thread = threading.Thread(target=self._write_records,
+                                        name='report-writer', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._queue.put(None)
+        self._thread.join()
+        self._fout.close()
+        if self._error is not None:
+            raise self._error
+
+    def add_dir(self, dir_name, records):
+        """
+        :param records: list of (file name, new file name, decision)
+        """
+        if records:
+            self._queue.put((dir_name, records))
+
+    def _write_records(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            if self._error is not None:
+                continue  # keep consuming, so add_dir() never blocks
+
+            dir_name, records = item
+            try:
+                self._fout.write(''.join(
+                    '%s\n' % json.dumps({
+                        'dir': dir_name,
+                        'file': file_name,
+                        'new_file': new_file_name,
+                        'decision': decision
+                    })
+                    for file_name, new_file_name, decision in records
+                ))
+            except Exception as ex:
+                self._error = ex
+                continue
+
+            self.count_records += len(records)
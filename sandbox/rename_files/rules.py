@@ -0,0 +1,242 @@
+"""
+Rules for changing file names
+
+Every rule is a callable, which gets the current file name and returns the
+changed one (or the same name if the rule does not change it). The rules
+are compiled once in RenamePipeline and applied one after another to every
+file name, so any number of changes cost one directory scan and at most one
+rename per file.
+"""
+import os
+import re
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# decisions of RenamePipeline
+MATCHED = 'matched'
+REGEX_MISS = 'regex-miss'
+UNCHANGED = 'unchanged'  # e.g. already prefixed
+INVALID_NAME = 'invalid-name'
+RULE_ERROR = 'rule-error'
+
+CASE_MODES = {
+    'lower': str.lower,
+    'upper': str.upper,
+    'title': str.title,
+}
+
+
+def split_extension(file_name):
+    """
+    :return tuple: (name without extension, extension without the dot), the
+    extension is '' if the name has no dot
+    """
+    file_parts = file_name.rsplit('.', 1)
+    if len(file_parts) == 1:
+        file_parts.append('')
+
+    return file_parts[0], file_parts[1]
+
+
+def join_extension(name, extension):
+    return '%s.%s' % (name, extension) if extension else name
+
+
+def is_valid_name(file_name):
+    """
+    :return bool: False for names, which can not be a name of a file in the
+    same dir (empty, ".", "..", with a path separator or a null character)
+    """
+    if file_name in ('', '.', '..') or '\0' in file_name:
+        return False
+
+    return not any(sep and sep in file_name for sep in (os.sep, os.altsep))
+
+
+class PrefixRule:
+
+    def __init__(self, prefix):
+        if not prefix:
+            raise ValueError('Empty prefix')
+
+        self.prefix = prefix
+
+    def __call__(self, file_name):
+        if file_name.startswith(self.prefix):
+            return file_name
+
+        return '%s%s' % (self.prefix, file_name)
+
+    def __repr__(self):
+        return 'prefix "%s"' % self.prefix
+
+
+class SuffixRule:
+
+    def __init__(self, suffix):
+        if not suffix:
+            raise ValueError('Empty suffix')
+
+        self.suffix = suffix
+
+    def __call__(self, file_name):
+        name, extension = split_extension(file_name)
+        if name.endswith(self.suffix):
+            return file_name
+
+        return join_extension('%s%s' % (name, self.suffix), extension)
+
+    def __repr__(self):
+        return 'suffix "%s"' % self.suffix
+
+
+class RegexSubRule:
+
+    def __init__(self, pattern, replacement):
+        try:
+            self.regex = re.compile(pattern)
+        except re.error:
+            raise ValueError('Can not create regular expression from "%s"' %
+                             pattern)
+
+        try:
+            # the template is parsed even without matches, e.g. "\2" with a
+            # single group in the pattern fails here
+            self.regex.sub(replacement, '')
+        except re.error as ex:
+            raise ValueError('Invalid replacement "%s": %s' %
+                             (replacement, ex))
+
+        self.replacement = replacement
+
+    def __call__(self, file_name):
+        return self.regex.sub(self.replacement, file_name)
+
+    def __repr__(self):
+        return 'sub "%s" -> "%s"' % (self.regex.pattern, self.replacement)
+
+
+class CaseRule:
+    """
+    Changes the case of the name, the extension is not changed (use
+    ExtensionMapRule for it)
+    """
+
+    def __init__(self, mode):
+        if mode not in CASE_MODES:
+            raise ValueError('Invalid case "%s", use one of: %s' %
+                             (mode, ', '.join(sorted(CASE_MODES))))
+
+        self.mode = mode
+        self._change_case = CASE_MODES[mode]
+
+    def __call__(self, file_name):
+        name, extension = split_extension(file_name)
+        return join_extension(self._change_case(name), extension)
+
+    def __repr__(self):
+        return 'case %s' % self.mode
+
+
+class ExtensionMapRule:
+    """
+    Replaces extensions, the old extensions are matched case-insensitive
+    """
+
+    def __init__(self, mapping):
+        """
+        :param mapping: dict old extension -> new extension (without dots)
+        """
+        self.mapping = {
+            old.lstrip('.').lower(): new.lstrip('.')
+            for old, new in mapping.items()
+        }
+
+    @staticmethod
+    def from_string(value):
+        """
+        :param value: comma separated old:new pairs, e.g. "jpeg:jpg,JPG:jpg"
+        """
+        mapping = {}
+        for pair in value.split(','):
+            old, sep, new = pair.strip().partition(':')
+            if not sep or not old or not new:
+                raise ValueError('Invalid extension mapping "%s"' % pair)
+
+            mapping[old] = new
+
+        return ExtensionMapRule(mapping)
+
+    def __call__(self, file_name):
+        name, extension = split_extension(file_name)
+        new_extension = self.mapping.get(extension.lower())
+        if not extension or new_extension is None:
+            return file_name
+
+        return join_extension(name, new_extension)
+
+    def __repr__(self):
+        return 'ext-map %s' % ','.join(
+            '%s:%s' % item for item in sorted(self.mapping.items()))
+
+
+RULE_FACTORIES = {
+    'prefix': PrefixRule,
+    'suffix': SuffixRule,
+    'sub': lambda values: RegexSubRule(*values),
+    'case': CaseRule,
+    'ext-map': ExtensionMapRule.from_string,
+}
+
+
+def make_rule(kind, value):
+    """
+    :param kind: one of RULE_FACTORIES
+    :param value: the value of the command line option for that rule
+    """
+    if kind not in RULE_FACTORIES:
+        raise ValueError('Unknown rule "%s"' % kind)
+
+    return RULE_FACTORIES[kind](value)
+
+
+class RenamePipeline:
+
+    def __init__(self, rules, regex=None):
+        """
+        :param rules: rules applied in that order
+        :param regex: if provided, only names matching it are changed
+        """
+        if not rules:
+            raise ValueError('At least one rule is required')
+
+        self.rules = list(rules)
+        self.regex = regex
+
+    def get_new_name(self, file_name):
+        """
+        :return tuple: (new file name or None if the file must not be
+        renamed, decision - one of MATCHED, REGEX_MISS, UNCHANGED,
+        INVALID_NAME, RULE_ERROR)
+        """
+        if self.regex and not self.regex.search(file_name):
+            return None, REGEX_MISS
+
+        new_file_name = file_name
+        for rule in self.rules:
+            try:
+                new_file_name = rule(new_file_name)
+            except re.error as ex:
+                # only this file is skipped
+                LOG.warning('Can not apply %s to %s: %s', rule,
+                            new_file_name, ex)
+                return None, RULE_ERROR
+
+        if not is_valid_name(new_file_name):
+            return None, INVALID_NAME
+
+        if new_file_name == file_name:
+            return None, UNCHANGED
+
+        return new_file_name, MATCHED
@@ -0,0 +1,159 @@
+"""
+Diff of two sorted listings (e.g. the output of
+get_file_names_from_nested_dir.py or movie_names_to_file.py from two runs)
+or of a listing and a live directory tree.
+
+The listings are streamed side by side (linear merge), so the memory
+used does not depend on their size. A live tree is listed and sorted with
+an external sort (see --memory-limit).
+
+Output: one line per difference
+    - name    only in the old listing (removed)
+    + name    only in the new listing / tree (added)
+
+Example:
+this_file.py --old names-2020-01.txt --new names-2020-02.txt
+this_file.py --old downloaded-horror-names.txt --dir /path/to/dir_horrors \
+    --relative-paths
+"""
+import sys
+import os
+import logging
+import argparse
+from collections import Counter
+
+from sandbox.common.dir_walker import iter_files
+from sandbox.common.file_filter import MOVIE_FILTER
+from sandbox.common.external_sort import ExternalSorter, iter_sorted_diff
+
+LOG = None
+
+
+class DiffListingsException(Exception):
+    pass
+
+
+def init_logging():
+    # stdout is used for the diff
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format='%(asctime)s [%(levelname)8s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def read_cli():
+    parser = argparse.ArgumentParser(
+        description='Diff of two sorted listings or a listing and a tree')
+    parser.add_argument('--old', required=True,
+                        help='Sorted listing, one name per line')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--new', help='Sorted listing, one name per line')
+    group.add_argument('--dir', help='Directory tree to compare with --old')
+    parser.add_argument('--relative-paths', action='store_true',
+                        help=('List the movie files with paths relative to '
+                              '--dir and compare stripped names (like '
+                              'movie_names_to_file.py), by default the base '
+                              'names of all files (like '
+                              'get_file_names_from_nested_dir.py)'))
+    parser.add_argument('--memory-limit', type=int, default=256,
+                        metavar='MB',
+                        help='Memory for sorting --dir, the rest is spilled '
+                             'to temp files')
+    parser.add_argument('--out-file', help='Where to write the diff, by '
+                                           'default stdout')
+    args = parser.parse_args()
+    for fname in (args.old, args.new):
+        if fname and not os.path.isfile(fname):
+            parser.error('Not a file: %s' % fname)
+
+    if args.dir and not os.path.isdir(args.dir):
+        parser.error('Not a dir: %s' % args.dir)
+
+    return args
+
+
+def read_listing(fname, strip=False):
+    """
+    :param strip: strip the white space of the lines (movie_names_to_file.py
+    reads its listing this way)
+    :return generator: the (non-empty) lines of a sorted listing
+    """
+    prev_name = None
+    with open(fname, errors='surrogateescape') as fin:
+        for line_number, line in enumerate(fin, 1):
+            name = line.strip() if strip else line.rstrip('\n')
+            if not name:
+                continue
+
+            # the merge needs sorted input
+            if prev_name is not None and name < prev_name:
+                raise DiffListingsException(
+                    'Not sorted: %s line %s' % (fname, line_number))
+
+            prev_name = name
+            yield name
+
+
+def iter_tree_names(dir_name, relative_paths, sorter):
+    """
+    :param relative_paths: the relative paths of the movie files (see
+    sandbox.common.file_filter.MOVIE_FILTER), else the base names of all
+    files
+    :param sorter: ExternalSorter, filled with the names
+    :return iterable: the sorted names of the files in dir_name
+    """
+    prefix_len = len(os.path.join(dir_name, ''))
+    if not relative_paths:
+        for entry in iter_files(dir_name, include=lambda e: e.is_file()):
+            sorter.add(entry.name)
+    else:
+        for entry in iter_files(dir_name, include=MOVIE_FILTER):
+            name = entry.path[prefix_len:].strip()
+            if name:
+                sorter.add(name)
+
+    LOG.info('Tree listed (spilled runs: %s)', sorter.count_runs)
+    return sorter
+
+
+def write_diff(old_names, new_names, fout):
+    """
+    :return Counter: "-" and "+" counts
+    """
+    counts = Counter()
+    for sign, name in iter_sorted_diff(old_names, new_names):
+        fout.write('%s %s\n' % (sign, name))
+        counts[sign] += 1
+
+    return counts
+
+
+def run():
+    args = read_cli()
+    init_logging()
+    global LOG
+    LOG = logging.getLogger(__name__)
+    with ExternalSorter(args.memory_limit * 1024 * 1024) as sorter:
+        if args.dir:
+            LOG.info('Listing dir: %s', args.dir)
+            new_names = iter_tree_names(args.dir, args.relative_paths,
+                                        sorter)
+        else:
+            new_names = read_listing(args.new, args.relative_paths)
+
+        fout = open(args.out_file, 'w', errors='surrogateescape') \
+            if args.out_file else sys.stdout
+        try:
+            counts = write_diff(read_listing(args.old, args.relative_paths),
+                                new_names, fout)
+        except DiffListingsException as ex:
+            LOG.error('%s', ex)
+            sys.exit(1)
+        finally:
+            if fout is not sys.stdout:
+                fout.close()
+
+    LOG.info('Removed: %s, added: %s', counts['-'], counts['+'])
+
+
+if __name__ == '__main__':
+    run()
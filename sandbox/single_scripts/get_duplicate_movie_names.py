@@ -6,19 +6,58 @@ get some statistics and get list of sorted movies.
 (by default will skip most non-movie files such as srt, png...)
 This list has to be reviewed manually for duplicates
 (movie names can have different formats)
+With --fuzzy the titles are normalized (release tags, resolution, codec
+are removed, the year is extracted) and similar titles are grouped in
+candidate duplicate clusters with similarity scores.
+With --by-content files with equal content (whatever their names) are
+found: by size, then by a few sampled chunks, then by full hash.
+With --dedupe the found duplicates are replaced with hardlinks/reflinks
+to the first file of their group (undo: python -m sandbox.common.dedupe).
 """
+import re
 import json
 import sys
 import os
 import logging
 import argparse
 from collections import namedtuple, defaultdict
+from contextlib import contextmanager
 import time
 
+from sandbox.common.dir_walker import iter_dirs
+from sandbox.common.file_filter import FileFilter
+from sandbox.common.file_catalog import open_catalog
+from sandbox.common.path_store import PathStore
+from sandbox.common.minhash import shingles, find_similar_groups
+from sandbox.common.hashing import ALGORITHMS, HashStats, hash_files
+from sandbox.common.dedupe import MODES as DEDUPE_MODES, dedupe_files
+
 LOG = None
 
 Args = namedtuple('Args', ['input_dir', 'write_to_files',
-                           'output_dir', 'exclude_extensions'])
+                           'output_dir', 'exclude_extensions',
+                           'fuzzy_threshold', 'jsonl', 'by_content',
+                           'hash_algorithm', 'jobs', 'dedupe',
+                           'dedupe_journal', 'dry_run', 'catalog',
+                           'rescan'])
+
+RELEASE_TAGS = {
+    '4k', 'uhd', 'hd', 'sd', 'hdr', 'hdr10', 'dv', 'sdr', 'imax',
+    'bluray', 'bdrip', 'brrip', 'bdremux', 'remux', 'web', 'webrip', 'webdl',
+    'dl', 'hdtv', 'hdrip', 'dvdrip', 'dvdscr', 'dvd', 'dvd5', 'dvd9', 'cam',
+    'ts', 'tc', 'r5', 'xvid', 'divx', 'hevc', 'avc', 'aac', 'ac3', 'dts',
+    'ddp', 'dd', 'atmos', 'truehd', 'flac', 'mp3', 'proper', 'repack',
+    'extended', 'unrated', 'remastered', 'limited', 'internal', 'multi',
+    'dubbed', 'subbed', 'yts', 'yify', 'rarbg', 'eng', 'bg', 'sub', 'subs',
+}
+# resolution, codec, bit depth, audio codec with channels (e.g. 1080p,
+# x264, 10bit, ddp5 of "DDP5.1"), a bare digit is not a tag ("Toy.Story.2")
+RELEASE_TAG_RE = re.compile(
+    r'^(\d{3,4}[pi]|[xh]26[45]|\d{1,2}bit|(aac|ac3|ddp?|dts|truehd)\d)$')
+YEAR_RE = re.compile(r'^(19|20)\d\d$')
+SEPARATORS_RE = re.compile(r'[\W_]+')
+# chunks hashed per file before a full hash, spread from the start to the end
+CONTENT_SAMPLES = 4
 
 
 def is_ascii(str_val):
@@ -44,8 +83,18 @@ def run():
     args = sanitize_args(args)
     init_logging()
     LOG.info('Sanitized args: %s', args)
-    sort_names(args)
-    sort_by_fname_and_parent_dirname(args)
+    catalog = build_catalog(args)
+    sort_names(catalog, args)
+    sort_by_fname_and_parent_dirname(catalog, args)
+    if args.fuzzy_threshold:
+        find_fuzzy_duplicates(catalog, args)
+    if args.by_content:
+        duplicates = find_content_duplicates(catalog, args)
+        if args.dedupe:
+            stats = dedupe_files((item['files'] for item in duplicates),
+                                 args.dedupe, args.dedupe_journal,
+                                 args.dry_run)
+            LOG.info('Dedupe (%s): %s', args.dedupe, stats)
 
 
 def init_logging():
@@ -71,10 +120,41 @@ def read_cli():
     args.add_argument('--output-dir',
                       help='Where to write files (Used for --write-to-files)')
     args.add_argument('--write-to-files', action='store_true',
-                      help='Save processing results to files')
+                      help='Save processing results to files (by default '
+                           'they are written to stdout)')
+    args.add_argument('--by-content', action='store_true',
+                      help='Find files with equal content (any names)')
+    args.add_argument('--hash-algorithm', choices=ALGORITHMS,
+                      default='blake2b', help='Used for --by-content')
+    args.add_argument('--jobs', type=int, default=1,
+                      help='Number of threads hashing the files (Used for '
+                           '--by-content)')
+    args.add_argument('--dedupe', choices=DEDUPE_MODES,
+                      help='Replace the duplicates by content with links to '
+                           'the first file of their group (Used for '
+                           '--by-content)')
+    args.add_argument('--dedupe-journal',
+                      help='Where to write the undo journal (Used for '
+                           '--dedupe)')
+    args.add_argument('--dry-run', action='store_true',
+                      help='Only log what --dedupe would do')
+    args.add_argument('--catalog',
+                      help='Scan the input dir once into this catalog file '
+                           'and use it in the next runs (instead of walking '
+                           'the dir)')
+    args.add_argument('--rescan', action='store_true',
+                      help='Scan the input dir again (Used for --catalog)')
+    args.add_argument('--jsonl', action='store_true',
+                      help='Write the results as compact JSON lines (one '
+                           'item per line)')
     args.add_argument('--exclude-extensions',
                       default='srt,nfo,sub,rar,txt,idx,jpg,zip,png',
                       help='Files with those extensions are skipped')
+    args.add_argument('--fuzzy', action='store_true',
+                      help='Group files with similar normalized titles')
+    args.add_argument('--fuzzy-threshold', type=float, default=0.5,
+                      help='Minimal similarity (0 - 1) of the titles in a '
+                           'group (Used for --fuzzy)')
     args = args.parse_args()
     return args
 
@@ -101,132 +181,405 @@ def sanitize_args(args):
         temp_extensions.add(ext)
     
     exclude_extensions = sorted(temp_extensions)
-    return Args(input_dir, write_to_files, output_dir, exclude_extensions)
+    fuzzy_threshold = None
+    if args.fuzzy:
+        if not 0 < args.fuzzy_threshold <= 1:
+            fail('Fuzzy threshold must be in (0, 1]')
 
+        fuzzy_threshold = args.fuzzy_threshold
 
-def sort_names(args):
-    skipped_files = []
-    non_skipped_files = []
-    for fname in traverse_dir(args.input_dir):
-        if skip_file(fname, args):
-            skipped_files.append(fname)
-        else:            
-            non_skipped_files.append(fname)
-    
-    skipped_files = sorted(skipped_files)
-    non_skipped_files = sorted(non_skipped_files)
-    
-    skipped_count = len(skipped_files)
-    skipped_json = json.dumps(skipped_files, indent=4)
-    non_skipped_count = len(non_skipped_files)
-    non_skipped_json = json.dumps(non_skipped_files, indent=4)
-    LOG.info('Skipped files (%s):\n%s', skipped_count, skipped_json)
-    LOG.info('Non-skipped files (%s):\n%s', non_skipped_count, non_skipped_json)
-    if args.write_to_files:
-        output_dir = args.output_dir
-        fname = 'skipped files (%s)' % skipped_count
-        write_to_file(fname, output_dir, skipped_json)
-        fname = 'non-skipped files (%s)' % non_skipped_count
-        write_to_file(fname, output_dir, non_skipped_json)
-        
+    if args.dedupe:
+        if not args.by_content:
+            fail('--dedupe needs --by-content')
+        if not args.dry_run and not args.dedupe_journal:
+            fail('--dedupe needs --dedupe-journal')
+
+    return Args(input_dir, write_to_files, output_dir, exclude_extensions,
+                fuzzy_threshold, bool(args.jsonl), bool(args.by_content),
+                args.hash_algorithm, args.jobs, args.dedupe,
+                args.dedupe_journal, bool(args.dry_run), args.catalog,
+                bool(args.rescan))
+
+
+class FileRecord:
+    """
+    File found in the input dir. The directories are kept once in the
+    PathStore of the catalog (instead of one abs path string per file).
+    """
+    __slots__ = ('file_name', 'dir_id', 'size', 'paths')
+
+    def __init__(self, file_name, dir_id, paths, size=None):
+        self.file_name = file_name
+        self.dir_id = dir_id
+        self.paths = paths
+        # for --by-content
+        self.size = size
+
+    @property
+    def dir_path(self):
+        return self.paths.dir_path(self.dir_id)
 
-def traverse_dir(dir_name):
+    @property
+    def parent_dir(self):
+        return self.paths.dir_name(self.dir_id)
+
+    @property
+    def abs_path(self):
+        return self.paths.join(self.dir_id, self.file_name)
+
+    def to_dict(self):
+        return {
+            'file_name': self.file_name,
+            'parent_dir': self.parent_dir,
+            'abs_path': self.abs_path
+        }
+
+
+class Catalog:
+
+    def __init__(self):
+        # the dirs of the files
+        self.paths = PathStore()
+        # FileRecord objects
+        self.files = []
+        self.skipped_files = []
+
+
+def build_catalog(args):
+    """
+    Scan the input dir once, the catalog is used by all reports.
+
+    :return Catalog:
+    """
+    dir_name = args.input_dir
     if not os.path.isdir(dir_name):
         fail('Not directory: %s' % dir_name)
-        
-    for fname in os.listdir(dir_name):
-        fname = os.path.join(dir_name, fname)
-        if os.path.isdir(fname):
-            for fname in traverse_dir(fname):
-                yield fname
+
+    file_filter = FileFilter(exclude_extensions=args.exclude_extensions)
+    catalog = Catalog()
+    for dir_path, file_name, size in iter_input_files(args):
+        # the top dir can end with a separator, it is ignored
+        dir_id = catalog.paths.add_dir(dir_path)
+        record = FileRecord(file_name, dir_id, catalog.paths, size)
+        if file_filter.match_name(file_name):
+            catalog.files.append(record)
         else:
-            yield fname
+            catalog.skipped_files.append(record)
 
+    LOG.info('Files found: %s (skipped: %s, dirs: %s)',
+             len(catalog.files) + len(catalog.skipped_files),
+             len(catalog.skipped_files), catalog.paths.count_dirs)
+    return catalog
+
+
+def iter_input_files(args):
+    """
+    :return generator: (dir path, file name, size) of the files in the input
+    dir, walked or from the --catalog file, the size is None if not needed
+    """
+    if args.catalog:
+        # the sizes of files rewritten in place would be stale
+        with open_catalog(args.catalog, args.input_dir, args.rescan,
+                          check_files=args.by_content) as file_catalog:
+            for dir_path, file_name, size, _ in file_catalog.iter_files():
+                yield dir_path, file_name, size
+        return
+
+    for dir_path, _, file_entries in iter_dirs(args.input_dir):
+        for entry in file_entries:
+            size = entry.stat().st_size if args.by_content else None
+            yield dir_path, entry.name, size
+
+
+def sort_names(catalog, args):
+    skipped_count = write_list_report(
+        'skipped files (%s)' % len(catalog.skipped_files),
+        sorted(record.abs_path for record in catalog.skipped_files), args)
+    non_skipped_count = write_list_report(
+        'non-skipped files (%s)' % len(catalog.files),
+        sorted(record.abs_path for record in catalog.files), args)
+    LOG.info('Skipped files: %s', skipped_count)
+    LOG.info('Non-skipped files: %s', non_skipped_count)
+
+
+@contextmanager
+def open_report(file_name, args):
+    """
+    :return context manager: file object, to which the report is written,
+    stdout if the results are not written to files
+    """
+    if not args.write_to_files:
+        print('%s:' % file_name)
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+
+    if args.jsonl:
+        file_name = '%s.jsonl' % file_name
+    if args.output_dir:
+        file_name = os.path.join(args.output_dir, file_name)
 
-def write_to_file(file_name, output_dir, data):
-    if output_dir:
-        file_name = os.path.join(output_dir, file_name)
-    
     with open(file_name, 'w') as fout:
-        fout.write(data)
-        fout.write('\n')
+        yield fout
 
     LOG.info('Data written to: %s', os.path.abspath(file_name))
 
 
-def skip_file(fname, args):
-    for ext in args.exclude_extensions:
-        if fname.endswith(ext):
-            return True
-    
-    return False
+def _write_json_items(fout, items, jsonl, start='[', end=']',
+                      format_item=json.dumps):
+    """
+    Write the items one by one, so the whole report is never in memory.
+
+    :param jsonl: write every item as compact JSON on a separate line
+    :param start: "[" or "{" (used if not jsonl)
+    :param end: "]" or "}" (used if not jsonl)
+    :param format_item: callable(item, indent) -> str (used if not jsonl)
+    :return int: count of the written items
+    """
+    count = 0
+    for item in items:
+        if jsonl:
+            fout.write(json.dumps(item))
+            fout.write('\n')
+        else:
+            fout.write(',\n    ' if count else '%s\n    ' % start)
+            # same layout as json.dumps(all items, indent=4)
+            fout.write(format_item(item, indent=4).replace('\n', '\n    '))
+        count += 1
+
+    if not jsonl:
+        fout.write('\n%s\n' % end if count else '%s%s\n' % (start, end))
+
+    return count
+
+
+def _format_member(item, indent):
+    key, value = item
+    return '%s: %s' % (json.dumps(key), json.dumps(value, indent=indent))
+
+
+def write_list_report(file_name, items, args):
+    """
+    :param items: iterable (e.g. generator) of JSON serializable values
+    :return int: count of the written items
+    """
+    with open_report(file_name, args) as fout:
+        return _write_json_items(fout, items, args.jsonl)
+
 
+def write_dict_report(file_name, items, args):
+    """
+    :param items: iterable of (key, value), written as JSON object (as
+    {key: value} lines for --jsonl)
+    :return int: count of the written items
+    """
+    if args.jsonl:
+        items = ({key: value} for key, value in items)
 
-def sort_by_fname_and_parent_dirname(args):
-    items = []
+    with open_report(file_name, args) as fout:
+        return _write_json_items(fout, items, args.jsonl, '{', '}',
+                                 _format_member)
+
+
+def sort_by_fname_and_parent_dirname(catalog, args):
+    items = catalog.files
     non_ascii = []
     dups_by_fname = defaultdict(list)
     dups_by_parent_dir = defaultdict(list)
-    for fname in traverse_dir(args.input_dir):
-        if skip_file(fname, args):
-            continue
-        
-        base_name = os.path.basename(fname)
-        parent_dir = os.path.basename(os.path.dirname(fname))
-        obj = {
-            'file_name': base_name,
-            'parent_dir': parent_dir,
-            'abs_path': fname
-        }
-        items.append(obj)
-        if not is_ascii(base_name) or not is_ascii(parent_dir):
-            non_ascii.append(obj)
+    for record in items:
+        if not is_ascii(record.file_name) or not is_ascii(record.parent_dir):
+            non_ascii.append(record)
             
-        dups_by_fname[base_name].append(fname)
-        dups_by_parent_dir[parent_dir].append(fname)
+        dups_by_fname[record.file_name].append(record)
+        dups_by_parent_dir[record.parent_dir].append(record)
         
-    dups_by_fname = {
-        base_name: dups
-        for base_name, dups in dups_by_fname.items() if len(dups) > 1
-    }
-    dups_by_parent_dir = {
-        parent_dir: dups
-        for parent_dir, dups in dups_by_parent_dir.items() if len(dups) > 1
-    }
-    
     LOG.info('Files processed: %s', len(items))
-    by_fname = sorted(
-        '%s --- %s' % (obj['file_name'], obj['abs_path']) 
-        for obj in items
-    )
-    by_parent_dir = sorted(
-        '%s --- %s' % (obj['parent_dir'], obj['abs_path'])
-        for obj in items
-    )
-    non_ascii = sorted(non_ascii, key=lambda x: obj['file_name'])
-    by_fname = json.dumps(by_fname, indent=4)
-    by_parent_dir = json.dumps(by_parent_dir, indent=4)
-    non_ascii = json.dumps(non_ascii, indent=4)
-    dups_by_fname = json.dumps(dups_by_fname, indent=4, sort_keys=True)
-    dups_by_parent_dir = json.dumps(dups_by_parent_dir, indent=4, sort_keys=True)
-    LOG.info('Sorted by base file name:\n%s', by_fname)
-    LOG.info('Sorted by base parent dirname:\n%s', by_parent_dir)
-    LOG.info('Non-ASCII:\n%s', non_ascii)
-    LOG.info('Duplicates by base file name:\n%s', dups_by_fname)
-    LOG.info('Duplicates by base parent dirname:\n%s', dups_by_parent_dir)
-    if args.write_to_files:
-        output_dir = args.output_dir
-        fname = 'sorted by base file name'
-        write_to_file(fname, output_dir, by_fname)
-        fname = 'sorted by base parent dirname'
-        write_to_file(fname, output_dir, by_parent_dir)
-        fname = 'non-ascii'
-        write_to_file(fname, output_dir, non_ascii)
-        fname = 'duplicates by base file name'
-        write_to_file(fname, output_dir, dups_by_fname)
-        fname = 'duplicates by base parent dirname'
-        write_to_file(fname, output_dir, dups_by_parent_dir)
+    count = write_list_report(
+        'sorted by base file name',
+        sorted('%s --- %s' % (record.file_name, record.abs_path)
+               for record in items),
+        args)
+    LOG.info('Sorted by base file name: %s', count)
+    count = write_list_report(
+        'sorted by base parent dirname',
+        sorted('%s --- %s' % (record.parent_dir, record.abs_path)
+               for record in items),
+        args)
+    LOG.info('Sorted by base parent dirname: %s', count)
+    count = write_list_report(
+        'non-ascii',
+        (record.to_dict()
+         for record in sorted(non_ascii, key=lambda x: x.file_name)),
+        args)
+    LOG.info('Non-ASCII: %s', count)
+    count = write_dict_report('duplicates by base file name',
+                              iter_duplicates(dups_by_fname), args)
+    LOG.info('Duplicates by base file name: %s', count)
+    count = write_dict_report('duplicates by base parent dirname',
+                              iter_duplicates(dups_by_parent_dir), args)
+    LOG.info('Duplicates by base parent dirname: %s', count)
+
+
+def iter_duplicates(records_by_name):
+    """
+    :return generator: (name, abs paths) sorted by name, for the names
+    with more than one file
+    """
+    for name in sorted(records_by_name):
+        records = records_by_name[name]
+        if len(records) > 1:
+            yield name, [record.abs_path for record in records]
+
+
+def normalize_title(file_name):
+    """
+    The title ends at the year or at the first release tag, the year is
+    looked for after the tags too.
+
+    >>> normalize_title('The.Matrix.1999.1080p.BluRay.x264-GRP.mkv')
+    ('the matrix', '1999')
+    >>> normalize_title('Toy.Story.2.1999.1080p.mkv')
+    ('toy story 2', '1999')
+    >>> normalize_title('2.Fast.2.Furious.2003.mkv')
+    ('2 fast 2 furious', '2003')
+    >>> normalize_title('Terminator.2.Extended.1991.DDP5.1.mkv')
+    ('terminator 2', '1991')
+
+    :return tuple: (title, year or None)
+    """
+    name = os.path.splitext(file_name)[0].lower()
+    title_tokens = []
+    title_done = False
+    year = None
+    for token in SEPARATORS_RE.split(name):
+        if not token:
+            continue
+
+        if title_tokens and YEAR_RE.match(token):
+            year = token
+            break
+
+        if title_done:
+            continue
+
+        if token in RELEASE_TAGS or RELEASE_TAG_RE.match(token):
+            # the rest are tags and the release group, "[YTS] Title" has
+            # tags before the title
+            title_done = bool(title_tokens)
+            continue
+
+        title_tokens.append(token)
+
+    return ' '.join(title_tokens), year
+
+
+def find_fuzzy_duplicates(catalog, args):
+    records_by_title = defaultdict(list)
+    for record in catalog.files:
+        title, year = normalize_title(record.file_name)
+        if not title:
+            continue
+
+        if year:
+            title = '%s %s' % (title, year)
+
+        records_by_title[title].append(record)
+
+    groups = find_similar_groups(
+        {title: shingles(title) for title in records_by_title},
+        args.fuzzy_threshold)
+    clusters = []
+    grouped_titles = set()
+    for titles, pairs in groups:
+        grouped_titles.update(titles)
+        clusters.append({
+            'similarity': pairs[0][2],
+            'titles': titles,
+            'pairs': ['%s --- %s (%s)' % pair for pair in pairs],
+            'files': sorted(record.abs_path for title in titles
+                            for record in records_by_title[title])
+        })
+
+    # files with the same normalized title
+    for title, records in records_by_title.items():
+        if len(records) > 1 and title not in grouped_titles:
+            clusters.append({
+                'similarity': 1.0,
+                'titles': [title],
+                'pairs': [],
+                'files': sorted(record.abs_path for record in records)
+            })
+
+    clusters.sort(key=lambda x: (-x['similarity'], x['titles']))
+    write_list_report('fuzzy duplicates', clusters, args)
+    LOG.info('Titles: %s, fuzzy duplicate clusters: %s',
+             len(records_by_title), len(clusters))
+
+
+def split_by_hash(groups, args, count_samples=None):
+    """
+    :param groups: lists of abs file names, which could be duplicates
+    :param count_samples: if provided, only that many chunks of every file
+    are hashed, else the whole files
+    :return list: (hex digest, abs file names) for the files of a group
+    with the same digest (2 or more files)
+    """
+    stats = HashStats()
+    digests = dict(hash_files(
+        (abs_fname for group in groups for abs_fname in group),
+        args.hash_algorithm, args.jobs, stats=stats,
+        count_samples=count_samples))
+    LOG.info('Hashing %s: %s',
+             'samples' if count_samples else 'full files', stats)
+    result = []
+    for group in groups:
+        by_digest = defaultdict(list)
+        for abs_fname in group:
+            by_digest[digests[abs_fname]].append(abs_fname)
+
+        result.extend((digest, abs_fnames)
+                      for digest, abs_fnames in by_digest.items()
+                      if len(abs_fnames) > 1)
+
+    return result
+
+
+def find_content_duplicates(catalog, args):
+    """
+    Staged comparison, every stage reads only the files that could still be
+    duplicates: equal size, then equal hash of CONTENT_SAMPLES chunks, then
+    equal full hash.
+    """
+    by_size = defaultdict(list)
+    for record in catalog.files:
+        by_size[record.size].append(record.abs_path)
+
+    # empty files are equal, but not duplicate movies
+    groups = [sorted(abs_fnames) for size, abs_fnames in by_size.items()
+              if size and len(abs_fnames) > 1]
+    LOG.info('By size: %s candidate files in %s groups',
+             sum(len(group) for group in groups), len(groups))
+    groups = [
+        abs_fnames for _, abs_fnames in
+        split_by_hash(groups, args, count_samples=CONTENT_SAMPLES)
+    ]
+    LOG.info('By sampled chunks: %s candidate files in %s groups',
+             sum(len(group) for group in groups), len(groups))
+    duplicates = [
+        {
+            'size': os.path.getsize(abs_fnames[0]),
+            'digest': digest,
+            'files': abs_fnames
+        }
+        for digest, abs_fnames in split_by_hash(groups, args)
+    ]
+    duplicates.sort(key=lambda x: (-x['size'], x['files']))
+    count = write_list_report('duplicates by content', duplicates, args)
+    LOG.info('Duplicates by content: %s (%s MB wasted)', count,
+             round(sum(item['size'] * (len(item['files']) - 1)
+                       for item in duplicates) / 1000000, 2))
+    return duplicates
+
 
-    
 if __name__ == '__main__':
     run()
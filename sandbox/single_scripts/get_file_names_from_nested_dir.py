@@ -4,6 +4,10 @@ import logging
 import time
 import argparse
 
+from sandbox.common.dir_walker import iter_files
+from sandbox.common.external_sort import ExternalSorter
+from sandbox.common.file_catalog import open_catalog
+
 LOG = None
 
 
@@ -18,19 +22,40 @@ def init_logging():
     logging.basicConfig(handlers=[h], level=logging.INFO)
 
 
-def load_file_names(dir_name, file_names):
-    for item_name in os.listdir(dir_name):
-        item_name = os.path.join(dir_name, item_name)
-        if os.path.isfile(item_name):
-            file_names.add(os.path.basename(item_name))
-        elif os.path.isdir(item_name):
-            load_file_names(item_name, file_names)
+def load_file_names(dir_name, file_names, catalog_fname=None, rescan=False):
+    """
+    :param file_names: set or ExternalSorter
+    :param catalog_fname: file catalog (sandbox.common.file_catalog) of
+    dir_name, used instead of walking the dir
+    """
+    if catalog_fname:
+        with open_catalog(catalog_fname, dir_name, rescan) as catalog:
+            for index in range(len(catalog)):
+                file_names.add(catalog.name(index))
+        return
+
+    for entry in iter_files(dir_name, include=lambda e: e.is_file()):
+        file_names.add(entry.name)
 
 
 def run():
     parser = argparse.ArgumentParser()
     parser.add_argument('--dir-name', required=True)
     parser.add_argument('--out-file', required=True)
+    parser.add_argument(
+        '--memory-limit', type=int, metavar='MB',
+        help=('Keep about that many MB of names in memory, sorted runs of '
+              'names are spilled to temp files and merged at the end (by '
+              'default all names are kept in memory)'))
+    parser.add_argument('--catalog',
+                        help=('Take the names from this catalog file of the '
+                              'dir, the dir is scanned into it if it does '
+                              'not exist'))
+    parser.add_argument('--rescan', action='store_true',
+                        help='Scan the dir again (Used for --catalog)')
+    parser.add_argument('--tmp-dir',
+                        help='Where to spill the runs (Used for '
+                             '--memory-limit)')
     args = parser.parse_args()
     dir_name = args.dir_name
 
@@ -41,12 +66,17 @@ def run():
         raise Exception('%s not existing dir' % dir_name)
 
     LOG.info('Processing dir: %s', dir_name)
-    file_names = set()
-    load_file_names(dir_name, file_names)
-    LOG.info('File names loaded: %s', len(file_names))
-    with open(args.out_file, 'w') as fout:
-        for fname in sorted(file_names):
-            fout.write('%s\n' % fname)
+    memory_limit = args.memory_limit and args.memory_limit * 1024 * 1024
+    with ExternalSorter(memory_limit, args.tmp_dir) as file_names:
+        load_file_names(dir_name, file_names, args.catalog, args.rescan)
+        LOG.info('File names loaded (spilled runs: %s)', file_names.count_runs)
+        count = 0
+        with open(args.out_file, 'w') as fout:
+            for fname in file_names:
+                fout.write('%s\n' % fname)
+                count += 1
+
+    LOG.info('File names written: %s', count)
 
     LOG.info('Output file %s', os.path.abspath(args.out_file))
 
@@ -14,10 +14,35 @@ what's new.
         - or same hash but different size (to avoid possible hash collisions)
 """
 import os
+import json
+import array
 import argparse
-import hashlib
-import shutil
 from datetime import datetime
+from itertools import islice
+from collections import defaultdict, Counter
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from sandbox.common.dir_walker import iter_files
+from sandbox.common.hash_index import HashIndex, DEFAULT_INDEX_NAME
+from sandbox.common.hashing import (
+    ALGORITHMS, HashStats, hash_files)
+from sandbox.common.file_copy import copy_files
+from sandbox.common.dedupe import MODES as DEDUPE_MODES, dedupe_files
+from sandbox.common.digest_map import DigestMapBuilder
+from sandbox.common.merkle import MerkleSnapshot, diff_contents
+from sandbox.common.path_store import PathStore
+from sandbox.common.perceptual_hash import (
+    HASH_FUNCTIONS, BKTree, PerceptualHashException, is_image_file,
+    check_image_libs, has_heif_decoder)
+
+BACKED_UP_SNAPSHOT_NAME = '.merkle_snapshot.json'
+IPHONE_SNAPSHOT_NAME = '.iphone_merkle_snapshot.json'
+# result of the last --diff, to compare only the dirs changed since it
+CONTENT_DIFF_NAME = '.iphone_content_diff.json'
+CONTENT_DIFF_VERSION = 1
+# files stat-ed and hashed at a time when building a DigestMap
+HASH_CHUNK_SIZE = 1024
 
 
 def read_cli_args():
@@ -35,6 +60,57 @@ def read_cli_args():
     parser.add_argument('--backed-up-files-dir', required=True)
     parser.add_argument('--new-files-dir', required=True)
     parser.add_argument('--ask-to-copy-files', action='store_true')
+    parser.add_argument(
+        '--no-hash-index', action='store_true',
+        help=('Do not use/update the index with the hashes of the backed-up '
+              'files ("%s" in the backed-up files dir)' % DEFAULT_INDEX_NAME)
+    )
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of threads hashing/copying the files')
+    parser.add_argument(
+        '--diff', action='store_true',
+        help=('Only list the dirs with files, which content is not in the '
+              'other tree (iPhone DCIM dir or backed-up files dir, any file '
+              'name or dir). Uses Merkle tree snapshots '
+              '("%s" in the backed-up files dir and "%s" in the new files '
+              'dir), so only new or modified files are hashed (the digests '
+              'in the hash index are reused), and the result of the last '
+              'comparison ("%s" in the new files dir), so only the dirs '
+              'changed since it are compared' %
+              (BACKED_UP_SNAPSHOT_NAME, IPHONE_SNAPSHOT_NAME,
+               CONTENT_DIFF_NAME))
+    )
+    parser.add_argument(
+        '--near-duplicates', type=int, metavar='MAX_DISTANCE',
+        help=('Do not copy new images, which are near-duplicates (e.g. '
+              'resized or re-encoded) of backed-up images: perceptual hashes '
+              'with Hamming distance up to MAX_DISTANCE (of 64 bits, e.g. 5). '
+              'Needs numpy and Pillow')
+    )
+    parser.add_argument('--perceptual-hash', choices=sorted(HASH_FUNCTIONS),
+                        default='dhash')
+    parser.add_argument(
+        '--verify-copies', action='store_true',
+        help=('Hash the new files while copying them and compare with the '
+              'source hash (without it the files are copied by the kernel '
+              'when possible)')
+    )
+    parser.add_argument(
+        '--dedupe-backed-up', choices=DEDUPE_MODES,
+        help=('Replace the backed-up files found to be duplicates (while '
+              'comparing with the iPhone files) with links to one copy, '
+              'undo: python -m sandbox.common.dedupe --undo JOURNAL')
+    )
+    parser.add_argument('--dedupe-journal',
+                        help='Undo journal for --dedupe-backed-up')
+    parser.add_argument('--use-processes', action='store_true',
+                        help=('Hash with --jobs processes instead of threads '
+                              '(faster for many small files)'))
+    parser.add_argument(
+        '--hash-algorithm', choices=ALGORITHMS, default='sha1',
+        help=('blake2b is the fastest on 64-bit CPUs, sha1 is kept for '
+              'compatibility with the existing hash indexes')
+    )
     return parser.parse_args()
 
     
@@ -52,73 +128,485 @@ def validate_cli_args(args):
         if not os.path.isdir(t[0]):
             raise Exception('Not a dir: %s' % t[1])
 
+    if args.dedupe_backed_up and not args.dedupe_journal:
+        raise Exception('--dedupe-backed-up needs --dedupe-journal')
+
+    if args.near_duplicates is not None:
+        # fail before the (long) comparison if numpy or Pillow is missing
+        check_image_libs()
+        if not has_heif_decoder():
+            print('WARNING: no HEIC/HEIF decoder, --near-duplicates skips '
+                  'the .heic images (the iPhone default), to include them: '
+                  'pip install pillow-heif')
+
+
+def read_file_names(cur_dir, fnames, exclude=None):
+    """
+    :param fnames: list or PathStore, the abs file names are added to it
+    :param exclude: callable(abs file name) -> bool, files for which it
+    returns True are skipped
+    """
+    fnames.extend(
+        entry.path for entry in iter_files(cur_dir)
+        if exclude is None or not exclude(entry.path)
+    )
+
+
+def stat_files(abs_fnames):
+    """
+    :return dict: abs file name -> os.stat_result
+    """
+    return {abs_fname: os.stat(abs_fname) for abs_fname in abs_fnames}
+
+
+def get_file_sizes(abs_fnames):
+    """
+    The files are stat-ed one by one and only their sizes are kept.
+
+    :return array: the sizes, in the order of abs_fnames
+    """
+    return array.array(
+        'Q', (os.stat(abs_fname).st_size for abs_fname in abs_fnames))
+
 
-def read_file_names(cur_dir, fnames):
-    for fname in os.listdir(cur_dir):
-        fname = os.path.join(cur_dir, fname)
-        if os.path.isdir(fname):
-            read_file_names(fname, fnames)
+def calculate_hash_per_file(abs_fnames, hash_index=None, algorithm='sha1',
+                            jobs=None, use_processes=False, duplicates=None):
+    """
+    The files are stat-ed and hashed in chunks (HASH_CHUNK_SIZE) and their
+    digests are added straight to a DigestMapBuilder, so only the data of
+    one chunk is kept besides the compact map.
+
+    :param hash_index: HashIndex, if provided the hashes of the unchanged
+    files are taken from it and the calculated ones are added to it
+    :param algorithm: one of sandbox.common.hashing.ALGORITHMS
+    :param jobs: number of threads (or processes) hashing the files
+    :param duplicates: list, if provided it is extended with the groups
+    (lists of abs file names, the kept file first) of files with same hash
+    :return DigestMap: hash -> (size, abs file name), for files with the
+    same hash only the first one is kept
+    """
+    builder = DigestMapBuilder()
+    stats = HashStats()
+    abs_fnames = iter(abs_fnames)
+    while True:
+        chunk = list(islice(abs_fnames, HASH_CHUNK_SIZE))
+        if not chunk:
+            break
+
+        stat_results = stat_files(chunk)
+        file_hashes = {}
+        not_indexed_fnames = []
+        for abs_fname in chunk:
+            file_hash = hash_index and hash_index.get(
+                abs_fname, stat_results[abs_fname], algorithm)
+            if file_hash:
+                file_hashes[abs_fname] = file_hash
+            else:
+                not_indexed_fnames.append(abs_fname)
+
+        for abs_fname, file_hash in hash_files(
+                not_indexed_fnames, algorithm, jobs, use_processes, stats):
+            file_hashes[abs_fname] = file_hash
+            if hash_index:
+                hash_index.set(abs_fname, stat_results[abs_fname], file_hash,
+                               algorithm)
+
+        # in the order of abs_fnames, the first file of a hash is kept
+        for abs_fname in chunk:
+            builder.add(file_hashes[abs_fname],
+                        stat_results[abs_fname].st_size, abs_fname)
+
+    print('Hashing: %s' % stats)
+    duplicates_by_hash = defaultdict(list)
+
+    def print_duplicate(file_hash, size, abs_fname):
+        item = {'abs_name': abs_fname, 'size': size}
+        print('DUPLICATE BY HASH IN SAME MASTER DIR: %s' % item)
+        duplicates_by_hash[file_hash].append(abs_fname)
+
+    digest_map = builder.build(on_duplicate=print_duplicate)
+    if duplicates is not None:
+        duplicates.extend(
+            [digest_map.get(file_hash)[1]] + abs_fnames
+            for file_hash, abs_fnames in duplicates_by_hash.items()
+        )
+
+    return digest_map
+
+
+def calculate_sample_hash_per_file(abs_fnames, algorithm='sha1', jobs=None,
+                                   use_processes=False):
+    """
+    :return dict: abs file name -> hash of the head and the tail of the file
+    """
+    stats = HashStats()
+    sample_hashes = dict(hash_files(abs_fnames, algorithm, jobs,
+                                    use_processes, stats, count_samples=2))
+    print('Hashing samples: %s' % stats)
+    return sample_hashes
+
+
+def find_new_file_names(backed_fnames, backed_sizes, iphone_fnames,
+                        iphone_sizes, hash_index=None, known_hashes=None,
+                        backed_duplicates=None, **hash_kwargs):
+    """
+    Staged comparison, every stage reads only the files that could still be
+    duplicates (of a backed-up file or of another iPhone file):
+        1. iPhone files with size not found in the backed-up files and in
+        the other iPhone files are new
+        2. of the rest, files with head+tail hash not found in the backed-up
+        files and in the other iPhone files (with the same size) are new
+        3. the rest are compared by full hash, only the first of the iPhone
+        files with the same hash is kept
+    The backed-up files with a valid digest in the hash index skip stage 2.
+    The files are referred to by their positions in the lists, only the
+    names of the files still compared are built.
+
+    :param backed_fnames: PathStore (or list), the abs names of the
+    backed-up files
+    :param backed_sizes: array, the sizes of backed_fnames (see
+    get_file_sizes())
+    :param iphone_fnames: PathStore (or list), the abs names of the iPhone
+    files
+    :param iphone_sizes: array, the sizes of iphone_fnames
+    :param known_hashes: dict, if provided it is updated with abs file name
+    -> full hash of the iPhone files, which were fully hashed
+    :param backed_duplicates: list, if provided it is extended with the
+    groups of backed-up files with the same full hash (see
+    calculate_hash_per_file())
+    :param hash_kwargs: passed to calculate_hash_per_file()
+    :return list: the new iPhone files, in the order of iphone_fnames
+    """
+    new_ids = array.array('I')
+
+    def new_file_names():
+        return [iphone_fnames[file_id] for file_id in sorted(new_ids)]
+
+    backed_size_set = set(backed_sizes)
+    iphone_size_counts = Counter(iphone_sizes)
+    candidate_ids = array.array('I')
+    for file_id, size in enumerate(iphone_sizes):
+        if size in backed_size_set or iphone_size_counts[size] > 1:
+            candidate_ids.append(file_id)
         else:
-            fnames.append(fname)
-
-
-def get_file_hash(abs_fname):
-    block_size = 65536  # read in 64kb blocks
-    hash_algo = hashlib.sha1()
-    with open(abs_fname, 'rb') as fin:
-        while True:
-            data = fin.read(block_size)
-            if not data:
-                break
-            hash_algo.update(data)
-    
-    return hash_algo.hexdigest()
-
-
-def calculate_hash_per_file(abs_fnames):
-    hash_data_map = {}
-    for abs_fname in abs_fnames:
-        file_hash = get_file_hash(abs_fname)
-        item = {
-            'abs_name': abs_fname,
-            # 'base_name': os.path.basename(abs_fname),
-            'size': os.path.getsize(abs_fname)  # in bytes
-        }
-        if file_hash in hash_data_map:
-            print('DUPLICATE BY HASH IN SAME MASTER DIR: %s' % item)
+            new_ids.append(file_id)
+
+    # one entry per distinct size of the whole trees
+    del backed_size_set, iphone_size_counts
+    print('By size: %s new, %s candidates' % (len(new_ids),
+                                              len(candidate_ids)))
+    if not candidate_ids:
+        return new_file_names()
+
+    candidate_sizes = {iphone_sizes[file_id] for file_id in candidate_ids}
+    algorithm = hash_kwargs.get('algorithm', 'sha1')
+    indexed_backed_ids = array.array('I')
+    backed_candidate_ids = array.array('I')
+    for file_id, size in enumerate(backed_sizes):
+        if size not in candidate_sizes:
             continue
-         
-        hash_data_map[file_hash] = item
 
-    return hash_data_map 
+        abs_fname = backed_fnames[file_id]
+        if hash_index and hash_index.contains(abs_fname, os.stat(abs_fname),
+                                              algorithm):
+            indexed_backed_ids.append(file_id)
+        else:
+            backed_candidate_ids.append(file_id)
+
+    candidate_fnames = [iphone_fnames[file_id] for file_id in candidate_ids]
+    backed_candidate_fnames = [backed_fnames[file_id]
+                               for file_id in backed_candidate_ids]
+    iphone_samples = calculate_sample_hash_per_file(candidate_fnames,
+                                                    **hash_kwargs)
+    backed_samples = calculate_sample_hash_per_file(backed_candidate_fnames,
+                                                    **hash_kwargs)
+    backed_keys = {
+        (backed_sizes[file_id], backed_samples[abs_fname])
+        for file_id, abs_fname in zip(backed_candidate_ids,
+                                      backed_candidate_fnames)
+    }
+    indexed_sizes = {backed_sizes[file_id] for file_id in indexed_backed_ids}
+    iphone_keys = [
+        (iphone_sizes[file_id], iphone_samples[abs_fname])
+        for file_id, abs_fname in zip(candidate_ids, candidate_fnames)
+    ]
+    iphone_key_counts = Counter(iphone_keys)
+    remaining_ids = array.array('I')
+    remaining_keys = set()
+    count_new = len(new_ids)
+    for file_id, key in zip(candidate_ids, iphone_keys):
+        if key in backed_keys or key[0] in indexed_sizes or \
+                iphone_key_counts[key] > 1:
+            remaining_ids.append(file_id)
+            remaining_keys.add(key)
+        else:
+            new_ids.append(file_id)
+
+    print('By head+tail hash: %s new, %s candidates' %
+          (len(new_ids) - count_new, len(remaining_ids)))
+    if not remaining_ids:
+        return new_file_names()
+
+    remaining_sizes = {size for size, _ in remaining_keys}
+    backed_remaining_fnames = [
+        abs_fname for file_id, abs_fname in zip(backed_candidate_ids,
+                                                backed_candidate_fnames)
+        if (backed_sizes[file_id], backed_samples[abs_fname])
+        in remaining_keys
+    ]
+    backed_remaining_fnames.extend(
+        backed_fnames[file_id] for file_id in indexed_backed_ids
+        if backed_sizes[file_id] in remaining_sizes
+    )
+    print('Generating full hashes for %s backed-up files' %
+          len(backed_remaining_fnames))
+    backed_hash_data_map = calculate_hash_per_file(
+        backed_remaining_fnames, hash_index, duplicates=backed_duplicates,
+        **hash_kwargs)
+    remaining_fnames = [iphone_fnames[file_id] for file_id in remaining_ids]
+    print('Generating full hashes for %s iPhone files' %
+          len(remaining_fnames))
+    iphone_hash_data_map = calculate_hash_per_file(
+        remaining_fnames, **hash_kwargs)
+    if known_hashes is not None:
+        known_hashes.update(
+            (abs_fname, file_hash)
+            for file_hash, _, abs_fname in iphone_hash_data_map.items()
+        )
+
+    remaining_ids_by_fname = dict(zip(remaining_fnames, remaining_ids))
+    new_ids.extend(
+        remaining_ids_by_fname[abs_fname] for abs_fname in
+        get_new_file_names(backed_hash_data_map, iphone_hash_data_map))
+    return new_file_names()
 
 
 def get_new_file_names(backed_hash_data_map, iphone_hash_data_map):
+    """
+    :param backed_hash_data_map: DigestMap
+    :param iphone_hash_data_map: DigestMap
+    """
     new_fnames = []
-    for iphone_hash, iphone_fdata in iphone_hash_data_map.items():
-        iphone_fname = iphone_fdata['abs_name']
-        if iphone_hash not in backed_hash_data_map:
+    for iphone_hash, iphone_size, iphone_fname in \
+            iphone_hash_data_map.items():
+        backed_fdata = backed_hash_data_map.get(iphone_hash)
+        if backed_fdata is None:
             new_fnames.append(iphone_fname)
             continue
         
-        backed_fdata = backed_hash_data_map[iphone_hash]
-        if iphone_fdata['size'] != backed_fdata['size']:
+        backed_size, backed_fname = backed_fdata
+        if iphone_size != backed_size:
             print('SAME HASH, DIFFERENT SIZE, iphone: %s, backed-up: %s' % 
-                  (iphone_fname, backed_fdata['abs_name']))
+                  (iphone_fname, backed_fname))
             new_fnames.append(iphone_fname)
     
     return new_fnames
 
 
-def write_new_files(new_files_dir, new_file_names):
+def get_perceptual_hashes(abs_fnames, hash_name='dhash', hash_index=None,
+                          jobs=None):
+    """
+    :param hash_index: HashIndex, used as cache for the perceptual hashes
+    :return dict: abs file name -> perceptual hash (int) of the images, the
+    images, which can not be read are skipped
+    """
+    hash_func = HASH_FUNCTIONS[hash_name]
+    perceptual_hashes = {}
+    not_indexed_fnames = []
+    for abs_fname in filter(is_image_file, abs_fnames):
+        digest = hash_index and hash_index.get(abs_fname, os.stat(abs_fname),
+                                               hash_name)
+        if digest:
+            perceptual_hashes[abs_fname] = int(digest, 16)
+        else:
+            not_indexed_fnames.append(abs_fname)
+
+    def hash_image(abs_fname):
+        try:
+            return abs_fname, hash_func(abs_fname)
+        except (OSError, PerceptualHashException) as ex:
+            print('Can not hash image %s: %s' % (abs_fname, ex))
+            return abs_fname, None
+
+    with ThreadPoolExecutor(max_workers=max(jobs or 1, 1)) as executor:
+        for abs_fname, hash_value in executor.map(hash_image,
+                                                  not_indexed_fnames):
+            if hash_value is None:
+                continue
+
+            perceptual_hashes[abs_fname] = hash_value
+            if hash_index:
+                hash_index.set(abs_fname, os.stat(abs_fname),
+                               '%x' % hash_value, hash_name)
+
+    return perceptual_hashes
+
+
+def remove_near_duplicates(backed_up_file_names, new_file_names,
+                           max_distance, hash_name='dhash', hash_index=None,
+                           jobs=None):
+    """
+    :return list: new_file_names without the near-duplicates of backed-up
+    images
+    """
+    print('Generating perceptual hashes of the backed-up images')
+    bk_tree = BKTree()
+    for abs_fname, hash_value in get_perceptual_hashes(
+            backed_up_file_names, hash_name, hash_index, jobs).items():
+        bk_tree.add(hash_value, abs_fname)
+
+    print('Backed-up images with different perceptual hashes: %s' %
+          bk_tree.count_hashes)
+    new_hashes = get_perceptual_hashes(new_file_names, hash_name, jobs=jobs)
+    not_duplicates = []
+    for abs_fname in new_file_names:
+        hash_value = new_hashes.get(abs_fname)
+        found = [] if hash_value is None else \
+            bk_tree.search(hash_value, max_distance)
+        if found:
+            distance, backed_fname = found[0]
+            print('NEAR DUPLICATE (distance %s), iphone: %s, backed-up: %s' %
+                  (distance, abs_fname, backed_fname))
+        else:
+            not_duplicates.append(abs_fname)
+
+    print('Near duplicates: %s' %
+          (len(new_file_names) - len(not_duplicates)))
+    return not_duplicates
+
+
+def gen_unique_file_names(abs_fnames):
+    """
+    The DCIM sub-dirs have the same file names, e.g. 100APPLE/IMG_0001.JPG
+    and 101APPLE/IMG_0001.JPG, the next files with a used name get a
+    number: IMG_0001_2.JPG.
+
+    :return list: unique base file names, in the order of abs_fnames
+    """
+    fnames = [os.path.basename(abs_fname) for abs_fname in abs_fnames]
+    used_fnames = set(fnames)
+    seen_fnames = set()
+    unique_fnames = []
+    for fname in fnames:
+        if fname in seen_fnames:
+            root, ext = os.path.splitext(fname)
+            number = 2
+            while '%s_%s%s' % (root, number, ext) in used_fnames:
+                number += 1
+
+            fname = '%s_%s%s' % (root, number, ext)
+            used_fnames.add(fname)
+
+        seen_fnames.add(fname)
+        unique_fnames.append(fname)
+
+    return unique_fnames
+
+
+def write_new_files(new_files_dir, new_file_names, jobs=None,
+                    algorithm=None, known_hashes=None):
+    """
+    :param jobs: number of files copied concurrently
+    :param algorithm: if provided, the copies are verified with that hash
+    algorithm (see sandbox.common.file_copy.copy_file())
+    :param known_hashes: dict abs file name -> hash of the source files
+    """
     print('Writing to "%s"' % new_files_dir)
     os.mkdir(new_files_dir)
-    for src_abs_fname in new_file_names:
-        dest_abs_fname = os.path.join(
-            new_files_dir,
-            os.path.basename(src_abs_fname)
-        )
-        shutil.copy2(src_abs_fname, dest_abs_fname)
+    fname_pairs = (
+        (src_abs_fname, os.path.join(new_files_dir, dest_fname))
+        for src_abs_fname, dest_fname in zip(
+            new_file_names, gen_unique_file_names(new_file_names))
+    )
+    stats = HashStats(action='copied')
+    for _ in copy_files(fname_pairs, jobs, algorithm, known_hashes, stats):
+        pass
+
+    print('Copying: %s%s' % (stats, ', verified' if algorithm else ''))
+
+
+def build_snapshot(top, snapshot_fname, exclude=None, algorithm='sha1',
+                   jobs=None, hash_index=None):
+    """
+    :return tuple: (previous MerkleSnapshot or None, new MerkleSnapshot)
+    """
+    previous = None
+    if os.path.isfile(snapshot_fname):
+        previous = MerkleSnapshot.load(snapshot_fname)
+
+    print('Building Merkle snapshot of "%s"' % top)
+    snapshot = MerkleSnapshot.build(top, algorithm, previous, exclude, jobs,
+                                    hash_index)
+    snapshot.save(snapshot_fname)
+    print('Root digest: %s, snapshot saved to: %s' %
+          (snapshot.root_digest, snapshot_fname))
+    return previous, snapshot
+
+
+def load_content_diff(fname, iphone_previous, backed_previous):
+    """
+    :return tuple: the previous argument of diff_contents() or None, if
+    the last comparison was not of these snapshots
+    """
+    if iphone_previous is None or backed_previous is None or \
+            not os.path.isfile(fname):
+        return None
+
+    with open(fname, encoding='utf-8', errors='surrogateescape') as fin:
+        data = json.load(fin)
+
+    root_digests = [iphone_previous.root_digest, backed_previous.root_digest]
+    if data.get('version') != CONTENT_DIFF_VERSION or \
+            data['root_digests'] != root_digests:
+        return None
+
+    return iphone_previous, backed_previous, tuple(data['missing'])
+
+
+def save_content_diff(fname, iphone_snapshot, backed_snapshot, missing):
+    data = {
+        'version': CONTENT_DIFF_VERSION,
+        'root_digests': [iphone_snapshot.root_digest,
+                         backed_snapshot.root_digest],
+        'missing': missing
+    }
+    with open(fname, 'w', encoding='utf-8',
+              errors='surrogateescape') as fout:
+        json.dump(data, fout, ensure_ascii=False)
+
+
+def diff_trees(iphone_dcim_dir, backed_up_files_dir, new_files_dir,
+               algorithm='sha1', jobs=None, hash_index=None):
+    """
+    :param hash_index: HashIndex of the backed-up files dir, the digests
+    are taken from it for the files not in the previous snapshot
+    """
+
+    def exclude_backed_up(entry):
+        return (entry.name.startswith(DEFAULT_INDEX_NAME) or
+                entry.name == BACKED_UP_SNAPSHOT_NAME)
+
+    iphone_previous, iphone_snapshot = build_snapshot(
+        iphone_dcim_dir, os.path.join(new_files_dir, IPHONE_SNAPSHOT_NAME),
+        algorithm=algorithm, jobs=jobs)
+    backed_previous, backed_snapshot = build_snapshot(
+        backed_up_files_dir,
+        os.path.join(backed_up_files_dir, BACKED_UP_SNAPSHOT_NAME),
+        exclude_backed_up, algorithm, jobs, hash_index)
+    content_diff_fname = os.path.join(new_files_dir, CONTENT_DIFF_NAME)
+    previous = load_content_diff(content_diff_fname, iphone_previous,
+                                 backed_previous)
+    print('Comparing %s' % ('all dirs' if previous is None else
+                            'the dirs changed since the last comparison'))
+    # the layouts of the trees differ, compare the contents
+    diffs, missing = diff_contents(iphone_snapshot, backed_snapshot,
+                                   names=('iPhone', 'backed-up'),
+                                   previous=previous)
+    save_content_diff(content_diff_fname, iphone_snapshot, backed_snapshot,
+                      missing)
+    print('Dirs with different files: %s' % len(diffs))
+    for name, rel_dir, description in diffs:
+        print('%s %s: %s' % (name, rel_dir, description))
 
 
 def run():
@@ -129,22 +617,58 @@ def run():
     backed_up_files_dir = args.backed_up_files_dir
     print('iPhone DCIM dir: "%s"\nBacked-up files dir: "%s"' % 
           (iphone_dcim_dir, backed_up_files_dir))
-    backed_up_file_names = list()
-    iphone_file_names = list()
-    
-    print('Reading backed-up file names from: %s' % backed_up_files_dir)
-    read_file_names(backed_up_files_dir, backed_up_file_names)
-    print('Read backed-up file names: %s' % len(backed_up_file_names))
-    print('Generating hashes per file')
-    backed_hash_data_map = calculate_hash_per_file(backed_up_file_names)
-    
-    print('Reading iPhone file names from: %s' % iphone_dcim_dir)
-    read_file_names(iphone_dcim_dir, iphone_file_names)
-    print('Read iPhone file names: %s' % len(iphone_file_names))
-    print('Generating hashes per file')
-    iphone_hash_data_map = calculate_hash_per_file(iphone_file_names)
-    new_file_names = \
-        get_new_file_names(backed_hash_data_map, iphone_hash_data_map)
+    if args.diff:
+        hash_index = (None if args.no_hash_index else
+                      HashIndex(backed_up_files_dir))
+        with hash_index or nullcontext():
+            diff_trees(iphone_dcim_dir, backed_up_files_dir,
+                       args.new_files_dir, args.hash_algorithm, args.jobs,
+                       hash_index)
+        return
+
+    hash_kwargs = {
+        'algorithm': args.hash_algorithm,
+        'jobs': args.jobs,
+        'use_processes': args.use_processes
+    }
+    # every dir path is kept once and the files are referred to by their
+    # positions (with the sizes in arrays), only the names of the files
+    # still compared are built
+    backed_up_file_names = PathStore()
+    iphone_file_names = PathStore()
+    hash_index = (None if args.no_hash_index else
+                  HashIndex(backed_up_files_dir))
+    with hash_index or nullcontext():
+        print('Reading backed-up file names from: %s' % backed_up_files_dir)
+        read_file_names(backed_up_files_dir, backed_up_file_names,
+                        exclude=hash_index and hash_index.is_index_file)
+        print('Read backed-up file names: %s' % len(backed_up_file_names))
+        print('Reading iPhone file names from: %s' % iphone_dcim_dir)
+        read_file_names(iphone_dcim_dir, iphone_file_names)
+        print('Read iPhone file names: %s' % len(iphone_file_names))
+        known_hashes = {}
+        backed_duplicates = []
+        new_file_names = find_new_file_names(
+            backed_up_file_names, get_file_sizes(backed_up_file_names),
+            iphone_file_names, get_file_sizes(iphone_file_names),
+            hash_index, known_hashes, backed_duplicates, **hash_kwargs)
+        if args.near_duplicates is not None and new_file_names:
+            new_file_names = remove_near_duplicates(
+                backed_up_file_names, new_file_names, args.near_duplicates,
+                args.perceptual_hash, hash_index, args.jobs)
+
+        if args.dedupe_backed_up and backed_duplicates:
+            stats = dedupe_files(backed_duplicates, args.dedupe_backed_up,
+                                 args.dedupe_journal)
+            print('Dedupe of backed-up files (%s): %s' %
+                  (args.dedupe_backed_up, stats))
+
+        if hash_index:
+            count_removed = hash_index.remove_missing(backed_up_file_names)
+            print('Hash index (%s): %s reused, %s calculated, %s removed' %
+                  (hash_index.index_fname, hash_index.count_hits,
+                   hash_index.count_misses, count_removed))
+
     print('new file names: %s' % len(new_file_names))
     if not new_file_names:
         return
@@ -157,7 +681,10 @@ def run():
         yes = ans.lower().strip() == 'y'
     
     if yes:
-        write_new_files(new_files_dir, new_file_names)
+        write_new_files(
+            new_files_dir, new_file_names, args.jobs,
+            args.hash_algorithm if args.verify_copies else None,
+            known_hashes)
     else:
         print('Will skip copying new files:\n%s' % (new_file_names,))
 
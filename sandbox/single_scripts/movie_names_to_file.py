@@ -1,8 +1,13 @@
 import logging
 import argparse
 import os
+import json
+import heapq
 
-MOVIE_EXTENSIONS = ('mkv', 'avi', 'mp4')
+from sandbox.common.file_filter import MOVIE_FILTER
+from sandbox.common.file_catalog import open_catalog
+
+STATE_VERSION = 2
 LOG = None
 
 def parse_args():
@@ -14,6 +19,15 @@ def parse_args():
     If not abspath, it is considered to be in the directory with movies.
     If exists will only add the new names (if any).
     '''))
+    arg_parser.add_argument('--full-rescan', action='store_true', help=(
+        'List all directories (by default only the directories with '
+        'changed mtime since the last run are listed, see the '
+        '"<out-file>.state.json" file)'))
+    arg_parser.add_argument('--catalog', help=(
+        'Take the names from this catalog file of the dir, the dir is '
+        'scanned into it if it does not exist'))
+    arg_parser.add_argument('--rescan', action='store_true',
+                            help='Scan the dir again (Used for --catalog)')
     args = arg_parser.parse_args()
     if not os.path.isdir(args.dir):
         raise Exception('Invalid dir path provided')
@@ -29,68 +43,212 @@ def init_logging(is_debug=None):
                         datefmt='%Y-%m-%d %H-%M-%S')
 
 
-def movie_names_to_file(dir_name, out_file):
-    names = set()
+def movie_names_to_file(dir_name, out_file, full_rescan=False,
+                        catalog_fname=None, rescan=False):
+    """
+    :param catalog_fname: file catalog (sandbox.common.file_catalog) of
+    dir_name, used instead of walking the dir
+    """
     if not os.path.isabs(out_file):
         out_file = os.path.join(dir_name, out_file)
 
-    if os.path.isfile(out_file):
-        with open(out_file) as fin:
-            for line in fin:
-                names.add(line.strip())
+    if catalog_fname:
+        LOG.info('Movies dir: %s, output file: %s, catalog: %s', dir_name,
+                 out_file, catalog_fname)
+        with open_catalog(catalog_fname, dir_name, rescan) as catalog:
+            names = {
+                os.path.join(dir_path, name)
+                for dir_path, name, _, _ in catalog.iter_files(relative=True)
+                if MOVIE_FILTER.match_name(name)
+            }
+        LOG.info('Collected movie names: %s', len(names))
+        update_file(names, out_file)
+        return
 
+    state_fname = '%s.state.json' % out_file
     LOG.info('Movies dir: %s, output file: %s', dir_name, out_file)
-    LOG.info('Collecting movie names')
-    names.update(get_movie_names(dir_name, dir_name))
+    dir_states = {} if full_rescan else \
+        load_state(state_fname, dir_name, out_file)
+    LOG.info('Collecting movie names (known dirs: %s)', len(dir_states))
+    names, dir_states = get_movie_names(dir_name, dir_states)
     LOG.info('Collected movie names: %s', len(names))
     update_file(names, out_file)
+    save_state(state_fname, dir_name, dir_states, out_file)
+
+
+def get_file_fingerprint(fname):
+    """
+    :return list: [size, mtime_ns] of fname, None if it does not exist
+    """
+    try:
+        stat_result = os.stat(fname)
+    except FileNotFoundError:
+        return None
+
+    return [stat_result.st_size, stat_result.st_mtime_ns]
+
+
+def load_state(state_fname, dir_name, out_file):
+    """
+    The names of the unchanged dirs are taken from out_file, so the state
+    is used only if out_file is the same as written in the last run (not
+    deleted, moved or edited).
+
+    :return dict: relative dir name -> [mtime_ns, sub-dir names] from the
+    last run, empty if there is no state for dir_name and out_file
+    """
+    if not os.path.isfile(state_fname):
+        return {}
+
+    with open(state_fname, encoding='utf-8', errors='surrogateescape') as fin:
+        state = json.load(fin)
 
+    if state.get('version') != STATE_VERSION or \
+            state.get('dir') != os.path.abspath(dir_name):
+        LOG.info('Ignoring state for another dir/version: %s', state_fname)
+        return {}
 
-def get_movie_names(root_dir, dir_name):
-    LOG.debug('Processing dir: %s', dir_name)
+    if state.get('out_file') != get_file_fingerprint(out_file):
+        LOG.warning('%s is missing or changed since the last run, listing '
+                    'all dirs', out_file)
+        return {}
+
+    return state['dirs']
+
+
+def save_state(state_fname, dir_name, dir_states, out_file):
+    tmp_fname = '%s.tmp' % state_fname
+    with open(tmp_fname, 'w', encoding='utf-8',
+              errors='surrogateescape') as fout:
+        json.dump({
+            'version': STATE_VERSION,
+            'dir': os.path.abspath(dir_name),
+            # [size, mtime_ns] of out_file, see load_state()
+            'out_file': get_file_fingerprint(out_file),
+            'dirs': dir_states
+        }, fout)
+
+    os.replace(tmp_fname, state_fname)
+
+
+def get_movie_names(root_dir, dir_states=None):
+    """
+    Only the directories with mtime different from dir_states (new, or
+    with added/removed/renamed entries) are listed, for the rest only the
+    known sub-directories are visited. The names are never removed from
+    the output file, so unchanged directories can not add names to it.
+
+    :param dir_states: see load_state()
+    :return tuple: (set of the movie names in the listed directories, new
+    dir states)
+    """
     # sometimes the movie is in directory, sometimes is not
     # sometimes the directory and the file name are different so store both
+    dir_states = dir_states or {}
     movie_names = set()
-    root_dir_len = len(root_dir)
-    for f in os.listdir(dir_name):
-        f = os.path.join(dir_name, f)
-        if os.path.isdir(f):
-            movie_names.update(get_movie_names(root_dir, f))
+    new_dir_states = {}
+    count_listed = 0
+    rel_dirs = ['']
+    while rel_dirs:
+        rel_dir = rel_dirs.pop()
+        cur_dir = os.path.join(root_dir, rel_dir) if rel_dir else root_dir
+        try:
+            mtime_ns = os.stat(cur_dir).st_mtime_ns
+        except OSError as ex:
+            LOG.debug('Skipping dir: %s', ex)
             continue
 
-        dot_index = f.rfind('.')
-        if dot_index == -1:
-            continue
+        dir_state = dir_states.get(rel_dir)
+        if dir_state and dir_state[0] == mtime_ns:
+            sub_dirs = dir_state[1]
+        else:
+            LOG.debug('Processing dir: %s', cur_dir)
+            count_listed += 1
+            sub_dirs = []
+            with os.scandir(cur_dir) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        sub_dirs.append(entry.name)
+                    elif MOVIE_FILTER(entry):
+                        name = os.path.join(rel_dir, entry.name)
+                        LOG.debug('* movie: %s', name)
+                        movie_names.add(name)
+
+        new_dir_states[rel_dir] = [mtime_ns, sub_dirs]
+        rel_dirs.extend(os.path.join(rel_dir, name) for name in sub_dirs)
+
+    LOG.info('Dirs: %s, listed (new or changed): %s', len(new_dir_states),
+             count_listed)
+    return movie_names, new_dir_states
+
+
+def _read_names(fname):
+    with open(fname) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def _is_sorted(fname):
+    prev_name = ''
+    for name in _read_names(fname):
+        if name < prev_name:
+            return False
+
+        prev_name = name
+
+    return True
 
-        extension = f[dot_index + 1:]
-        if extension not in MOVIE_EXTENSIONS:
-            continue
-        
-        if os.path.basename(f).lower() == 'sample.%s' % extension:
-            continue
-        
-        name = f[root_dir_len+1:]
-        LOG.debug('* movie: %s', name)
-        movie_names.add(name)
-    
-    LOG.debug('Done processing dir: %s', dir_name)
-    return movie_names
 
 def update_file(names, out_file):
+    """
+    Merge the names into the sorted names in out_file. The file is read and
+    written as a stream and is not rewritten if there are no new names.
+    """
     if not names:
         return
-    
-    LOG.info('Writing to %s', out_file)
-    names = sorted(names)
-    with open(out_file, 'w') as fout:
-        fout.writelines('%s\n' % name for name in names)
+
+    if not os.path.isfile(out_file):
+        existing_names = iter(())
+    elif _is_sorted(out_file):
+        existing_names = _read_names(out_file)
+    else:
+        # edited by hand
+        LOG.info('Not sorted, sorting: %s', out_file)
+        existing_names = iter(sorted(set(_read_names(out_file))))
+
+    tmp_fname = '%s.tmp' % out_file
+    count_new = 0
+    with open(tmp_fname, 'w') as fout:
+        prev_name = None
+        # for equal names the existing one (0) comes first
+        for name, is_new in heapq.merge(
+                ((name, 0) for name in existing_names),
+                ((name, 1) for name in sorted(names))):
+            if name == prev_name:
+                continue
+
+            prev_name = name
+            count_new += is_new
+            fout.write('%s\n' % name)
+
+    if not count_new:
+        os.unlink(tmp_fname)
+        LOG.info('No new names')
+        return
+
+    os.replace(tmp_fname, out_file)
+    LOG.info('Written %s new names to %s', count_new, out_file)
+
 
 def run():
     args = parse_args()
     init_logging(args.debug)
     global LOG
     LOG = logging.getLogger(__name__)
-    movie_names_to_file(args.dir, args.out_file)
+    movie_names_to_file(args.dir, args.out_file, args.full_rescan,
+                        args.catalog, args.rescan)
 
 
 if __name__ == '__main__':
@@ -13,11 +13,14 @@ from datetime import datetime
 import re
 import json
 
+from sandbox.common.file_filter import FileFilter
+
 # 00:00:06,006 --> 00:00:11,750
 TIME_MARKER_REGEX = re.compile('^\d[\d:,-> ]+$')
 # - [cheering]
 # [applauding]
 HI_REGEX = re.compile(r'^(\s*-\s*)?\[.+\]$')
+SRT_FILTER = FileFilter(extensions=['srt'], files_only=True)
 
 
 def read_cli():
@@ -37,10 +40,14 @@ def gen_out_dir_name(dir_name):
 
 
 def is_srt_file(fname):
-    return os.path.isfile(fname) and fname.endswith('.srt')
+    return SRT_FILTER.match_path(fname)
 
 
-def read_blocks(fname):
+def iter_blocks(fname, stat):
+    """
+    :param stat: dict, "blocks before" is counted in it
+    :return generator: the blocks of the file, read one at a time
+    """
 
     def init_new_block(block_id):
         return {
@@ -49,10 +56,8 @@ def read_blocks(fname):
             'lines': []
         }
 
-    print('Reading blocks')
     cur_block = init_new_block(1)
-    blocks = []
-    next_block_id = 2
+    next_block_id = '2'
     # skip BOM, otherwise the first line "1" is read as "\ufeff1"
     with open(fname, encoding='utf-8-sig') as fin:
         first_line = fin.readline().strip()
@@ -62,77 +67,95 @@ def read_blocks(fname):
         # the loop starts from the second line
         for line in fin:
             line = line.rstrip('\n')
-            if line.strip() == str(next_block_id):
+            if line.strip() == next_block_id:
                 if not cur_block['time'] or not cur_block['lines']:
                     raise Exception('Invalid block %s' % cur_block)
 
-                blocks.append(cur_block)
+                stat['blocks before'] += 1
+                yield cur_block
                 cur_block = init_new_block(next_block_id)
-                next_block_id += 1
+                next_block_id = str(int(next_block_id) + 1)
             elif TIME_MARKER_REGEX.match(line) and not cur_block['time']:
                 cur_block['time'] = line
             else:
                 cur_block['lines'].append(line)
         
         if cur_block['time'] is not None:
-            blocks.append(cur_block)
-    
-    print('Blocks read: %s' % len(blocks))
-    return blocks
-
-
-def remove_hi_from_blocks(blocks):
-    print('Removing HI from blocks')
-    i = 0
-    modified_blocks = 0
-    while i < len(blocks):
-        block = blocks[i]
+            stat['blocks before'] += 1
+            yield cur_block
+
+
+def remove_hi_from_blocks(blocks, stat):
+    """
+    :param stat: dict, "blocks removed" and "blocks modified" are counted
+    in it
+    :return generator: the blocks without the HI lines, the blocks with HI
+    lines only are skipped
+    """
+    for block in blocks:
         lines = block['lines']
         if not lines:
             raise Exception('No lines (text) for block: %s' % block)
         
-        new_lines = []
-        for line in lines:
-            if HI_REGEX.match(line):
-                continue
-            
-            new_lines.append(line)  # include empty line separators
-        
+        # include empty line separators
+        new_lines = [line for line in lines if not HI_REGEX.match(line)]
         if not new_lines or len(new_lines) == 1 and new_lines[0].strip() == '':
-            del blocks[i]
-        else:
-            i += 1
-            if len(lines) != len(new_lines):
-                modified_blocks += 1
-                block['lines'] = new_lines
-        
-    return modified_blocks
-    
+            stat['blocks removed'] += 1
+            continue
+
+        if len(lines) != len(new_lines):
+            stat['blocks modified'] += 1
+            block['lines'] = new_lines
+
+        yield block
+
+
+def renumber_blocks(blocks):
+    """
+    :return generator: (new block id, block), some of the blocks might be
+    removed so block['id'] is not reliable
+    """
+    return enumerate(blocks, 1)
+
+
+def write_blocks(numbered_blocks, fout):
+    """
+    :return int: count of the written blocks
+    """
+    count_blocks = 0
+    for block_id, block in numbered_blocks:
+        fout.write('%s\n%s\n' % (block_id, block['time']))
+        fout.writelines('%s\n' % line for line in block['lines'])
+        count_blocks = block_id
+
+    return count_blocks
+
 
 def remove_hi(fname, out_dir):
+    """
+    The file is streamed through parse -> filter -> renumber -> write, a
+    block at a time, so the memory used does not depend on the file size.
+    """
     print('Removing HI from file: "%s"' % fname)
     stat = {
-        'blocks before': None,
+        'blocks before': 0,
         'blocks after': None,
-        'blocks removed': None,
-        'blocks modified': None
+        'blocks removed': 0,
+        'blocks modified': 0
     }
-    blocks = read_blocks(fname)
-    stat['blocks before'] = len(blocks)
-    stat['blocks modified'] = remove_hi_from_blocks(blocks)
-    stat['blocks after'] = len(blocks)
-    stat['blocks removed'] = stat['blocks before'] - stat['blocks after']
     out_fname = os.path.join(out_dir, os.path.basename(fname))
     print('Writing to output file %s' % out_fname)
-    block_id = 1
-    with open(out_fname, 'w') as fout:
-        # some of the blocks might be removed so block['id'] is not reliable
-        for block in blocks: 
-            lines = [str(block_id), block['time']]
-            lines.extend(block['lines'])
-            fout.writelines('%s\n' % line for line in lines)
-            block_id += 1
-    
+    # no partial output file if the input is invalid
+    tmp_fname = '%s.tmp' % out_fname
+    try:
+        with open(tmp_fname, 'w') as fout:
+            blocks = remove_hi_from_blocks(iter_blocks(fname, stat), stat)
+            stat['blocks after'] = write_blocks(renumber_blocks(blocks), fout)
+    except BaseException:
+        os.remove(tmp_fname)
+        raise
+
+    os.replace(tmp_fname, out_fname)
     return stat
 
 
@@ -141,11 +164,10 @@ def run():
     stats = {}
     if os.path.isdir(source):
         out_dir = gen_out_dir_name(source)
-        for fname in os.listdir(source):
-            fname = os.path.join(source, fname)
-            if not is_srt_file(fname):
-                continue
-            
+        with os.scandir(source) as it:
+            srt_fnames = [entry.path for entry in it if SRT_FILTER(entry)]
+
+        for fname in srt_fnames:
             stats[fname] = remove_hi(fname, out_dir)
             
     elif is_srt_file(source):
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from sandbox.common.file_copy import copy_file, CopyVerificationException
+from sandbox.common.hashing import get_file_hash
+
+
+class CopyFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir_name = tempfile.mkdtemp()
+        self.src_fname = os.path.join(self.dir_name, 'src.bin')
+        self.dest_fname = os.path.join(self.dir_name, 'dest.bin')
+        with open(self.src_fname, 'wb') as f:
+            f.write(os.urandom(300000))
+
+        self.digest = get_file_hash(self.src_fname, 'sha1')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_name)
+
+    def _corrupt_dest(self, *args):
+        with open(self.dest_fname, 'r+b') as f:
+            f.seek(1000)
+            f.write(b'\0' * 10)
+
+    def _truncate_dest(self, *args):
+        os.truncate(self.dest_fname, 1000)
+
+    def test_verified_copy(self):
+        for expected_digest in (None, self.digest):
+            self.assertEqual(
+                copy_file(self.src_fname, self.dest_fname, 'sha1',
+                          expected_digest),
+                (300000, self.digest))
+
+    def test_corrupt_destination(self):
+        for damage in (self._corrupt_dest, self._truncate_dest):
+            for expected_digest in (None, self.digest):
+                # the destination is damaged after it is written
+                with mock.patch('shutil.copystat', side_effect=damage):
+                    with self.assertRaisesRegex(CopyVerificationException,
+                                                'destination digest'):
+                        copy_file(self.src_fname, self.dest_fname, 'sha1',
+                                  expected_digest)
+
+    def test_changed_source(self):
+        with self.assertRaisesRegex(CopyVerificationException,
+                                    'source digest'):
+            copy_file(self.src_fname, self.dest_fname, 'sha1', '0' * 40)
+
+    def test_not_verified_copy(self):
+        self.assertEqual(copy_file(self.src_fname, self.dest_fname),
+                         (300000, None))
+        self.assertEqual(get_file_hash(self.dest_fname, 'sha1'), self.digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from sandbox.rename_files.inotify_watch import InotifyWatcher
+
+
+class InotifyWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.outside = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.top, 'sub', 'nested'))
+        self.watcher = InotifyWatcher()
+        self.watcher.add_tree(self.top)
+        self.batches = self.watcher.iter_batches(delay=0.1)
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.top)
+        shutil.rmtree(self.outside)
+
+    def _create_file(self, *names):
+        with open(os.path.join(self.top, *names), 'w') as f:
+            f.write('x')
+
+    def test_new_file_in_renamed_dir(self):
+        os.rename(os.path.join(self.top, 'sub'),
+                  os.path.join(self.top, 'sub_renamed'))
+        batch = next(self.batches)
+        self.assertEqual(batch.new_dirs, [])
+        self.assertEqual(dict(batch.new_files), {})
+
+        self._create_file('sub_renamed', 'a.txt')
+        self._create_file('sub_renamed', 'nested', 'b.txt')
+        batch = next(self.batches)
+        self.assertEqual(dict(batch.new_files), {
+            os.path.join(self.top, 'sub_renamed'): {'a.txt'},
+            os.path.join(self.top, 'sub_renamed', 'nested'): {'b.txt'},
+        })
+
+    def test_file_renamed_in_same_batch_as_its_dir(self):
+        self._create_file('sub', 'a.txt')
+        os.rename(os.path.join(self.top, 'sub'),
+                  os.path.join(self.top, 'sub_renamed'))
+        batch = next(self.batches)
+        self.assertEqual(dict(batch.new_files), {
+            os.path.join(self.top, 'sub_renamed'): {'a.txt'},
+        })
+
+    def test_dir_moved_out_of_tree(self):
+        os.rename(os.path.join(self.top, 'sub'),
+                  os.path.join(self.outside, 'sub'))
+        next(self.batches)
+        self.assertEqual(sorted(self.watcher._wd_to_dir.values()),
+                         [self.top])
+        self.assertEqual(self.watcher._moved_from, {})
+
+    def test_file_renamed_in_dir_is_not_new(self):
+        self._create_file('a.txt')
+        next(self.batches)
+        os.rename(os.path.join(self.top, 'a.txt'),
+                  os.path.join(self.top, 'b.txt'))
+        self._create_file('c.txt')
+        batch = next(self.batches)
+        self.assertEqual(dict(batch.new_files), {self.top: {'c.txt'}})
+
+
+if __name__ == '__main__':
+    unittest.main()